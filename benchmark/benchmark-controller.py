@@ -0,0 +1,651 @@
+"""Benchmark and load test for the Dask controller.
+
+Runs dask-controller.py in-process against the fake Kubernetes/OpenShift
+API server and HubAuth stub in fake_kubernetes.py, so it needs no cluster,
+hub or network access. For each number of users, a fresh process is used
+which simulates every user spawning a notebook, polling /pods, scaling
+their workers up and down, and then going idle so their cluster is culled.
+
+For each phase it reports the requests per second achieved, the p50 and
+p99 latency of the controller routes, and the number of Kubernetes API
+requests made per user action. The resident memory of the process, which
+includes the fake API server, is reported at the end of each run.
+
+With --replicas, that many controllers are run side by side with sharding
+enabled, each serving HTTP on a local port so that provisioning requests
+can be forwarded between them. Requests are spread across the replicas,
+and before the idle phase one replica is stopped as if it had crashed, to
+time how long the others take to notice and take over its clusters. With
+three or more replicas, another is then shut down cleanly, releasing its
+lease, to time how quickly its clusters are handed over.
+
+With --api-latency, each API request other than a watch is delayed by
+that many seconds, to see the effect of round trips to a real API server.
+
+With --api-errors, that fraction of API requests other than watches fail
+as if the API server were overloaded, to see how well the controller's
+retries and circuit breaker cope. The controller's own API rate limit is
+off unless --api-qps is given.
+
+With --budget, a worker budget of the workers each user starts with is
+set, and a phase added which suspends the workers of half the clusters,
+has the rest scale up into the room freed, then resumes the suspended
+clusters, checking that the total never goes over the budget.
+
+The startup timings of each replica are also reported: how long loading
+the module, API discovery and the initial sync of each cache took.
+
+    python benchmark/benchmark-controller.py --users 10 100 1000 10000
+    python benchmark/benchmark-controller.py --users 1000 --replicas 3
+    python benchmark/benchmark-controller.py --users 100 --api-latency 0.05
+    python benchmark/benchmark-controller.py --users 100 --api-errors 0.05
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+import importlib.util
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+controller_path = os.path.join(here, '..', 'jupyterhub', 'dask-controller.py')
+
+def resident_memory():
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return values[int(fraction * (len(values) - 1))]
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def reset_metrics():
+    # Every replica registers the same metrics in the default registry,
+    # so clear it before loading another. Only the metrics of the last
+    # replica loaded are then exported.
+
+    from prometheus_client import REGISTRY
+
+    for collector in list(REGISTRY._collector_to_names):
+        REGISTRY.unregister(collector)
+
+def load_controller(server, options, index=0):
+    namespace_file = tempfile.NamedTemporaryFile('w', delete=False)
+    namespace_file.write('benchmark')
+    namespace_file.close()
+
+    port = free_port()
+
+    os.environ.update({
+        'DASK_NAMESPACE_FILE': namespace_file.name,
+        'JUPYTERHUB_API_TOKEN': 'benchmark',
+        'JUPYTERHUB_SERVICE_PREFIX': '/services/dask-controller/',
+        'JUPYTERHUB_NAME': 'jupyterhub',
+        'DASK_CLUSTER_NAME': 'dask',
+        'DASK_CONTROLLER_API_TOKEN': 'benchmark',
+        'DASK_WORKER_REPLICAS': str(options.workers),
+        'DASK_MAX_WORKER_REPLICAS': str(options.workers + 2),
+        'DASK_IDLE_CLUSTER_TIMEOUT': '0',
+        'DASK_IDLE_DELETE_TIMEOUT': '0',
+        'DASK_IDLE_WORKER_TIMEOUT': '0',
+        'DASK_RECONCILE_QPS': str(options.reconcile_qps),
+        'DASK_RECONCILE_BURST': str(int(options.reconcile_qps)),
+        'DASK_CONTROLLER_SHARDING': 'true' if options.replicas > 1 else '',
+        'DASK_CONTROLLER_IDENTITY': 'replica%d' % index,
+        'DASK_CONTROLLER_ADDRESS': '127.0.0.1:%d' % port,
+        'DASK_LEASE_DURATION': str(options.lease_duration),
+        'DASK_DISCOVERY_CACHE_FILE': options.discovery_cache_file,
+        'DASK_WORKER_BUDGET': str(options.users * options.workers
+                if options.budget else 0),
+        'DASK_API_QPS': str(options.api_qps),
+        'DASK_API_BURST': str(int(options.api_qps) * 2),
+    })
+
+    if index:
+        reset_metrics()
+
+    spec = importlib.util.spec_from_file_location('dask_controller%d' % index,
+            controller_path)
+
+    controller = importlib.util.module_from_spec(spec)
+
+    sys.modules[spec.name] = controller
+
+    spec.loader.exec_module(controller)
+
+    # Stand in for the scheduler dashboards, reporting the worker pods
+    # of the cluster as its workers.
+
+    def fetch_scheduler_json(name, path, data=None, timeout=None):
+        if path == '/json/identity.json':
+            worker_name = controller.worker_deployment_name(name)
+
+            workers = {}
+
+            for pod in controller.pod_informer.by_index('deployment',
+                    worker_name):
+                address = 'tcp://%s:8786' % pod.status.podIP
+                workers[address] = dict(host=pod.status.podIP, ncores=1,
+                        memory_limit=512*1024*1024, memory=64*1024*1024)
+
+            return dict(workers=workers)
+
+        return {}
+
+    def retire_scheduler_workers(name, addresses):
+        return dict((address, {}) for address in addresses)
+
+    controller.fetch_scheduler_json = fetch_scheduler_json
+
+    controller.retire_scheduler_workers = retire_scheduler_workers
+
+    controller.fetch_scheduler_memory = lambda name: 64*1024*1024
+
+    if options.replicas > 1:
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class RequestHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        http_server = make_server('127.0.0.1', port, controller.application,
+                threaded=True, request_handler=RequestHandler)
+
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    return controller
+
+class Phase(object):
+
+    def __init__(self, name, server):
+        self.name = name
+        self.server = server
+
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.actions = 0
+
+    def __enter__(self):
+        self.requests = self.server.total_requests()
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.duration = time.time() - self.started
+        self.api_requests = self.server.total_requests() - self.requests
+
+    def request(self, client, route, url, method='GET', headers={}):
+        started = time.time()
+
+        response = client.open(url, method=method, headers=headers)
+
+        elapsed = time.time() - started
+
+        with self.lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+
+        return response
+
+    def action(self, count=1):
+        with self.lock:
+            self.actions += count
+
+    def report(self):
+        requests = sum(len(values) for values in self.latencies.values())
+
+        return dict(phase=self.name, duration=self.duration,
+                requests_per_second=requests / self.duration
+                        if self.duration else None,
+                api_requests=self.api_requests,
+                api_requests_per_action=float(self.api_requests) /
+                        self.actions if self.actions else None,
+                routes=dict((route, dict(count=len(values),
+                        p50=percentile(values, 0.5),
+                        p99=percentile(values, 0.99)))
+                        for route, values in self.latencies.items()))
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+
+    return False
+
+def run(options):
+    sys.path.insert(0, here)
+
+    import fake_kubernetes
+
+    server = fake_kubernetes.FakeApiServer(latency=options.api_latency,
+            errors=options.api_errors)
+
+    fake_kubernetes.install(server)
+
+    memory_before = resident_memory()
+
+    # The replicas of a run share the API discovery cache, so only the
+    # first has to do discovery, as after a restart of a real controller.
+
+    options.discovery_cache_file = os.path.join(tempfile.mkdtemp(),
+            'discovery.json')
+
+    controllers = [load_controller(server, options, index)
+            for index in range(options.replicas)]
+
+    for controller in controllers:
+        controller.pod_informer.wait_for_sync(30.0)
+        controller.deployment_informer.wait_for_sync(30.0)
+        controller.service_informer.wait_for_sync(30.0)
+
+    startup = [dict(controller.startup_timings)
+            for controller in controllers]
+
+    def members(controller):
+        return controller.membership.ring.members
+
+    if options.replicas > 1:
+        if not wait_for(lambda: all(len(members(controller)) ==
+                options.replicas for controller in controllers), 60.0):
+            print('WARNING: not all replicas joined.', file=sys.stderr)
+
+    # Checks on progress can use any replica, as all of them watch
+    # every pod and deployment.
+
+    controller = controllers[0]
+
+    prefix = '/services/dask-controller'
+
+    users = ['user%05d' % i for i in range(options.users)]
+
+    replica = dict((user, controllers[i % len(controllers)])
+            for i, user in enumerate(users))
+
+    local = threading.local()
+
+    def client(user):
+        if not hasattr(local, 'clients'):
+            local.clients = {}
+
+        target = replica[user]
+
+        if target not in local.clients:
+            local.clients[target] = target.application.test_client()
+
+        return local.clients[target]
+
+    def headers(user):
+        return {'Authorization': 'token %s' % user}
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=options.concurrency)
+
+    def each_user(function, group=None):
+        for future in [executor.submit(function, user)
+                for user in group or users]:
+            future.result()
+
+    results = []
+
+    # Spawn a notebook for each user, making the same provisioning
+    # request as the hub's pre-spawn hook, and wait until every cluster
+    # has its full complement of worker pods.
+
+    with Phase('spawn', server) as phase:
+        def spawn(user):
+            server.create('Pod', {
+                'metadata': {
+                    'name': 'jupyterhub-nb-%s' % user,
+                    'labels': {
+                        'app': 'jupyterhub',
+                        'component': 'singleuser-server'
+                    },
+                    'annotations': {
+                        'jupyteronopenshift.org/dask-cluster': user
+                    }
+                },
+                'status': {'phase': 'Running'}
+            })
+
+            phase.request(client(user), '/provision',
+                    '%s/provision?user=%s' % (prefix, user), method='POST',
+                    headers={'Authorization': 'token benchmark'})
+
+            phase.action()
+
+        each_user(spawn)
+
+        def provisioned():
+            return all(len(controller.get_pods(user)) == options.workers
+                    for user in users)
+
+        if not wait_for(provisioned, options.timeout):
+            print('WARNING: not all clusters were provisioned.',
+                    file=sys.stderr)
+
+    results.append(phase.report())
+
+    with Phase('poll', server) as phase:
+        def poll(user):
+            for i in range(options.polls):
+                phase.request(client(user), '/pods', '%s/pods' % prefix,
+                        headers=headers(user))
+                phase.action()
+
+        each_user(poll)
+
+    results.append(phase.report())
+
+    with Phase('scale', server) as phase:
+        def scale(user):
+            for replicas in (options.workers + 1, options.workers - 1):
+                phase.request(client(user), '/scale',
+                        '%s/scale?replicas=%d' %
+                        (prefix, replicas), headers=headers(user))
+                phase.action()
+
+        each_user(scale)
+
+    results.append(phase.report())
+
+    # With a worker budget, which the clusters as provisioned use all of,
+    # suspend the workers of half the clusters, have the other half ask
+    # for more workers, which takes the room freed, and then resume the
+    # suspended clusters. The workers of all the clusters must never come
+    # to more than the budget.
+
+    if options.budget:
+        budget = options.users * options.workers
+
+        def worker_replicas():
+            with server.condition:
+                return sum(deployment['spec'].get('replicas', 0)
+                        for deployment in server.objects['Deployment'].values()
+                        if deployment['metadata']['labels'].get('component')
+                        == 'dask-worker')
+
+        peak = [worker_replicas()]
+
+        sampled = threading.Event()
+
+        def sample():
+            while not sampled.is_set():
+                peak[0] = max(peak[0], worker_replicas())
+                time.sleep(0.01)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+
+        # Suspending and resuming is done by the replica owning the
+        # cluster, as it would be when driven by the activity checks.
+
+        def owner(user):
+            for other in controllers:
+                if other.owns_cluster(user):
+                    return other
+
+            return replica[user]
+
+        with Phase('budget', server) as phase:
+            def suspend(user):
+                owner(user).suspend_cluster(user, workers_only=True)
+                phase.action()
+
+            def grow(user):
+                phase.request(client(user), '/scale',
+                        '%s/scale?replicas=%d' % (prefix,
+                        options.workers + 2), headers=headers(user))
+                phase.action()
+
+            def resume(user):
+                owner(user).resume_cluster(user)
+                phase.action()
+
+            each_user(suspend, users[::2])
+            each_user(grow, users[1::2])
+            each_user(resume, users[::2])
+
+            # Give any waiting requests the chance to be granted.
+
+            time.sleep(1.0)
+
+        sampled.set()
+        sampler.join()
+
+        if peak[0] > budget:
+            print('WARNING: %d workers is over the budget of %d.' % (
+                    peak[0], budget), file=sys.stderr)
+
+        report = phase.report()
+        report.update(budget=budget, peak_workers=peak[0])
+
+        results.append(report)
+
+    # Stop one replica without releasing its lease, as if it had crashed,
+    # and wait for the others to drop it and share out its clusters.
+
+    if options.replicas > 1:
+        with Phase('failover', server) as phase:
+            crashed = controllers.pop()
+
+            crashed.membership.running = False
+
+            identity = crashed.membership.identity
+
+            names = controller.deployment_informer.index_values(
+                    'dask-cluster')
+
+            phase.action(len(names))
+
+            def rebalanced():
+                if any(identity in members(other) for other in controllers):
+                    return False
+
+                return all(sum(other.owns_cluster(name) for other in
+                        controllers) == 1 for name in names)
+
+            if not wait_for(rebalanced, options.timeout):
+                print('WARNING: clusters were not taken over.',
+                        file=sys.stderr)
+
+        results.append(phase.report())
+
+    # Stop another replica as it would be on shutdown, releasing its lease,
+    # and wait for the others to share out its clusters, which shouldn't
+    # need the lease to expire.
+
+    if len(controllers) > 1:
+        with Phase('shutdown', server) as phase:
+            stopped = controllers.pop()
+
+            stopped.membership.stop()
+
+            identity = stopped.membership.identity
+
+            names = controller.deployment_informer.index_values(
+                    'dask-cluster')
+
+            phase.action(len(names))
+
+            def rebalanced():
+                if any(identity in members(other) for other in controllers):
+                    return False
+
+                return all(sum(other.owns_cluster(name) for other in
+                        controllers) == 1 for name in names)
+
+            if not wait_for(rebalanced, options.timeout):
+                print('WARNING: clusters were not taken over.',
+                        file=sys.stderr)
+
+        results.append(phase.report())
+
+    # Remove every notebook and wait until the culler has deleted all the
+    # clusters, which with the timeouts of zero is done straight away.
+
+    with Phase('idle', server) as phase:
+        def idle(user):
+            server.delete('Pod', 'jupyterhub-nb-%s' % user)
+            phase.action()
+
+        each_user(idle)
+
+        def culled():
+            return not controller.deployment_informer.index_values(
+                    'dask-cluster')
+
+        if not wait_for(culled, options.timeout):
+            print('WARNING: not all clusters were culled.', file=sys.stderr)
+
+    results.append(phase.report())
+
+    executor.shutdown()
+
+    shutil.rmtree(os.path.dirname(options.discovery_cache_file))
+
+    return dict(users=options.users, replicas=options.replicas,
+            phases=results, startup=startup,
+            api_errors=sum(count for (verb, kind), count in
+                    server.requests.items() if verb == 'error'),
+            circuit_breaker_trips=sum(controller.api_breaker.trips
+                    for controller in controllers),
+            hub_auth_lookups=sys.modules['jupyterhub.services.auth'].HubAuth
+                    .lookups,
+            resident_memory=resident_memory(),
+            resident_memory_growth=resident_memory() - memory_before)
+
+def format_seconds(value):
+    return '-' if value is None else '%.2fms' % (value * 1000)
+
+def summarise(result):
+    print('%d users, %d replicas, %.1f MiB resident (%.1f MiB growth), '
+            '%d hub lookups' % (result['users'], result['replicas'],
+            result['resident_memory'] / 1048576.0,
+            result['resident_memory_growth'] / 1048576.0,
+            result['hub_auth_lookups']))
+
+    if result['api_errors']:
+        print('  %d API errors injected, circuit breaker opened %d times' % (
+                result['api_errors'], result['circuit_breaker_trips']))
+
+    for index, timings in enumerate(result['startup']):
+        print('  startup  replica%d %s' % (index, ' '.join('%s=%.3fs' %
+                (step, seconds) for step, seconds in timings.items())))
+
+    for phase in result['phases']:
+        print('  %-8s %8.2fs %10.1f req/s %8.2f api/action' % (
+                phase['phase'], phase['duration'],
+                phase['requests_per_second'] or 0.0,
+                phase['api_requests_per_action'] or 0.0))
+
+        if 'budget' in phase:
+            print('           peak of %d workers, budget %d' % (
+                    phase['peak_workers'], phase['budget']))
+
+        for route, stats in sorted(phase['routes'].items()):
+            print('           %-12s n=%-7d p50=%-10s p99=%s' % (route,
+                    stats['count'], format_seconds(stats['p50']),
+                    format_seconds(stats['p99'])))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('--users', type=int, nargs='+',
+            default=[10, 100, 1000, 10000])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--polls', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--reconcile-qps', type=float, default=1000.0)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--lease-duration', type=int, default=3)
+    parser.add_argument('--api-latency', type=float, default=0.0,
+            help='seconds added to each API request')
+    parser.add_argument('--api-errors', type=float, default=0.0,
+            help='fraction of API requests which fail')
+    parser.add_argument('--api-qps', type=float, default=0.0,
+            help='controller API rate limit, 0 for none')
+    parser.add_argument('--budget', action='store_true',
+            help='set a worker budget and check it is kept to')
+    parser.add_argument('--json', action='store_true',
+            help='print results as JSON')
+    parser.add_argument('--child', action='store_true',
+            help=argparse.SUPPRESS)
+
+    options = parser.parse_args()
+
+    if options.child:
+        options.users = options.users[0]
+        print(json.dumps(run(options)))
+
+        # The controller's background threads are not daemon threads.
+
+        sys.stdout.flush()
+        os._exit(0)
+
+    # Each run uses a new process so that runs don't share controller
+    # state and the memory figures are independent.
+
+    results = []
+
+    for users in options.users:
+        command = [sys.executable, os.path.abspath(__file__), '--child',
+                '--users', str(users), '--workers', str(options.workers),
+                '--polls', str(options.polls), '--concurrency',
+                str(options.concurrency), '--reconcile-qps',
+                str(options.reconcile_qps), '--timeout', str(options.timeout),
+                '--replicas', str(options.replicas), '--lease-duration',
+                str(options.lease_duration), '--api-latency',
+                str(options.api_latency), '--api-errors',
+                str(options.api_errors), '--api-qps', str(options.api_qps)]
+
+        if options.budget:
+            command.append('--budget')
+
+        output = subprocess.check_output(command, universal_newlines=True)
+
+        result = json.loads(output.strip().splitlines()[-1])
+
+        results.append(result)
+
+        if not options.json:
+            summarise(result)
+
+    if options.json:
+        print(json.dumps(results, indent=4))
+
+if __name__ == '__main__':
+    main()
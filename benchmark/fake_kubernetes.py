@@ -0,0 +1,553 @@
+"""In-process stand-in for the parts of the Kubernetes/OpenShift API and
+JupyterHub used by the Dask controller.
+
+Calling install() registers fake versions of the openshift, kubernetes and
+jupyterhub.services.auth modules, so that the controller can be imported
+and run without a cluster or a hub. The fake API server keeps objects in
+memory, hands out resource versions, supports list, watch, get, create,
+patch, replace, scale and delete of pods, deployments, services and
+leases, with patches and replaces conditional on any resource version
+given in the body, as the real API server does, serves API discovery
+documents, and simulates
+the deployment controller, garbage collector and kubelet closely enough
+for worker pods to appear, become ready and go away. Every request is
+counted by verb and kind, and a fraction of requests can be made to fail.
+
+"""
+
+import sys
+import copy
+import json
+import time
+import types
+import uuid
+import random
+import threading
+import collections
+
+class ApiException(Exception):
+
+    def __init__(self, status=None, reason=None):
+        super(ApiException, self).__init__(status, reason)
+        self.status = status
+        self.reason = reason
+
+    def __str__(self):
+        return '(%s) Reason: %s' % (self.status, self.reason)
+
+class ResourceField(object):
+
+    def __init__(self, params):
+        self.__dict__.update(dict((key, self._wrap(value))
+                for key, value in params.items()))
+
+    @classmethod
+    def _wrap(cls, value):
+        if isinstance(value, dict):
+            return ResourceField(value)
+        if isinstance(value, list):
+            return [cls._wrap(item) for item in value]
+        return value
+
+    @classmethod
+    def _unwrap(cls, value):
+        if isinstance(value, ResourceField):
+            return value.to_dict()
+        if isinstance(value, list):
+            return [cls._unwrap(item) for item in value]
+        return value
+
+    def __getattr__(self, name):
+        return self.__dict__.get(name)
+
+    def __getitem__(self, name):
+        return self.__dict__.get(name)
+
+    def to_dict(self):
+        return dict((key, self._unwrap(value))
+                for key, value in self.__dict__.items())
+
+class ResourceInstance(object):
+
+    def __init__(self, client, instance):
+        self.client = client
+        self.attributes = ResourceField(instance)
+
+    def __getattr__(self, name):
+        return getattr(self.attributes, name)
+
+    def __getitem__(self, name):
+        return self.attributes[name]
+
+    def to_dict(self):
+        return self.attributes.to_dict()
+
+def merge_patch(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+class FakeApiServer(object):
+
+    """Holds the objects of each kind, the log of watch events and the
+    request counters. All state is protected by a single condition, which
+    is notified whenever an event is added so that watches wake up.
+
+    """
+
+    def __init__(self, max_events=200000, latency=0.0, errors=0.0):
+        self.condition = threading.Condition()
+
+        # Time added to each request other than a watch, standing in for
+        # the round trip to a real API server.
+
+        self.latency = latency
+
+        # Fraction of requests other than watches which fail as if the API
+        # server were overloaded, before being acted on.
+
+        self.errors = errors
+
+        self.objects = dict((kind, {}) for kind in
+                ('Pod', 'Deployment', 'Service', 'Lease', 'ConfigMap'))
+
+        self.max_events = max_events
+
+        self.events = []
+        self.version = 0
+
+        self.requests = collections.Counter()
+
+        # Indexes so the simulated controllers don't scan every object.
+
+        self.owned = collections.defaultdict(set)
+        self.deployment_pods = collections.defaultdict(set)
+        self.pod_sequence = 0
+
+    def count(self, verb, kind):
+        with self.condition:
+            self.requests[(verb, kind)] += 1
+
+        if self.latency and verb != 'watch':
+            time.sleep(self.latency)
+
+        if self.errors and verb != 'watch' and random.random() < self.errors:
+            with self.condition:
+                self.requests[('error', kind)] += 1
+
+            raise ApiException(503, 'Service Unavailable')
+
+    def total_requests(self):
+        with self.condition:
+            return sum(self.requests.values())
+
+    def _event(self, event_type, kind, obj):
+        self.version += 1
+        obj['metadata']['resourceVersion'] = str(self.version)
+        self.events.append((self.version, kind, event_type,
+                copy.deepcopy(obj)))
+
+        if len(self.events) > 2 * self.max_events:
+            del self.events[:self.max_events]
+
+        self.condition.notify_all()
+
+    def list(self, kind):
+        with self.condition:
+            return {
+                'metadata': {'resourceVersion': str(self.version)},
+                'items': [copy.deepcopy(obj) for obj in
+                        self.objects[kind].values()]
+            }
+
+    def get(self, kind, name):
+        with self.condition:
+            if name not in self.objects[kind]:
+                raise ApiException(404, 'Not Found')
+            return copy.deepcopy(self.objects[kind][name])
+
+    def create(self, kind, body):
+        with self.condition:
+            return copy.deepcopy(self._create(kind, copy.deepcopy(body)))
+
+    def _create(self, kind, obj):
+        metadata = obj.setdefault('metadata', {})
+        name = metadata['name']
+
+        if name in self.objects[kind]:
+            raise ApiException(409, 'Conflict')
+
+        metadata['uid'] = str(uuid.uuid4())
+        metadata['creationTimestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        metadata.setdefault('labels', {})
+        metadata.setdefault('annotations', {})
+
+        obj['kind'] = kind
+
+        self.objects[kind][name] = obj
+
+        self._index(kind, obj)
+        self._event('ADDED', kind, obj)
+
+        if kind == 'Deployment':
+            self._reconcile_deployment(obj)
+
+        return obj
+
+    def patch(self, kind, name, body):
+        with self.condition:
+            if name not in self.objects[kind]:
+                raise ApiException(404, 'Not Found')
+
+            obj = self.objects[kind][name]
+
+            self._check_version(obj, body)
+
+            references = body.get('metadata', {}).get('ownerReferences')
+
+            merge_patch(obj, body)
+
+            if references is not None:
+                obj['metadata']['ownerReferences'] = copy.deepcopy(references)
+                self._index(kind, obj)
+
+            self._event('MODIFIED', kind, obj)
+
+            if kind == 'Deployment':
+                self._reconcile_deployment(obj)
+
+            return copy.deepcopy(obj)
+
+    def replace(self, kind, body):
+        with self.condition:
+            name = body['metadata']['name']
+
+            if name not in self.objects[kind]:
+                raise ApiException(404, 'Not Found')
+
+            obj = self.objects[kind][name]
+
+            self._check_version(obj, body)
+
+            metadata = copy.deepcopy(body['metadata'])
+            for key in ('uid', 'creationTimestamp'):
+                metadata[key] = obj['metadata'][key]
+
+            obj.clear()
+            obj.update(copy.deepcopy(body))
+            obj['metadata'] = metadata
+            obj['kind'] = kind
+
+            self._event('MODIFIED', kind, obj)
+
+            return copy.deepcopy(obj)
+
+    def _check_version(self, obj, body):
+        version = body.get('metadata', {}).get('resourceVersion')
+
+        if version is not None and version != obj['metadata'][
+                'resourceVersion']:
+            raise ApiException(409, 'Conflict')
+
+    def scale(self, kind, body):
+        name = body['metadata']['name']
+        replicas = body['spec']['replicas']
+
+        return self.patch(kind, name, {'spec': {'replicas': replicas}})
+
+    def delete(self, kind, name):
+        with self.condition:
+            if name not in self.objects[kind]:
+                raise ApiException(404, 'Not Found')
+
+            obj = self.objects[kind][name]
+
+            self._delete(kind, name)
+
+            # The replica set replaces a pod of a deployment which is
+            # deleted.
+
+            if kind == 'Pod':
+                for reference in obj['metadata'].get('ownerReferences', []):
+                    deployment = self.objects['Deployment'].get(
+                            reference['name'])
+                    if deployment is not None:
+                        self._reconcile_deployment(deployment)
+
+    def _index(self, kind, obj):
+        name = obj['metadata']['name']
+
+        for reference in obj['metadata'].get('ownerReferences', []):
+            self.owned[reference['uid']].add((kind, name))
+
+        if kind == 'Pod':
+            deployment = obj['metadata']['labels'].get('deployment')
+            if deployment:
+                self.deployment_pods[deployment].add(name)
+
+    def _delete(self, kind, name):
+        obj = self.objects[kind].pop(name)
+        self._event('DELETED', kind, obj)
+
+        if kind == 'Pod':
+            deployment = obj['metadata']['labels'].get('deployment')
+            self.deployment_pods.get(deployment, set()).discard(name)
+
+        # Garbage collect anything owned by the deleted object.
+
+        for other_kind, other_name in self.owned.pop(
+                obj['metadata']['uid'], ()):
+            if other_name in self.objects[other_kind]:
+                self._delete(other_kind, other_name)
+
+    def _reconcile_deployment(self, deployment):
+        # Stands in for the deployment and replica set controllers and
+        # the kubelet. Pods are created already running and ready. As in
+        # the versions of Kubernetes which serve extensions/v1beta1
+        # deployments, any pod deletion cost is ignored, and the newest
+        # pods are removed first.
+
+        name = deployment['metadata']['name']
+        replicas = deployment['spec'].get('replicas', 1)
+        template = deployment['spec']['template']
+
+        pods = [self.objects['Pod'][pod_name] for pod_name in
+                self.deployment_pods.get(name, ())]
+
+        while len(pods) < replicas:
+            pod = {
+                'metadata': {
+                    'name': '%s-%s' % (name, uuid.uuid4().hex[:5]),
+                    'labels': copy.deepcopy(template['metadata']['labels']),
+                    'annotations': {},
+                    'ownerReferences': [{
+                        'kind': 'Deployment',
+                        'name': name,
+                        'uid': deployment['metadata']['uid']
+                    }]
+                },
+                'spec': copy.deepcopy(template['spec']),
+                'status': {
+                    'phase': 'Running',
+                    'podIP': '10.%d.%d.%d' % tuple(uuid.uuid4().bytes[:3]),
+                    'conditions': [{'type': 'Ready', 'status': 'True'}]
+                }
+            }
+
+            self.pod_sequence += 1
+            pod['metadata']['annotations']['fake/sequence'] = str(
+                    self.pod_sequence)
+
+            pods.append(self._create('Pod', pod))
+
+        pods.sort(key=lambda pod: -int(pod['metadata']['annotations'].get(
+                'fake/sequence', 0)))
+
+        while len(pods) > replicas:
+            self._delete('Pod', pods.pop(0)['metadata']['name'])
+
+        status = {
+            'replicas': replicas,
+            'availableReplicas': replicas,
+            'readyReplicas': replicas
+        }
+
+        if deployment.get('status') != status:
+            deployment['status'] = status
+            self._event('MODIFIED', 'Deployment', deployment)
+
+    def watch(self, kind, resource_version, timeout, bookmarks=False):
+        deadline = time.time() + (timeout or 3600)
+
+        position = int(resource_version or 0)
+
+        while True:
+            with self.condition:
+                first = self.events[0][0] if self.events else self.version + 1
+
+                if position < first - 1:
+                    yield {'type': 'ERROR', 'object': {'code': 410,
+                            'message': 'too old resource version'}}
+                    return
+
+                pending = self.events[position - first + 1:]
+
+                if not pending:
+                    remaining = deadline - time.time()
+
+                    if remaining <= 0:
+                        break
+
+                    self.condition.wait(remaining)
+
+                    continue
+
+            for version, event_kind, event_type, obj in pending:
+                position = version
+
+                if event_kind == kind:
+                    yield {'type': event_type, 'object': obj,
+                            'raw_object': obj}
+
+        # A bookmark is sent as the watch is closed, with the version the
+        # watch has reached, whatever the kind of the events.
+
+        if bookmarks:
+            yield {'type': 'BOOKMARK', 'object': {'kind': kind,
+                    'metadata': {'resourceVersion': str(position)}}}
+
+class FakeResource(object):
+
+    def __init__(self, server, kind, subresource=None):
+        self.server = server
+        self.kind = kind
+        self.subresource = subresource
+
+        if subresource is None:
+            self.scale = FakeResource(server, kind, 'scale')
+
+    def get(self, name=None, namespace=None, serialize=True, watch=False,
+            resource_version=None, timeout_seconds=None, query_params=(),
+            **kwargs):
+
+        if watch:
+            self.server.count('watch', self.kind)
+            return self.server.watch(self.kind, resource_version,
+                    timeout_seconds,
+                    ('allowWatchBookmarks', 'true') in query_params)
+
+        if name is None:
+            self.server.count('list', self.kind)
+            return ResourceInstance(self, self.server.list(self.kind))
+
+        self.server.count('get', self.kind)
+        return ResourceInstance(self, self.server.get(self.kind, name))
+
+    def create(self, namespace=None, body=None, **kwargs):
+        self.server.count('create', self.kind)
+        return ResourceInstance(self, self.server.create(self.kind, body))
+
+    def patch(self, namespace=None, name=None, body=None, **kwargs):
+        self.server.count('patch', self.kind)
+        return ResourceInstance(self, self.server.patch(self.kind, name, body))
+
+    def replace(self, namespace=None, body=None, **kwargs):
+        if self.subresource == 'scale':
+            self.server.count('scale', self.kind)
+            return ResourceInstance(self, self.server.scale(self.kind, body))
+
+        self.server.count('replace', self.kind)
+        return ResourceInstance(self, self.server.replace(self.kind, body))
+
+    def delete(self, namespace=None, name=None, body=None, **kwargs):
+        self.server.count('delete', self.kind)
+        self.server.delete(self.kind, name)
+
+class Watch(object):
+
+    def stream(self, func, *args, **kwargs):
+        kwargs['watch'] = True
+        for event in func(*args, **kwargs):
+            yield event
+
+    def stop(self):
+        pass
+
+class HubAuth(object):
+
+    """Accepts any token of the form 'token <name>', treating names
+    starting with 'admin' as admin users. Lookups are counted.
+
+    """
+
+    cookie_name = 'jupyterhub-services'
+    auth_header_name = 'Authorization'
+    login_url = '/hub/login'
+    hub_prefix = '/hub/'
+
+    lookups = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    def user_for_token(self, token):
+        HubAuth.lookups += 1
+
+        name = token.split()[-1]
+
+        return {'name': name, 'admin': name.startswith('admin')}
+
+    def user_for_cookie(self, cookie):
+        return self.user_for_token(cookie)
+
+def module(name, **attributes):
+    value = types.ModuleType(name)
+    value.__dict__.update(attributes)
+    sys.modules[name] = value
+    return value
+
+def discovery(server, path):
+    """Returns the discovery document for a group version. Every kind is
+    served from every group version, as the controller only looks up kinds
+    in the group version they belong to.
+
+    """
+
+    resources = []
+
+    for kind in sorted(server.objects):
+        name = '%ss' % kind.lower()
+
+        resources.append(dict(name=name, kind=kind, namespaced=True,
+                verbs=['create', 'delete', 'get', 'list', 'patch',
+                'update', 'watch']))
+
+        if kind == 'Deployment':
+            resources.append(dict(name='%s/scale' % name, kind='Scale',
+                    namespaced=True, verbs=['get', 'patch', 'update']))
+
+    return dict(kind='APIResourceList', groupVersion=path.split('/', 2)[2],
+            resources=resources)
+
+class Configuration(object):
+
+    def __init__(self):
+        self.connection_pool_maxsize = None
+
+class ApiClient(object):
+
+    def __init__(self, configuration=None):
+        self.configuration = configuration
+
+def install(server):
+    class DynamicClient(object):
+        def __init__(self, client):
+            self.client = client
+
+        def request(self, method, path, body=None, **params):
+            server.count('discovery', path)
+            document = json.dumps(discovery(server, path))
+            return types.SimpleNamespace(data=document.encode('utf-8'))
+
+    def Resource(**kwargs):
+        return FakeResource(server, kwargs['kind'])
+
+    module('kubernetes')
+    module('kubernetes.client', Configuration=Configuration)
+    module('kubernetes.client.rest', ApiException=ApiException)
+
+    module('openshift')
+    module('openshift.config', load_incluster_config=lambda: None)
+    module('openshift.client')
+    module('openshift.client.api_client', ApiClient=ApiClient)
+    module('openshift.dynamic', DynamicClient=DynamicClient,
+            ResourceInstance=ResourceInstance, Resource=Resource)
+    module('openshift.watch', Watch=Watch)
+
+    module('jupyterhub')
+    module('jupyterhub.services')
+    module('jupyterhub.services.auth', HubAuth=HubAuth)
@@ -21,19 +21,24 @@ with open('/var/run/secrets/kubernetes.io/serviceaccount/namespace') as fp:
 config.load_incluster_config()
 oapi = client.OapiApi()
 
-routes = oapi.list_namespaced_route(namespace)
+# Only the routes needed are read, rather than listing every route in
+# the project, which is slow to start up with when there are many.
 
-def extract_hostname(routes, name):
-    for route in routes.items:
-        if route.metadata.name == name:
-            return route.spec.host
+from kubernetes.client.rest import ApiException
+
+def extract_hostname(name):
+    try:
+        return oapi.read_namespaced_route(name, namespace).spec.host
+    except ApiException as e:
+        if e.status != 404:
+            raise
 
 jupyterhub_name = os.environ.get('JUPYTERHUB_SERVICE_NAME')
-jupyterhub_hostname = extract_hostname(routes, jupyterhub_name)
+jupyterhub_hostname = extract_hostname(jupyterhub_name)
 print('jupyterhub_hostname', jupyterhub_hostname)
 
 keycloak_name = os.environ.get('KEYCLOAK_SERVICE_NAME')
-keycloak_hostname = extract_hostname(routes, keycloak_name)
+keycloak_hostname = extract_hostname(keycloak_name)
 print('keycloak_hostname', keycloak_hostname)
 
 keycloak_realm = os.environ.get('KEYCLOAK_REALM')
@@ -125,6 +130,69 @@ worker_replicas = os.environ.get('DASK_WORKER_REPLICAS', '2')
 max_worker_replicas = os.environ.get('DASK_MAX_WORKER_REPLICAS', '3')
 worker_memory = os.environ.get('DASK_WORKER_MEMORY', '512Mi')
 idle_cluster_timeout = os.environ.get('DASK_IDLE_CLUSTER_TIMEOUT', '600')
+warm_pool_size = os.environ.get('DASK_WARM_POOL_SIZE', '0')
+idle_delete_timeout = os.environ.get('DASK_IDLE_DELETE_TIMEOUT', '86400')
+idle_worker_timeout = os.environ.get('DASK_IDLE_WORKER_TIMEOUT', '1800')
+
+# Every open control panel holds a long polling request against the
+# controller, so it needs more request threads than the mod_wsgi default.
+# Only half of the threads are used for waiting requests, beyond which
+# control panels fall back to polling every few seconds.
+
+controller_threads = os.environ.get('DASK_CONTROLLER_THREADS', '50')
+
+# The controller can instead be run as several replicas outside of the hub,
+# behind a service of their own, in which case the hub is only given the
+# URL of that service. The replicas must then use the controller API token
+# as their JupyterHub API token.
+
+dask_controller_service_url = os.environ.get('DASK_CONTROLLER_URL', '')
+
+# Sizing profiles for the Dask clusters, as JSON mapping the name of each
+# profile to its settings, which are passed on to the controller. A profile
+# listing users or groups is only available to those users and is their
+# default. Otherwise a profile can be chosen at spawn time by giving a
+# 'dask_profile' user option, or through a 'dask_profile' key on entries
+# of the KubeSpawner profile list.
+
+import json
+
+dask_cluster_profiles = os.environ.get('DASK_CLUSTER_PROFILES', '')
+
+dask_profiles = json.loads(dask_cluster_profiles or '{}')
+
+def dask_profile_allowed(name, user):
+    users = dask_profiles[name].get('users') or []
+    groups = dask_profiles[name].get('groups') or []
+
+    if not users and not groups:
+        return True
+
+    return user.name in users or any(group.name in groups
+            for group in user.groups)
+
+def select_dask_profile(spawner):
+    options = spawner.user_options or {}
+
+    name = options.get('dask_profile')
+
+    if not name and options.get('profile') is not None:
+        profile_list = getattr(spawner, 'profile_list', None)
+
+        if isinstance(profile_list, list):
+            for index, entry in enumerate(profile_list):
+                if options['profile'] in (entry.get('slug'), str(index)):
+                    name = entry.get('dask_profile')
+
+    if name in dask_profiles and dask_profile_allowed(name, spawner.user):
+        return name
+
+    for name, profile in sorted(dask_profiles.items()):
+        if profile.get('users') or profile.get('groups'):
+            if dask_profile_allowed(name, spawner.user):
+                return name
+
+    return ''
 
 def modify_pod_hook(spawner, pod):
     if dask_cluster_name and dask_api_token:
@@ -134,14 +202,66 @@ def modify_pod_hook(spawner, pod):
         pod.spec.containers[0].env.append(dict(name='DASK_SCHEDULER_ADDRESS',
             value=scheduler_address))
 
+        dask_profile = getattr(spawner, 'dask_profile', '')
+
+        if dask_profile:
+            pod.metadata.annotations = dict(pod.metadata.annotations or {})
+            pod.metadata.annotations['jupyteronopenshift.org/dask-profile'] = \
+                    dask_profile
+
     return pod
 
 c.KubeSpawner.modify_pod_hook = modify_pod_hook
 
+# Ask the Dask controller to start provisioning the user's cluster as soon
+# as the spawn starts, rather than waiting for it to see the notebook pod.
+# The request is not waited on, so a slow or failed request doesn't delay
+# the spawn, with the controller's pod watch acting as a fallback.
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from urllib.parse import quote
+
+dask_controller_url = '%s/services/dask-controller' % (
+        dask_controller_service_url or 'http://localhost:11111')
+
+def pre_spawn_hook(spawner):
+    if dask_cluster_name and dask_api_token:
+        spawner.dask_profile = select_dask_profile(spawner)
+
+        request = HTTPRequest('%s/provision?user=%s&profile=%s' % (
+                dask_controller_url, quote(spawner.user.name),
+                quote(spawner.dask_profile)), method='POST', body='',
+                headers={'Authorization': 'token %s' % dask_api_token},
+                request_timeout=10.0)
+
+        def provisioned(future):
+            if future.exception():
+                print('ERROR: Cannot request Dask cluster for %s. %s' % (
+                        spawner.user.name, future.exception()))
+
+        AsyncHTTPClient().fetch(request).add_done_callback(provisioned)
+
+c.Spawner.pre_spawn_hook = pre_spawn_hook
+
 if dask_cluster_name and dask_api_token:
     c.KubeSpawner.singleuser_extra_annotations.update(
             {'jupyteronopenshift.org/dask-cluster': '{username}'})
 
+    # The label lets the Dask scheduler be placed near the notebook.
+
+    c.KubeSpawner.singleuser_extra_labels.update(
+            {'jupyteronopenshift.org/dask-cluster': '{username}'})
+
+if dask_cluster_name and dask_api_token and dask_controller_service_url:
+    c.JupyterHub.services.extend([
+        {
+            'name': 'dask-controller',
+            'url': dask_controller_service_url,
+            'api_token': dask_api_token,
+        }
+    ])
+
+elif dask_cluster_name and dask_api_token:
     c.JupyterHub.services.extend([
         {
             'name': 'dask-controller',
@@ -155,6 +275,12 @@ if dask_cluster_name and dask_api_token:
                 DASK_WORKER_REPLICAS=worker_replicas,
                 DASK_MAX_WORKER_REPLICAS=max_worker_replicas,
                 DASK_IDLE_CLUSTER_TIMEOUT=idle_cluster_timeout,
+                DASK_WARM_POOL_SIZE=warm_pool_size,
+                DASK_IDLE_DELETE_TIMEOUT=idle_delete_timeout,
+                DASK_IDLE_WORKER_TIMEOUT=idle_worker_timeout,
+                DASK_CONTROLLER_API_TOKEN=dask_api_token,
+                DASK_CLUSTER_PROFILES=dask_cluster_profiles,
+                MOD_WSGI_THREADS=controller_threads,
                 KUBERNETES_SERVICE_HOST=os.environ['KUBERNETES_SERVICE_HOST'],
                 KUBERNETES_SERVICE_PORT=os.environ['KUBERNETES_SERVICE_PORT']
                 ),
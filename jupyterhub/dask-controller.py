@@ -3,549 +3,5082 @@ import time
 import json
 import threading
 import string
+import collections
+import heapq
+import hmac
+import uuid
+import concurrent.futures
+import urllib.request
+import urllib.parse
+import urllib.error
+import math
+import hashlib
+import functools
+import socket
+import bisect
+import random
+import atexit
 
 from urllib.parse import quote
 
-from flask import Flask, redirect, request, Response, abort
+from flask import Flask, redirect, request, Response, abort, g
 from flask import Blueprint, jsonify
 
+from werkzeug.exceptions import HTTPException
+
 from wrapt import decorator
 
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
 from jupyterhub.services.auth import HubAuth
 
+from kubernetes.client import Configuration
 from kubernetes.client.rest import ApiException
 
 from openshift.config import load_incluster_config
 from openshift.client.api_client import ApiClient
-from openshift.dynamic import DynamicClient, ResourceInstance
+from openshift.dynamic import DynamicClient, ResourceInstance, Resource
 from openshift.watch import Watch
 
-with open('/var/run/secrets/kubernetes.io/serviceaccount/namespace') as fp:
+# Time taken by each step of starting up, in seconds from when the module
+# started to be loaded, or for API discovery, the time the lookup took.
+
+startup_started = time.time()
+
+startup_timings = collections.OrderedDict()
+
+startup_lock = threading.Lock()
+
+def record_startup(step, seconds=None):
+    with startup_lock:
+        if step in startup_timings:
+            return
+
+        if seconds is None:
+            seconds = time.time() - startup_started
+
+        startup_timings[step] = round(seconds, 3)
+
+    print('INFO: Startup step %s took %.3f seconds.' % (step, seconds))
+
+namespace_file = os.environ.get('DASK_NAMESPACE_FILE',
+        '/var/run/secrets/kubernetes.io/serviceaccount/namespace')
+
+with open(namespace_file) as fp:
     namespace = fp.read().strip()
 
 load_incluster_config()
 
-dyn_client = DynamicClient(ApiClient())
+record_startup('config')
 
-deployment_resource = dyn_client.resources.get(
-        api_version='extensions/v1beta1', kind='Deployment')
+# API discovery. The dynamic client would discover every API group of the
+# cluster when created, with a request for each group version, which can
+# take seconds on a busy API server. Instead only the group versions of
+# the resources used are discovered, when each is first used, and the
+# discovery documents are kept in a file for the cache TTL, so that a
+# restarted controller usually needs no discovery requests at all.
 
-service_resource = dyn_client.resources.get(
-        api_version='v1', kind='Service')
+discovery_cache_file = os.environ.get('DASK_DISCOVERY_CACHE_FILE',
+        '/tmp/dask-controller-discovery.json')
 
-pod_resource = dyn_client.resources.get(api_version='v1', kind='Pod')
+discovery_cache_ttl = float(os.environ.get('DASK_DISCOVERY_CACHE_TTL',
+        '3600'))
 
-auth = HubAuth(api_token=os.environ['JUPYTERHUB_API_TOKEN'],
-        cookie_cache_max_age=60)
+class LazyDynamicClient(DynamicClient):
 
-jupyterhub_service_name = os.environ.get('JUPYTERHUB_SERVICE_NAME', '')
-prefix = os.environ.get('JUPYTERHUB_SERVICE_PREFIX', '')
+    """Dynamic client which doesn't discover the API groups when created.
+    Resources for it are looked up through LazyResources.
 
-jupyterhub_name = os.environ.get('JUPYTERHUB_NAME', '')
+    """
 
-application = Flask(__name__)
+    def __init__(self, client):
+        self.client = client
+        self.configuration = getattr(client, 'configuration', None)
 
-controller = Blueprint('controller', __name__, template_folder='templates')
+class LazyResources(object):
 
-@decorator
-def authenticated_user(wrapped, instance, args, kwargs):
-    cookie = request.cookies.get(auth.cookie_name)
-    token = request.headers.get(auth.auth_header_name)
+    """Looks up the API resources of the dynamic client on first use,
+    using discovery documents cached in a file, which are fetched again if
+    missing, older than the TTL, or not holding the resource wanted.
 
-    if cookie:
-        user = auth.user_for_cookie(cookie)
-    elif token:
-        user = auth.user_for_token(token)
-    else:
-        user = None
+    """
 
-    if user:
-        return wrapped(user, *args, **kwargs)
-    else:
-        # Request to login url on failed authentication.
-        return redirect(auth.login_url + '?next=%s' % quote(request.path))
+    def __init__(self, client, cache_file, cache_ttl):
+        self.client = client
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
 
-@decorator
-def admin_users_only(wrapped, instance, args, kwargs):
-    user = (lambda user: user)(*args, **kwargs)
-    if not user.get('admin', False):
-        abort(403)
-    return wrapped(*args, **kwargs)
+        self.lock = threading.Lock()
 
-dask_cluster_name = os.environ.get('DASK_CLUSTER_NAME')
-dask_scheduler_name = '%s-scheduler' % dask_cluster_name
+        self.documents = {}
+        self.resolved = {}
 
-def get_pods(name):
-    dask_worker_name = '%s-worker-%s' % (dask_cluster_name, name)
+        self.hits = 0
+        self.misses = 0
 
-    pods = pod_resource.get(namespace=namespace)
+        try:
+            with open(cache_file) as fp:
+                self.documents = json.load(fp)
 
-    details = []
+        except (IOError, ValueError):
+            pass
 
-    for pod in pods.items:
-        if pod.metadata.labels['deployment'] == dask_worker_name:
-            details.append((pod.metadata.name, pod.status.phase))
+    def get(self, api_version, kind):
+        return LazyResource(self, api_version, kind)
 
-    return details
+    def document(self, path, refresh=False):
+        entry = self.documents.get(path)
 
-@controller.route('/pods', methods=['GET', 'OPTIONS', 'POST'])
-@authenticated_user
-def pods(user):
-    return jsonify(get_pods(user['name']))
+        if (not refresh and entry is not None and
+                time.time() - entry['time'] < self.cache_ttl):
+            self.hits += 1
+            return entry['document']
 
-max_worker_replicas = int(os.environ.get('DASK_MAX_WORKER_REPLICAS', '0'))
+        self.misses += 1
 
-scale_template = string.Template("""
-{
-    "kind": "Scale",
-    "apiVersion": "extensions/v1beta1",
-    "metadata": {
-        "namespace": "${namespace}",
-        "name": "${name}"
-    },
-    "spec": {
-        "replicas": ${replicas}
-    }
-}
-""")
+        response = self.client.request('GET', path)
 
-@controller.route('/scale', methods=['GET', 'OPTIONS', 'POST'])
-@authenticated_user
-def scale(user):
-    replicas = request.args.get('replicas', None)
+        document = json.loads(response.data.decode('utf-8'))
 
-    if replicas is None:
-        return jsonify()
+        self.documents[path] = dict(time=time.time(), document=document)
 
-    replicas = int(replicas)
+        # The file is replaced rather than written in place, so that other
+        # replicas sharing it never read a partial file.
 
-    if max_worker_replicas > 0:
-        replicas = min(replicas, max_worker_replicas)
+        try:
+            temporary = '%s.%s' % (self.cache_file, uuid.uuid4().hex[:8])
 
-    name = '%s-worker-%s' % (dask_cluster_name, user['name'])
+            with open(temporary, 'w') as fp:
+                json.dump(self.documents, fp)
 
-    body = json.loads(scale_template.safe_substitute(namespace=namespace,
-            name=name, replicas=replicas))
+            os.rename(temporary, self.cache_file)
 
-    deployment_resource.scale.replace(namespace=namespace, body=body)
+        except (IOError, OSError) as e:
+            print('ERROR: Could not save API discovery cache. %s' % e)
 
-    return jsonify()
+        return document
 
-restart_template = string.Template("""
-{
-    "spec": {
-        "template": {
-            "metadata": {
-                "annotations": {
-                    "dask-controller/restart": "${time}"
-                }
-            }
-        }
-    }
-}
-""")
+    def resource(self, group_version, kind, document):
+        group, _, version = group_version.rpartition('/')
 
-@controller.route('/restart', methods=['GET', 'OPTIONS', 'POST'])
-@authenticated_user
-def restart(user):
-    name = '%s-worker-%s' % (dask_cluster_name, user['name'])
+        subresources = {}
 
-    body = json.loads(restart_template.safe_substitute(time=time.time()))
+        for item in document['resources']:
+            if '/' in item['name']:
+                parent, name = item['name'].split('/', 1)
+                subresources.setdefault(parent, {})[name] = item
 
-    deployment_resource.patch(namespace=namespace, name=name, body=body)
+        for item in document['resources']:
+            if '/' in item['name'] or item['kind'] != kind:
+                continue
 
-    return jsonify()
+            item = dict(item)
 
-application.register_blueprint(controller, url_prefix=prefix.rstrip('/'))
+            for key in ('prefix', 'group', 'api_version', 'client',
+                    'preferred'):
+                item.pop(key, None)
 
-worker_replicas = int(os.environ.get('DASK_WORKER_REPLICAS', 3))
-worker_memory = os.environ.get('DASK_WORKER_MEMORY', '512Mi')
-idle_timeout = int(os.environ.get('DASK_IDLE_CLUSTER_TIMEOUT', 600))
+            return Resource(prefix=group and 'apis' or 'api', group=group,
+                    api_version=version, client=self.client, preferred=True,
+                    subresources=subresources.get(item['name']), **item)
 
-worker_deployment_template = string.Template("""
-{
-    "apiVersion": "extensions/v1beta1",
-    "kind": "Deployment",
-    "metadata": {
-        "labels": {
-            "app": "${application}",
-            "component": "dask-worker",
-            "dask-cluster": "${cluster}"
-        },
-        "name": "${name}",
-        "namespace": "${namespace}",
-        "ownerReferences": [
-            {
-                "apiVersion": "v1",
-                "controller": true,
-                "blockOwnerDeletion": false,
-                "kind": "Service",
-                "name": "${owner}",
-                "uid": "${owner_uid}"
-            }
-        ]
-    },
-    "spec": {
-        "replicas": ${replicas},
-        "selector": {
-            "matchLabels": {
-                "app": "${application}",
-                "deployment": "${name}"
-            }
-        },
-        "strategy": {
-            "type": "Recreate"
-        },
-        "template": {
-            "metadata": {
-                "annotations": {
-                    "alpha.image.policy.openshift.io/resolve-names": "*"
-                },
-                "labels": {
-                    "app": "${application}",
-                    "deployment": "${name}"
-                }
-            },
-            "spec": {
-                "containers": [
-                    {
-                        "name": "worker",
-                        "image": "${application}-notebook-img:latest",
-                        "command": [
-                            "start-daskworker.sh"
-                        ],
-                        "env": [
-                            {
-                                "name": "DASK_SCHEDULER_ADDRESS",
-                                "value": "${scheduler}:8786"
-                            }
-                        ],
-                        "ports": [
-                            {
-                                "containerPort": 8786,
-                                "protocol": "TCP"
-                            },
-                            {
-                                "containerPort": 8787,
-                                "protocol": "TCP"
-                            }
-                        ],
-                        "resources": {
-                            "limits": {
-                                "memory": "${memory}"
-                            }
-                        }
-                    }
-                ]
-            }
-        }
-    }
-}
-""")
+    def resolve(self, group_version, kind):
+        with self.lock:
+            key = (group_version, kind)
 
-scheduler_deployment_template = string.Template("""
-{
-    "apiVersion": "extensions/v1beta1",
-    "kind": "Deployment",
-    "metadata": {
-        "labels": {
-            "app": "${application}",
-            "component": "dask-scheduler",
-            "dask-cluster": "${cluster}"
-        },
-        "name": "${name}",
-        "namespace": "${namespace}",
-        "ownerReferences": [
-            {
-                "apiVersion": "v1",
-                "controller": true,
-                "blockOwnerDeletion": false,
-                "kind": "Service",
-                "name": "${owner}",
-                "uid": "${owner_uid}"
-            }
-        ]
-    },
-    "spec": {
-        "replicas": 1,
-        "selector": {
-            "matchLabels": {
-                "app": "${application}",
-                "deployment": "${name}"
-            }
-        },
-        "strategy": {
-            "type": "Recreate"
-        },
-        "template": {
-            "metadata": {
-                "annotations": {
-                    "alpha.image.policy.openshift.io/resolve-names": "*"
-                },
-                "labels": {
-                    "app": "${application}",
-                    "deployment": "${name}"
-                }
-            },
-            "spec": {
-                "containers": [
-                    {
-                        "name": "scheduler",
-                        "image": "${application}-notebook-img:latest",
-                        "command": [
-                            "start-daskscheduler.sh"
-                        ],
-                        "ports": [
-                            {
-                                "containerPort": 8786,
-                                "protocol": "TCP"
-                            },
-                            {
-                                "containerPort": 8787,
-                                "protocol": "TCP"
-                            }
-                        ],
-                        "resources": {
-                            "limits": {
-                                "memory": "256Mi"
-                            }
-                        }
-                    }
-                ]
-            }
-        }
-    }
-}
-""")
+            if key not in self.resolved:
+                started = time.time()
 
-scheduler_service_template = string.Template("""
-{
-    "kind": "Service",
-    "apiVersion": "v1",
-    "metadata": {
-        "namespace": "${namespace}",
-        "name": "${name}",
-        "labels": {
-            "app": "${application}"
-        }
-    },
-    "spec": {
-        "ports": [
-            {
-                "name": "8786-tcp",
-                "protocol": "TCP",
-                "port": 8786,
-                "targetPort": 8786
-            },
-            {
+                path = '/%s/%s' % ('/' in group_version and 'apis' or 'api',
+                        group_version)
+
+                resource = self.resource(group_version, kind,
+                        self.document(path))
+
+                if resource is None:
+                    resource = self.resource(group_version, kind,
+                            self.document(path, refresh=True))
+
+                if resource is None:
+                    raise LookupError('No %s resource in %s.' % (kind,
+                            group_version))
+
+                self.resolved[key] = resource
+
+                record_startup('discovery:%s' % kind, time.time() - started)
+
+            return self.resolved[key]
+
+    def status(self):
+        with self.lock:
+            return dict(cache_file=self.cache_file, ttl=self.cache_ttl,
+                    hits=self.hits, misses=self.misses,
+                    resolved=sorted('%s/%s' % key for key in self.resolved))
+
+class LazyResource(object):
+
+    """Stands in for an API resource, which is only looked up when it is
+    first used. The kind is known up front so that it can be used in log
+    messages without a lookup.
+
+    """
+
+    def __init__(self, resources, group_version, kind):
+        self.resources = resources
+        self.group_version = group_version
+        self.kind = kind
+
+    def __getattr__(self, attr):
+        resource = self.resources.resolve(self.group_version, self.kind)
+
+        return getattr(resource, attr)
+
+# Connections to the API server. Connections are kept open for reuse in
+# a pool, which should be at least as large as the number of API requests
+# made at the same time, else connections are opened and closed for each
+# request. Every request has a connect and read timeout, so that a stalled
+# API server can't hold up the thread making the request indefinitely.
+# Watches are given a read timeout longer than the API server keeps them
+# open for.
+
+api_pool_size = int(os.environ.get('DASK_API_POOL_SIZE', '25'))
+
+api_connect_timeout = float(os.environ.get('DASK_API_CONNECT_TIMEOUT', '5'))
+api_read_timeout = float(os.environ.get('DASK_API_READ_TIMEOUT', '30'))
+
+class TimeoutApiClient(ApiClient):
+
+    def call_api(self, *args, **kwargs):
+        if kwargs.get('_request_timeout') is None:
+            query_params = kwargs.get('query_params',
+                    args[3] if len(args) > 3 else None) or []
+
+            if ('watch', True) in query_params:
+                kwargs['_request_timeout'] = (api_connect_timeout,
+                        watch_timeout + api_read_timeout)
+            else:
+                kwargs['_request_timeout'] = (api_connect_timeout,
+                        api_read_timeout)
+
+        return super(TimeoutApiClient, self).call_api(*args, **kwargs)
+
+api_configuration = Configuration()
+api_configuration.connection_pool_maxsize = api_pool_size
+
+api_resources = LazyResources(
+        LazyDynamicClient(TimeoutApiClient(api_configuration)),
+        discovery_cache_file, discovery_cache_ttl)
+
+api_request_seconds = Histogram('dask_controller_api_request_seconds',
+        'Latency of Kubernetes API requests.', ['verb', 'resource'])
+
+api_request_errors = Counter('dask_controller_api_request_errors_total',
+        'Failed Kubernetes API requests.', ['verb', 'resource', 'status'])
+
+api_request_retries = Counter('dask_controller_api_request_retries_total',
+        'Kubernetes API requests retried.', ['verb', 'resource'])
+
+api_requests_shed = Counter('dask_controller_api_requests_shed_total',
+        'Kubernetes API requests refused while the circuit breaker is open.',
+        ['verb', 'resource'])
+
+api_throttled_seconds = Counter('dask_controller_api_throttled_seconds_total',
+        'Time Kubernetes API requests waited for the rate limit.')
+
+api_circuit_open = Gauge('dask_controller_api_circuit_open',
+        'Whether the Kubernetes API circuit breaker is open.')
+
+# Protection of the API server, and of the controller, when the API server
+# is struggling. Requests other than watches are limited to a rate, with
+# bursts allowed, across the whole controller. Requests which fail with an
+# error that may be transient are retried after a jittered exponential
+# backoff, if repeating them is safe. When requests keep failing or being
+# slow, a circuit breaker opens and requests fail straight away, rather
+# than adding to the load on the API server, until a trial request after
+# a pause succeeds.
+
+api_qps = float(os.environ.get('DASK_API_QPS', '100'))
+api_burst = int(os.environ.get('DASK_API_BURST', '200'))
+
+api_retries = int(os.environ.get('DASK_API_RETRIES', '3'))
+api_retry_delay = float(os.environ.get('DASK_API_RETRY_DELAY', '0.2'))
+api_retry_max_delay = float(os.environ.get('DASK_API_RETRY_MAX_DELAY', '5'))
+
+api_breaker_failures = int(os.environ.get('DASK_API_BREAKER_FAILURES', '5'))
+api_breaker_reset = float(os.environ.get('DASK_API_BREAKER_RESET', '30'))
+api_slow_request = float(os.environ.get('DASK_API_SLOW_REQUEST', '5'))
+
+# Errors for which the API server didn't act on the request, so it can be
+# repeated whatever the verb, and errors which could be transient but for
+# which the request may have been acted on.
+
+api_throttled_statuses = (429,)
+api_transient_statuses = (0, 429, 500, 502, 503, 504)
+
+class RateLimiter(object):
+
+    """Token bucket rate limiter. A caller which finds the bucket empty
+    reserves the next token to be added and sleeps until then, so callers
+    are let through in the order they arrived.
+
+    """
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = burst
+
+        self.lock = threading.Lock()
+
+        self.tokens = float(burst)
+        self.refilled = time.time()
+
+    def wait(self):
+        if self.qps <= 0:
+            return 0.0
+
+        with self.lock:
+            now = time.time()
+
+            self.tokens = min(float(self.burst),
+                    self.tokens + (now - self.refilled) * self.qps)
+            self.refilled = now
+
+            self.tokens -= 1.0
+
+            delay = max(0.0, -self.tokens / self.qps)
+
+        if delay:
+            api_throttled_seconds.inc(delay)
+            time.sleep(delay)
+
+        return delay
+
+class CircuitBreaker(object):
+
+    """Counts consecutive failed or slow requests, and once there have been
+    too many, opens so that requests are refused for a time. After that,
+    a single trial request is let through, which closes the breaker if it
+    succeeds and opens it again if not.
+
+    """
+
+    def __init__(self, failures, reset):
+        self.failures = failures
+        self.reset = reset
+
+        self.lock = threading.Lock()
+
+        self.state = 'closed'
+        self.consecutive = 0
+        self.opened = None
+        self.trips = 0
+
+    def allow(self):
+        if self.failures <= 0:
+            return True
+
+        with self.lock:
+            if self.state == 'closed':
+                return True
+
+            if self.state == 'open':
+                if time.time() - self.opened >= self.reset:
+                    self.state = 'half-open'
+                    return True
+
+            return False
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                self.consecutive = 0
+
+                if self.state != 'closed':
+                    print('INFO: Kubernetes API circuit breaker closed.')
+
+                    self.state = 'closed'
+                    api_circuit_open.set(0)
+
+                return
+
+            self.consecutive += 1
+
+            if (self.state == 'half-open' or (self.state == 'closed' and
+                    self.consecutive >= self.failures)):
+                print('ERROR: Kubernetes API circuit breaker opened after '
+                        '%d failed or slow requests.' % self.consecutive)
+
+                self.state = 'open'
+                self.opened = time.time()
+                self.trips += 1
+
+                api_circuit_open.set(1)
+
+    def status(self):
+        with self.lock:
+            return dict(state=self.state, consecutive=self.consecutive,
+                    opened=self.opened, trips=self.trips)
+
+api_limiter = RateLimiter(api_qps, api_burst)
+
+api_breaker = CircuitBreaker(api_breaker_failures, api_breaker_reset)
+
+def retry_delay(attempt, error):
+    delay = random.uniform(0, min(api_retry_max_delay,
+            api_retry_delay * 2 ** attempt))
+
+    # Honour how long the API server asks for us to wait when throttling.
+
+    headers = getattr(error, 'headers', None) or {}
+
+    try:
+        delay = max(delay, min(api_retry_max_delay,
+                float(headers.get('Retry-After', 0))))
+
+    except (TypeError, ValueError):
+        pass
+
+    return delay
+
+class InstrumentedResource(object):
+
+    """Wraps a dynamic client resource so that the latency of each request
+    made through it is recorded against the verb and the resource. A get
+    is recorded as a list or watch when it is one. Requests other than
+    watches are rate limited, retried and subject to the circuit breaker.
+
+    A create is only retried when the API server throttled it, unless the
+    resource is marked as having its objects named by the controller, and
+    an object already existing treated as success by the callers, in which
+    case a create which went through before failing is harmless to repeat.
+    Requests for a resource marked as critical are retried but never held
+    back by the rate limit or refused by the circuit breaker.
+
+    """
+
+    verbs = ('get', 'create', 'patch', 'replace', 'delete')
+
+    subresources = ('scale',)
+
+    idempotent = ('get', 'list', 'patch', 'replace', 'delete')
+
+    def __init__(self, resource, name, idempotent_create=False,
+            critical=False):
+        self.resource = resource
+        self.name = name
+        self.idempotent_create = idempotent_create
+        self.critical = critical
+
+    def __getattr__(self, attr):
+        value = getattr(self.resource, attr)
+
+        if attr in self.verbs:
+            return functools.partial(self.request, attr, value)
+
+        if attr in self.subresources:
+            return InstrumentedResource(value, '%s/%s' % (self.name, attr),
+                    self.idempotent_create, self.critical)
+
+        return value
+
+    def retryable(self, verb, error):
+        status = getattr(error, 'status', None)
+
+        if verb in self.idempotent or self.idempotent_create:
+            if not isinstance(error, ApiException):
+                return True
+
+            return status in api_transient_statuses
+
+        return status in api_throttled_statuses
+
+    def request(self, verb, function, *args, **kwargs):
+        if verb == 'get':
+            if kwargs.get('watch'):
+                verb = 'watch'
+            elif not kwargs.get('name'):
+                verb = 'list'
+
+        if verb == 'watch':
+            return self.call(verb, function, *args, **kwargs)
+
+        attempt = 0
+
+        while True:
+            if not self.critical:
+                if not api_breaker.allow():
+                    api_requests_shed.labels(verb, self.name).inc()
+
+                    raise ApiException(status=503, reason='Kubernetes API '
+                            'circuit breaker is open, request not made.')
+
+                api_limiter.wait()
+
+            started = time.time()
+
+            try:
+                result = self.call(verb, function, *args, **kwargs)
+
+            except Exception as e:
+                transient = (not isinstance(e, ApiException) or
+                        e.status in api_transient_statuses)
+
+                api_breaker.record(transient)
+
+                if attempt >= api_retries or not self.retryable(verb, e):
+                    raise
+
+                delay = retry_delay(attempt, e)
+
+                print('ERROR: Retrying %s of %s in %.2f seconds. %s' % (verb,
+                        self.name, delay, e))
+
+                api_request_retries.labels(verb, self.name).inc()
+
+                attempt += 1
+
+                time.sleep(delay)
+
+            else:
+                api_breaker.record(time.time() - started > api_slow_request)
+
+                return result
+
+    def call(self, verb, function, *args, **kwargs):
+        started = time.time()
+
+        try:
+            return function(*args, **kwargs)
+
+        except ApiException as e:
+            api_request_errors.labels(verb, self.name, e.status).inc()
+            raise
+
+        except Exception:
+            api_request_errors.labels(verb, self.name, 'none').inc()
+            raise
+
+        finally:
+            api_request_seconds.labels(verb, self.name).observe(
+                    time.time() - started)
+
+# Deployments and config maps are always created with a name derived from
+# the cluster name, and an existing one counts as created. That isn't so
+# for services, as an existing service tells a warm pool claim that the
+# cluster is being created some other way.
+
+deployment_resource = InstrumentedResource(api_resources.get(
+        'extensions/v1beta1', 'Deployment'), 'deployments',
+        idempotent_create=True)
+
+service_resource = InstrumentedResource(api_resources.get(
+        'v1', 'Service'), 'services')
+
+pod_resource = InstrumentedResource(api_resources.get(
+        'v1', 'Pod'), 'pods')
+
+config_map_resource = InstrumentedResource(api_resources.get(
+        'v1', 'ConfigMap'), 'configmaps', idempotent_create=True)
+
+# Independent API calls made when acting on a cluster, such as creating
+# its deployments once the service owning them exists, are made at the
+# same time from a shared pool of threads, so that the time taken is that
+# of the slowest call rather than of all of them one after another.
+
+api_concurrency = int(os.environ.get('DASK_API_CONCURRENCY', '20'))
+
+api_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=api_concurrency)
+
+def run_concurrently(calls):
+    futures = [api_executor.submit(call[0], *call[1:]) for call in calls]
+
+    return [future.result() for future in futures]
+
+# Each watch request is closed by the API server after this many seconds
+# and then resumed from the last resource version seen, so that a silently
+# stalled connection can never stop the cache from being updated. Watches
+# ask for bookmarks, which carry the latest resource version even when no
+# object of the type has changed, so that a watch of a quiet resource
+# isn't resumed from a version which has since been compacted away. The
+# version of the dynamic client used only passes on a fixed set of
+# parameters, so this is given as a query parameter. API servers from
+# before bookmarks were added in Kubernetes 1.15 ignore it.
+
+watch_timeout = int(os.environ.get('DASK_WATCH_TIMEOUT', '300'))
+
+class Informer(object):
+
+    """Keeps an in-memory copy of all objects of one resource type in the
+    namespace, populated by an initial list and then kept up to date from
+    a watch. Secondary indexes map label or annotation values to the names
+    of the objects carrying them, so lookups cost only the number of
+    matching objects and never need an API call.
+
+    """
+
+    def __init__(self, resource, indexers={}):
+        self.resource = resource
+        self.indexers = dict(indexers)
+
+        self.lock = threading.RLock()
+        self.synced = threading.Event()
+
+        self.objects = {}
+        self.indexes = dict((name, {}) for name in self.indexers)
+
+        self.resource_version = None
+
+        self.handlers = []
+
+        self.restarts = 0
+        self.relists = 0
+        self.expired = 0
+        self.last_event = None
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def _notify(self, events):
+        for event_type, obj in events:
+            for handler in self.handlers:
+                try:
+                    handler(event_type, obj)
+                except Exception as e:
+                    print('ERROR: Error handling %s event. %s' % (
+                            self.resource.kind, e))
+
+    def _insert(self, obj):
+        key = obj.metadata.name
+
+        self._delete(key)
+
+        self.objects[key] = obj
+
+        for name, indexer in self.indexers.items():
+            for value in indexer(obj):
+                if value:
+                    self.indexes[name].setdefault(value, set()).add(key)
+
+    def _delete(self, key):
+        obj = self.objects.pop(key, None)
+
+        if obj is None:
+            return None
+
+        for name, indexer in self.indexers.items():
+            index = self.indexes[name]
+            for value in indexer(obj):
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+
+        return obj
+
+    def get(self, name):
+        with self.lock:
+            return self.objects.get(name)
+
+    def items(self):
+        with self.lock:
+            return list(self.objects.values())
+
+    def by_index(self, index, value):
+        with self.lock:
+            keys = self.indexes[index].get(value, ())
+            return [self.objects[key] for key in keys]
+
+    def index_values(self, index):
+        with self.lock:
+            return list(self.indexes[index].keys())
+
+    def wait_for_sync(self, timeout=None):
+        return self.synced.wait(timeout)
+
+    def relist(self):
+        result = self.resource.get(namespace=namespace)
+
+        events = []
+
+        with self.lock:
+            previous = self.objects
+
+            self.objects = {}
+            self.indexes = dict((name, {}) for name in self.indexers)
+
+            for item in result.to_dict()['items']:
+                obj = ResourceInstance(self.resource, item)
+                old = previous.pop(obj.metadata.name, None)
+
+                self._insert(obj)
+
+                if old is None:
+                    events.append(('ADDED', obj))
+                elif (old.metadata.resourceVersion !=
+                        obj.metadata.resourceVersion):
+                    events.append(('MODIFIED', obj))
+
+            for obj in previous.values():
+                events.append(('DELETED', obj))
+
+            self.resource_version = result.metadata.resourceVersion
+
+        self.relists += 1
+        self.last_event = time.time()
+
+        record_startup('sync:%s' % self.resource.kind)
+
+        self.synced.set()
+
+        self._notify(events)
+
+    def apply(self, event_type, obj):
+        with self.lock:
+            if event_type in ('ADDED', 'MODIFIED'):
+                self._insert(obj)
+            elif event_type == 'DELETED':
+                self._delete(obj.metadata.name)
+
+            self.resource_version = obj.metadata.resourceVersion
+
+        self._notify([(event_type, obj)])
+
+    def watch(self):
+        watcher = Watch()
+
+        for item in watcher.stream(self.resource.get,
+                namespace=namespace, serialize=False,
+                resource_version=self.resource_version,
+                timeout_seconds=watch_timeout,
+                query_params=[('allowWatchBookmarks', 'true')]):
+
+            self.last_event = time.time()
+
+            event_type = item['type']
+
+            if event_type in ('ADDED', 'MODIFIED', 'DELETED'):
+                obj = ResourceInstance(self.resource, item['object'])
+                self.apply(event_type, obj)
+
+            elif event_type == 'BOOKMARK':
+                metadata = item['object'].get('metadata', {})
+                self.resource_version = metadata.get('resourceVersion',
+                        self.resource_version)
+
+            elif event_type == 'ERROR':
+                status = item['object']
+
+                if status.get('code') == 410:
+                    # The resource version we hold has been compacted
+                    # away. Drop it so that the next pass does a relist.
+
+                    self.resource_version = None
+                    self.expired += 1
+
+                    return
+
+                raise RuntimeError(status.get('message', status))
+
+    def run(self):
+        delay = 1.0
+
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.relist()
+
+                self.watch()
+
+            except ApiException as e:
+                if e.status == 410:
+                    self.resource_version = None
+                    self.expired += 1
+
+                else:
+                    print('ERROR: Error watching %s. %s' % (
+                            self.resource.kind, e))
+
+                    time.sleep(delay)
+                    delay = min(2 * delay, 60.0)
+
+                    continue
+
+            except Exception as e:
+                print('ERROR: Error watching %s. %s' % (self.resource.kind, e))
+
+                time.sleep(delay)
+                delay = min(2 * delay, 60.0)
+
+                continue
+
+            finally:
+                self.restarts += 1
+
+            self.last_event = time.time()
+
+            delay = 1.0
+
+    def status(self):
+        lag = None
+
+        if self.last_event is not None:
+            lag = time.time() - self.last_event
+
+        return dict(kind=self.resource.kind, synced=self.synced.is_set(),
+                resource_version=self.resource_version, lag=lag,
+                restarts=self.restarts, relists=self.relists,
+                expired=self.expired, objects=len(self.objects))
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+def label_indexer(label):
+    def indexer(obj):
+        labels = obj.metadata.labels
+        return [labels[label]] if labels else []
+    return indexer
+
+def annotation_indexer(annotation):
+    def indexer(obj):
+        annotations = obj.metadata.annotations
+        return [annotations[annotation]] if annotations else []
+    return indexer
+
+pod_informer = Informer(pod_resource, {
+    'deployment': label_indexer('deployment'),
+    'dask-cluster': label_indexer('dask-cluster'),
+    'notebook': annotation_indexer('jupyteronopenshift.org/dask-cluster'),
+})
+
+deployment_informer = Informer(deployment_resource, {
+    'dask-cluster': label_indexer('dask-cluster'),
+    'dask-pool': label_indexer('dask-pool'),
+})
+
+service_informer = Informer(service_resource)
+
+auth = HubAuth(api_token=os.environ['JUPYTERHUB_API_TOKEN'],
+        cookie_cache_max_age=60)
+
+jupyterhub_service_name = os.environ.get('JUPYTERHUB_SERVICE_NAME', '')
+prefix = os.environ.get('JUPYTERHUB_SERVICE_PREFIX', '')
+
+jupyterhub_name = os.environ.get('JUPYTERHUB_NAME', '')
+
+application = Flask(__name__)
+
+controller = Blueprint('controller', __name__, template_folder='templates')
+
+class UserCache(object):
+
+    """Bounded cache of user models returned by the hub for a cookie or
+    token. Entries expire after a maximum age, and the least recently used
+    entry is evicted when the cache is full. Keys are stored as digests so
+    that credentials are not held in memory longer than needed.
+
+    """
+
+    def __init__(self, max_size, max_age):
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, kind, value):
+        return hashlib.sha256(('%s:%s' % (kind, value)).encode('utf-8')).digest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                if time.time() - entry[0] < self.max_age:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+
+                del self.entries[key]
+
+            self.misses += 1
+
+    def set(self, key, user):
+        with self.lock:
+            self.entries[key] = (time.time(), user)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def status(self):
+        with self.lock:
+            return dict(size=len(self.entries), max_size=self.max_size,
+                    max_age=self.max_age, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations)
+
+user_cache = UserCache(int(os.environ.get('DASK_AUTH_CACHE_SIZE', '1000')),
+        float(os.environ.get('DASK_AUTH_CACHE_TTL', '60')))
+
+def request_credentials():
+    cookie = request.cookies.get(auth.cookie_name)
+    token = request.headers.get(auth.auth_header_name)
+
+    if cookie:
+        return user_cache.key('cookie', cookie), auth.user_for_cookie, cookie
+    elif token:
+        return user_cache.key('token', token), auth.user_for_token, token
+
+    return None, None, None
+
+@decorator
+def authenticated_user(wrapped, instance, args, kwargs):
+    key, lookup, credentials = request_credentials()
+
+    user = None
+
+    if key is not None:
+        user = user_cache.get(key)
+
+        if user is None:
+            user = lookup(credentials)
+
+            if user:
+                user_cache.set(key, user)
+
+    if user:
+        try:
+            return wrapped(user, *args, **kwargs)
+
+        except HTTPException as e:
+            # Permissions of the user may have changed since the user
+            # was cached, so look the user up again on the next request.
+
+            if e.code == 403:
+                user_cache.invalidate(key)
+
+            raise
+
+    else:
+        # Request to login url on failed authentication.
+        return redirect(auth.login_url + '?next=%s' % quote(request.path))
+
+route_request_seconds = Histogram('dask_controller_route_request_seconds',
+        'Latency of requests to the controller routes.', ['route'])
+
+@controller.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+@controller.after_request
+def record_request_time(response):
+    started = getattr(g, 'request_started', None)
+
+    if started is not None and request.url_rule is not None:
+        route_request_seconds.labels(request.url_rule.rule[len(
+                prefix.rstrip('/')):]).observe(time.time() - started)
+
+    return response
+
+# A Kubernetes API request a route depends on having failed with a
+# transient error, even after any retries, or having been refused by the
+# circuit breaker, is reported as the service being unavailable, with a
+# hint of when to try again, rather than as an internal error. Any other
+# failure, such as a resource not being found or a conflict, is passed on
+# with the status the API server gave.
+
+@controller.errorhandler(ApiException)
+def api_unavailable(e):
+    print('ERROR: Kubernetes API request for %s failed. %s' % (
+            request.path, e))
+
+    response = jsonify(error='Kubernetes API request failed.',
+            status=e.status, reason=e.reason)
+
+    if e.status in api_transient_statuses:
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(api_breaker_reset))
+
+    elif e.status and 400 <= e.status < 600:
+        response.status_code = e.status
+
+    else:
+        response.status_code = 500
+
+    return response
+
+@decorator
+def admin_users_only(wrapped, instance, args, kwargs):
+    user = (lambda user: user)(*args, **kwargs)
+    if not user.get('admin', False):
+        abort(403)
+    return wrapped(*args, **kwargs)
+
+dask_cluster_name = os.environ.get('DASK_CLUSTER_NAME')
+dask_scheduler_name = '%s-scheduler' % dask_cluster_name
+
+def pod_details(deployment):
+    pods = pod_informer.by_index('deployment', deployment)
+
+    details = []
+
+    for pod in sorted(pods, key=lambda pod: pod.metadata.name):
+        details.append((pod.metadata.name, pod.status.phase))
+
+    return details
+
+def get_pods(name, pool=None):
+    details = []
+
+    for pool_name, deployment in sorted(cluster_worker_pools(name).items()):
+        if pool is None or pool == pool_name:
+            details.extend(pod_details(deployment))
+
+    return details
+
+@controller.route('/pods', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+def pods(user):
+    return jsonify(get_pods(user['name'], request.args.get('pool')))
+
+# Long polling support for the pod list. Each worker deployment has a
+# version which changes only when the name or phase of one of its pods
+# changes, with the version of a cluster being the latest of those of
+# its worker pools. A client passes back the last version it saw and the request
+# blocks until there is a newer version or the poll timeout expires. The
+# counter is seeded from the clock so versions handed out before a
+# restart of the controller are never mistaken for current ones.
+#
+# A waiting request holds one of the request threads of mod_wsgi for the
+# whole of the poll, so only DASK_POD_WATCH_LIMIT requests, by default half
+# of the request threads, are allowed to wait at once. Any more are
+# answered straight away and told how long to wait before polling again,
+# which leaves threads free for provisioning and scaling requests.
+
+pod_status_timeout = float(os.environ.get('DASK_POD_STATUS_TIMEOUT', '30'))
+
+pod_watch_limit = int(os.environ.get('DASK_POD_WATCH_LIMIT',
+        int(os.environ.get('MOD_WSGI_THREADS', '5')) // 2))
+pod_watch_retry = float(os.environ.get('DASK_POD_WATCH_RETRY', '5'))
+pod_watch_waiting = 0
+
+pod_status_condition = threading.Condition()
+pod_status_counter = int(time.time() * 1000)
+pod_status_versions = {}
+pod_status_snapshots = {}
+
+def pod_status_changed(event_type, pod):
+    global pod_status_counter
+
+    labels = pod.metadata.labels
+    deployment = labels['deployment'] if labels else None
+
+    if not deployment or '-worker-' not in deployment:
+        return
+
+    # Pods can still be going away after their deployment was deleted,
+    # and shouldn't bring back the version it had.
+
+    if event_type == 'DELETED' and deployment_informer.get(deployment) is None:
+        forget_pod_status(deployment)
+        return
+
+    details = pod_details(deployment)
+
+    with pod_status_condition:
+        if pod_status_snapshots.get(deployment) != details:
+            pod_status_counter += 1
+            pod_status_snapshots[deployment] = details
+            pod_status_versions[deployment] = pod_status_counter
+            pod_status_condition.notify_all()
+
+pod_informer.add_handler(pod_status_changed)
+
+# The version of a worker deployment is forgotten when it is deleted, so
+# that clusters coming and going don't leave entries behind. Any request
+# waiting on it is woken, as the version it was waiting on has changed.
+
+def forget_pod_status(deployment):
+    with pod_status_condition:
+        pod_status_snapshots.pop(deployment, None)
+
+        if pod_status_versions.pop(deployment, None):
+            pod_status_condition.notify_all()
+
+def pod_status_deleted(event_type, deployment):
+    if event_type == 'DELETED':
+        forget_pod_status(deployment.metadata.name)
+
+deployment_informer.add_handler(pod_status_deleted)
+
+@controller.route('/pods/watch', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+def pods_watch(user):
+    global pod_watch_waiting
+
+    version = request.args.get('version', '')
+
+    pool = request.args.get('pool')
+
+    deployments = [deployment for pool_name, deployment in
+            cluster_worker_pools(user['name']).items()
+            if pool is None or pool == pool_name]
+
+    deadline = time.time() + pod_status_timeout
+
+    with pod_status_condition:
+        current = str(max([pod_status_versions.get(deployment, 0)
+                for deployment in deployments], default=0))
+
+        if current == version and pod_watch_waiting >= pod_watch_limit:
+            return jsonify(version=current,
+                    pods=get_pods(user['name'], pool), retry=pod_watch_retry)
+
+        pod_watch_waiting += 1
+
+        try:
+            while current == version:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    break
+
+                pod_status_condition.wait(remaining)
+
+                current = str(max([pod_status_versions.get(deployment, 0)
+                        for deployment in deployments], default=0))
+
+        finally:
+            pod_watch_waiting -= 1
+
+    return jsonify(version=current, pods=get_pods(user['name'], pool))
+
+max_worker_replicas = int(os.environ.get('DASK_MAX_WORKER_REPLICAS', '0'))
+
+scale_template = string.Template("""
+{
+    "kind": "Scale",
+    "apiVersion": "extensions/v1beta1",
+    "metadata": {
+        "namespace": "${namespace}",
+        "name": "${name}"
+    },
+    "spec": {
+        "replicas": ${replicas}
+    }
+}
+""")
+
+def scale_deployment(name, replicas):
+    body = json.loads(scale_template.safe_substitute(namespace=namespace,
+            name=name, replicas=replicas))
+
+    deployment_resource.scale.replace(namespace=namespace, body=body)
+
+# When reducing the number of workers, the workers to be removed are
+# first retired through the scheduler, so any data they hold is moved to
+# the workers which remain rather than being lost and having to be
+# recomputed. The version of distributed in the notebook image has no
+# HTTP API for this, so the controller connects to the scheduler as a
+# Dask client. Pods which haven't yet joined the scheduler are chosen
+# first, newest first, then the workers using the least memory. The
+# versions of Kubernetes which still serve extensions/v1beta1 deployments
+# don't let the replica set be told which pods to remove, so the chosen
+# pods are deleted, once retired, before the deployment is scaled down.
+# Any pods the replica set starts in their place in the meantime are the
+# newest and not yet ready, which are the first it removes when scaled
+# down. If the scheduler can't be queried or asked to retire workers, the
+# chosen pods are still deleted.
+
+retire_timeout = float(os.environ.get('DASK_RETIRE_TIMEOUT', '300'))
+
+def retire_scheduler_workers(name, addresses):
+    from distributed import Client
+
+    address = 'tcp://%s-scheduler-%s:8786' % (dask_cluster_name, name)
+
+    client = Client(address, timeout=scheduler_request_timeout,
+            set_as_default=False)
+
+    try:
+        return client.retire_workers(workers=addresses, close_workers=False,
+                callback_timeout=retire_timeout)
+
+    finally:
+        client.close()
+
+def retire_workers(name, worker_name, count):
+    started = time.time()
+
+    pods = list(pod_informer.by_index('deployment', worker_name))
+
+    try:
+        identity = fetch_scheduler_json(name, '/json/identity.json')
+        workers = identity.get('workers') or {}
+
+    except Exception as e:
+        print('ERROR: Could not query workers of cluster %s: %s' % (name, e))
+        workers = {}
+
+    by_host = dict((pod.status.podIP, pod) for pod in pods
+            if pod.status.podIP)
+
+    candidates = []
+
+    for address, worker in workers.items():
+        host = worker.get('host') or urllib.parse.urlparse(address).hostname
+
+        if host in by_host:
+            candidates.append((worker.get('memory') or 0, address,
+                    by_host.pop(host)))
+
+    candidates.sort(key=lambda candidate: candidate[0])
+
+    joining = [(0, None, pod) for pod in pods
+            if pod.status.podIP is None or pod.status.podIP in by_host]
+
+    joining.sort(key=lambda candidate: str(
+            candidate[2].metadata.creation_timestamp or ''), reverse=True)
+
+    chosen = (joining + candidates)[:count]
+
+    if not chosen:
+        return {}
+
+    addresses = [address for nbytes, address, pod in chosen if address]
+
+    retired = {}
+
+    if addresses:
+        try:
+            retired = retire_scheduler_workers(name, addresses) or {}
+
+        except Exception as e:
+            print('ERROR: Could not retire workers of cluster %s: %s' %
+                    (name, e))
+
+    def delete_pod(pod_name):
+        try:
+            pod_resource.delete(namespace=namespace, name=pod_name)
+
+        except ApiException as e:
+            if e.status != 404:
+                print('ERROR: Could not delete pod %s: %s' % (pod_name, e))
+
+    run_concurrently([(delete_pod, pod.metadata.name)
+            for nbytes, address, pod in chosen])
+
+    moved = sum(nbytes for nbytes, address, pod in chosen
+            if address in retired)
+
+    return dict(retired=len(retired), moved_bytes=moved,
+            retire_seconds=time.time()-started)
+
+def scale_workers(name, replicas, pool=None):
+    worker_name = cluster_worker_pools(name)[pool or default_worker_pool]
+
+    result = dict(replicas=replicas, retired=0, moved_bytes=0,
+            retire_seconds=0.0)
+
+    deployment = deployment_informer.get(worker_name)
+
+    if deployment is not None and replicas < (deployment.spec.replicas or 0):
+        result.update(retire_workers(name, worker_name,
+                deployment.spec.replicas - replicas))
+
+    scale_deployment(worker_name, replicas)
+
+    return result
+
+@controller.route('/scale', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+def scale(user):
+    replicas = request.args.get('replicas', None)
+
+    if replicas is None:
+        return jsonify()
+
+    # With a worker budget, workers are only granted by the leader, as the
+    # grants a replica has made but the cache doesn't yet show are known
+    # only to it, so the request is passed on to the leader.
+
+    if worker_budget > 0 and not is_leader():
+        response = None
+
+        if not request.headers.get(forwarded_header):
+            response = forward_request(membership.leader_address(),
+                    forward_timeout + retire_timeout)
+
+        if response is None:
+            response = jsonify(error='Leader of the controller replicas '
+                    'could not be reached.')
+            response.status_code = 503
+            response.headers['Retry-After'] = str(int(forward_timeout))
+
+        return response
+
+    replicas = int(replicas)
+
+    pool = request.args.get('pool', default_worker_pool)
+
+    settings = worker_pool_settings(user['name'], pool)
+
+    if settings is None or pool not in cluster_worker_pools(user['name']):
+        abort(404)
+
+    if settings['max_replicas'] > 0:
+        replicas = min(replicas, settings['max_replicas'])
+
+    replicas = max(replicas, settings['min_replicas'])
+
+    resume_cluster(user['name'])
+
+    if worker_budget > 0:
+        result = request_workers(user['name'], replicas, pool,
+                user_priority(user))
+    else:
+        result = scale_workers(user['name'], replicas, pool)
+
+    result['pool'] = pool
+
+    return jsonify(result)
+
+restart_template = string.Template("""
+{
+    "spec": {
+        "template": {
+            "metadata": {
+                "annotations": {
+                    "dask-controller/restart": "${time}"
+                }
+            }
+        }
+    }
+}
+""")
+
+@controller.route('/restart', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+def restart(user):
+    pool = request.args.get('pool')
+
+    body = json.loads(restart_template.safe_substitute(time=time.time()))
+
+    for pool_name, name in cluster_worker_pools(user['name']).items():
+        if pool is None or pool == pool_name:
+            deployment_resource.patch(namespace=namespace, name=name,
+                    body=body)
+
+    return jsonify()
+
+@controller.route('/logout', methods=['GET', 'OPTIONS', 'POST'])
+def logout():
+    key, lookup, credentials = request_credentials()
+
+    if key is not None:
+        user_cache.invalidate(key)
+
+    return redirect(auth.hub_prefix + 'logout')
+
+@controller.route('/auth', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def auth_cache(user):
+    return jsonify(user_cache.status())
+
+@controller.route('/watches', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def watches(user):
+    return jsonify([informer.status() for informer in
+            (pod_informer, deployment_informer, service_informer)])
+
+@controller.route('/queues', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def queues(user):
+    return jsonify([reconcile_queue.status(), registration_queue.status(),
+            cull_queue.status(), admission_queue.status()])
+
+worker_replicas = int(os.environ.get('DASK_WORKER_REPLICAS', 3))
+worker_memory = os.environ.get('DASK_WORKER_MEMORY', '512Mi')
+idle_timeout = int(os.environ.get('DASK_IDLE_CLUSTER_TIMEOUT', 600))
+
+worker_deployment_template = string.Template("""
+{
+    "apiVersion": "extensions/v1beta1",
+    "kind": "Deployment",
+    "metadata": {
+        "labels": {
+            "app": "${application}",
+            "component": "dask-worker",
+            "dask-cluster": "${cluster}",
+            "dask-profile": "${profile}",
+            "dask-worker-pool": "${pool}"
+        },
+        "name": "${name}",
+        "namespace": "${namespace}",
+        "ownerReferences": [
+            {
+                "apiVersion": "v1",
+                "controller": true,
+                "blockOwnerDeletion": false,
+                "kind": "Service",
+                "name": "${owner}",
+                "uid": "${owner_uid}"
+            }
+        ]
+    },
+    "spec": {
+        "replicas": ${replicas},
+        "selector": {
+            "matchLabels": {
+                "app": "${application}",
+                "deployment": "${name}"
+            }
+        },
+        "strategy": {
+            "type": "Recreate"
+        },
+        "template": {
+            "metadata": {
+                "annotations": {
+                    "alpha.image.policy.openshift.io/resolve-names": "*",
+                    "dask-controller/config-hash": "${config_hash}"
+                },
+                "labels": {
+                    "app": "${application}",
+                    "dask-cluster": "${cluster}",
+                    "dask-worker-pool": "${pool}",
+                    "deployment": "${name}"
+                }
+            },
+            "spec": {
+                "containers": [
+                    {
+                        "name": "worker",
+                        "image": "${application}-notebook-img:latest",
+                        "command": [
+                            "start-daskworker.sh"
+                        ],
+                        "args": ${args},
+                        "env": [
+                            {
+                                "name": "DASK_SCHEDULER_ADDRESS",
+                                "value": "${scheduler}:8786"
+                            },
+                            {
+                                "name": "DASK_CONFIG",
+                                "value": "/etc/dask/config.yaml"
+                            }
+                        ],
+                        "ports": [
+                            {
+                                "containerPort": 8786,
+                                "protocol": "TCP"
+                            },
+                            {
+                                "containerPort": 8787,
+                                "protocol": "TCP"
+                            }
+                        ],
+                        "resources": ${resources},
+                        "volumeMounts": [
+                            {
+                                "name": "dask-config",
+                                "mountPath": "/etc/dask"
+                            },
+                            {
+                                "name": "dask-scratch",
+                                "mountPath": "${scratch_directory}"
+                            }
+                        ]
+                    }
+                ],
+                "volumes": [
+                    {
+                        "name": "dask-config",
+                        "configMap": {
+                            "name": "${config}",
+                            "optional": true
+                        }
+                    },
+                    {
+                        "name": "dask-scratch",
+                        "emptyDir": ${scratch}
+                    }
+                ]
+            }
+        }
+    }
+}
+""")
+
+scheduler_deployment_template = string.Template("""
+{
+    "apiVersion": "extensions/v1beta1",
+    "kind": "Deployment",
+    "metadata": {
+        "labels": {
+            "app": "${application}",
+            "component": "dask-scheduler",
+            "dask-cluster": "${cluster}",
+            "dask-profile": "${profile}"
+        },
+        "name": "${name}",
+        "namespace": "${namespace}",
+        "ownerReferences": [
+            {
+                "apiVersion": "v1",
+                "controller": true,
+                "blockOwnerDeletion": false,
+                "kind": "Service",
+                "name": "${owner}",
+                "uid": "${owner_uid}"
+            }
+        ]
+    },
+    "spec": {
+        "replicas": 1,
+        "selector": {
+            "matchLabels": {
+                "app": "${application}",
+                "deployment": "${name}"
+            }
+        },
+        "strategy": {
+            "type": "Recreate"
+        },
+        "template": {
+            "metadata": {
+                "annotations": {
+                    "alpha.image.policy.openshift.io/resolve-names": "*",
+                    "dask-controller/config-hash": "${config_hash}"
+                },
+                "labels": {
+                    "app": "${application}",
+                    "dask-cluster": "${cluster}",
+                    "deployment": "${name}"
+                }
+            },
+            "spec": {
+                "containers": [
+                    {
+                        "name": "scheduler",
+                        "image": "${application}-notebook-img:latest",
+                        "command": [
+                            "start-daskscheduler.sh"
+                        ],
+                        "env": [
+                            {
+                                "name": "DASK_CONFIG",
+                                "value": "/etc/dask/config.yaml"
+                            }
+                        ],
+                        "ports": [
+                            {
+                                "containerPort": 8786,
+                                "protocol": "TCP"
+                            },
+                            {
+                                "containerPort": 8787,
+                                "protocol": "TCP"
+                            }
+                        ],
+                        "resources": ${resources},
+                        "volumeMounts": [
+                            {
+                                "name": "dask-config",
+                                "mountPath": "/etc/dask"
+                            }
+                        ]
+                    }
+                ],
+                "volumes": [
+                    {
+                        "name": "dask-config",
+                        "configMap": {
+                            "name": "${config}",
+                            "optional": true
+                        }
+                    }
+                ]
+            }
+        }
+    }
+}
+""")
+
+scheduler_service_template = string.Template("""
+{
+    "kind": "Service",
+    "apiVersion": "v1",
+    "metadata": {
+        "namespace": "${namespace}",
+        "name": "${name}",
+        "labels": {
+            "app": "${application}"
+        }
+    },
+    "spec": {
+        "ports": [
+            {
+                "name": "8786-tcp",
+                "protocol": "TCP",
+                "port": 8786,
+                "targetPort": 8786
+            },
+            {
                 "name": "8787-tcp",
                 "protocol": "TCP",
                 "port": 8787,
                 "targetPort": 8787
             }
-        ],
-        "selector": {
-            "app": "${application}",
-            "deployment": "${name}"
+        ],
+        "selector": {
+            "app": "${application}",
+            "deployment": "${selector}"
+        }
+    }
+}
+""")
+
+dask_config_template = string.Template("""
+{
+    "kind": "ConfigMap",
+    "apiVersion": "v1",
+    "metadata": {
+        "namespace": "${namespace}",
+        "name": "${name}",
+        "labels": {
+            "app": "${application}"
+        },
+        "ownerReferences": [
+            {
+                "apiVersion": "v1",
+                "controller": true,
+                "blockOwnerDeletion": false,
+                "kind": "Service",
+                "name": "${owner}",
+                "uid": "${owner_uid}"
+            }
+        ]
+    },
+    "data": {
+        "config.yaml": ${config}
+    }
+}
+""")
+
+# Sizing profiles for clusters, given as JSON in DASK_CLUSTER_PROFILES or
+# in the file named by DASK_CLUSTER_PROFILES_FILE, which map each profile
+# name to the CPU and memory requests and limits of the workers and the
+# scheduler, and to the number of threads and processes of each worker.
+# A profile is chosen by the hub when the notebook is spawned, and passed
+# in the provisioning request and as an annotation on the notebook pod.
+# Settings a profile doesn't give are taken from the default profile.
+#
+# A profile can also define named worker pools in addition to the default
+# pool, each with its own deployment, worker settings overriding those of
+# the profile, initial, minimum and maximum replicas, and the Dask worker
+# resources its workers advertise, so that tasks needing, for example,
+# a lot of memory can be sent to the workers of one pool.
+#
+# The Dask configuration of the scheduler and workers of a cluster is
+# rendered from its profile into a config map mounted at /etc/dask, and
+# named by DASK_CONFIG. This gives the fractions of the memory limit at
+# which workers start spilling to disk, pause and are restarted, the
+# compression used for communication, and whether work stealing is
+# enabled. The directory spilled data is written to is passed to the
+# workers as an argument. Workers write spilled data to an emptyDir
+# volume rather than the writable layer of the container, optionally
+# limited in size and backed by memory. As a memory backed volume counts
+# against the memory limit of the container, its size is taken off the
+# memory limit given to Dask.
+#
+# Placement of the pods of a cluster is also set by its profile. The
+# scheduler can be preferred to run on the same node or in the same zone
+# as the notebook, which the hub labels with the name of its cluster, to
+# keep the round trips between client and scheduler short. The workers of
+# each pool can be spread out across nodes or zones, for isolation
+# from failures, or packed together on as few as possible, to keep the
+# traffic between them local. Placement is only a preference, so pods are
+# still scheduled when it can't be met.
+
+profile_settings = ('worker_cpu_request', 'worker_cpu_limit',
+        'worker_memory_request', 'worker_memory_limit', 'worker_nthreads',
+        'worker_nprocs', 'worker_scratch_size', 'worker_scratch_medium',
+        'worker_placement', 'worker_topology', 'scheduler_cpu_request',
+        'scheduler_cpu_limit', 'scheduler_memory_request',
+        'scheduler_memory_limit', 'scheduler_placement')
+
+dask_config_settings = ('memory_target', 'memory_spill', 'memory_pause',
+        'memory_terminate', 'comm_compression', 'work_stealing',
+        'local_directory')
+
+scratch_directory = os.environ.get('DASK_SCRATCH_DIRECTORY',
+        '/var/tmp/dask-scratch')
+
+notebook_label = 'jupyteronopenshift.org/dask-cluster'
+
+topology_keys = {
+    'node': 'kubernetes.io/hostname',
+    'zone': os.environ.get('DASK_ZONE_TOPOLOGY_KEY',
+            'failure-domain.beta.kubernetes.io/zone')
+}
+
+default_profile = os.environ.get('DASK_DEFAULT_PROFILE', 'default')
+
+profile_annotation = 'jupyteronopenshift.org/dask-profile'
+
+default_worker_pool = 'default'
+
+def load_cluster_profiles():
+    text = os.environ.get('DASK_CLUSTER_PROFILES', '')
+
+    filename = os.environ.get('DASK_CLUSTER_PROFILES_FILE', '')
+
+    if filename:
+        with open(filename) as fp:
+            text = fp.read()
+
+    profiles = json.loads(text or '{}')
+
+    defaults = dict(worker_memory_limit=worker_memory, worker_nprocs=1,
+            scheduler_memory_limit='256Mi', local_directory=scratch_directory,
+            worker_topology='node')
+
+    defaults.update(profiles.get(default_profile, {}))
+
+    profiles[default_profile] = defaults
+
+    for name, profile in profiles.items():
+        for setting in profile_settings + dask_config_settings:
+            profile.setdefault(setting, defaults.get(setting))
+
+        pools = {default_worker_pool: {}}
+        pools.update(profile.get('worker_pools') or {})
+
+        for pool_name, pool in pools.items():
+            for setting in profile_settings:
+                if setting.startswith('worker_'):
+                    pool.setdefault(setting, profile[setting])
+
+            pool.setdefault('worker_resources',
+                    profile.get('worker_resources') or {})
+
+            pool.setdefault('replicas', worker_replicas
+                    if pool_name == default_worker_pool else 0)
+            pool.setdefault('min_replicas', 0)
+            pool.setdefault('max_replicas', max_worker_replicas)
+
+        profile['worker_pools'] = pools
+
+    return profiles
+
+cluster_profiles = load_cluster_profiles()
+
+quantity_suffixes = [('Ki', 2**10), ('Mi', 2**20), ('Gi', 2**30),
+        ('Ti', 2**40), ('k', 10**3), ('M', 10**6), ('G', 10**9),
+        ('T', 10**12)]
+
+def parse_quantity(value):
+    value = str(value)
+
+    for suffix, factor in quantity_suffixes:
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+
+    return int(float(value))
+
+def container_resources(profile, component):
+    resources = {}
+
+    for kind in ('request', 'limit'):
+        for resource in ('cpu', 'memory'):
+            value = profile['%s_%s_%s' % (component, resource, kind)]
+            if value:
+                resources.setdefault(kind + 's', {})[resource] = str(value)
+
+    return resources
+
+def worker_arguments(profile, local_directory=None):
+    # The memory limit of each worker process is set to its share of the
+    # container limit, rather than left to Dask to work out from the
+    # memory of the node.
+
+    nprocs = int(profile['worker_nprocs'] or 1)
+
+    args = []
+
+    if profile['worker_nthreads']:
+        args.extend(['--nthreads', str(profile['worker_nthreads'])])
+
+    if nprocs > 1:
+        args.extend(['--nprocs', str(nprocs)])
+
+    if profile['worker_memory_limit']:
+        memory_limit = parse_quantity(profile['worker_memory_limit'])
+
+        if (profile['worker_scratch_medium'] == 'Memory' and
+                profile['worker_scratch_size']):
+            memory_limit -= parse_quantity(profile['worker_scratch_size'])
+
+        args.extend(['--memory-limit', str(max(memory_limit, 0) // nprocs)])
+
+    if profile.get('worker_resources'):
+        resources = []
+
+        for resource, value in sorted(profile['worker_resources'].items()):
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            resources.append('%s=%s' % (resource, value))
+
+        args.extend(['--resources', ','.join(resources)])
+
+    if local_directory:
+        args.extend(['--local-directory', local_directory])
+
+    return args
+
+def scratch_volume(profile):
+    volume = {}
+
+    if profile['worker_scratch_medium']:
+        volume['medium'] = profile['worker_scratch_medium']
+
+    if profile['worker_scratch_size']:
+        volume['sizeLimit'] = str(profile['worker_scratch_size'])
+
+    return volume
+
+def scheduler_affinity(name, profile):
+    # Clusters in the warm pool don't yet have a notebook to be near.
+
+    topology = topology_keys.get(profile['scheduler_placement'])
+
+    if not name or not topology:
+        return None
+
+    return {
+        'podAffinity': {
+            'preferredDuringSchedulingIgnoredDuringExecution': [
+                {
+                    'weight': 100,
+                    'podAffinityTerm': {
+                        'labelSelector': {
+                            'matchLabels': {notebook_label: name}
+                        },
+                        'topologyKey': topology
+                    }
+                }
+            ]
+        }
+    }
+
+def worker_placement(deployment_name, profile):
+    # Returns the affinity for the workers of a pool, which are matched by
+    # the name of their deployment. Deployments are created through the
+    # extensions/v1beta1 API, which is only served by versions of
+    # Kubernetes older than those supporting topology spread constraints,
+    # so workers are spread by a preference for not running alongside
+    # each other. This only spreads them evenly while there are no more
+    # workers than nodes or zones, after which they are placed as usual.
+
+    topology = topology_keys.get(profile['worker_topology'])
+
+    selector = {'matchLabels': {'deployment': deployment_name}}
+
+    if topology and profile['worker_placement'] == 'spread':
+        return {
+            'podAntiAffinity': {
+                'preferredDuringSchedulingIgnoredDuringExecution': [
+                    {
+                        'weight': 100,
+                        'podAffinityTerm': {
+                            'labelSelector': selector,
+                            'topologyKey': topology
+                        }
+                    }
+                ]
+            }
+        }
+
+    if topology and profile['worker_placement'] == 'pack':
+        return {
+            'podAffinity': {
+                'preferredDuringSchedulingIgnoredDuringExecution': [
+                    {
+                        'weight': 100,
+                        'podAffinityTerm': {
+                            'labelSelector': selector,
+                            'topologyKey': topology
+                        }
+                    }
+                ]
+            }
+        }
+
+    return None
+
+def dask_config(profile):
+    settings = cluster_profiles[profile]
+
+    # The version of distributed in the notebook image predates the nested
+    # dask.config layout and only reads the single file named by the
+    # DASK_CONFIG environment variable, with flat keys. It has no key for
+    # the local directory, which is instead passed to dask-worker as an
+    # argument.
+
+    config = {}
+
+    def set_config(key, value):
+        if value is not None:
+            config[key] = value
+
+    for fraction in ('target', 'spill', 'pause', 'terminate'):
+        set_config('worker-memory-%s' % fraction,
+                settings['memory_%s' % fraction])
+
+    set_config('compression', settings['comm_compression'])
+    set_config('work-stealing', settings['work_stealing'])
+
+    # The file is YAML, of which JSON is a subset.
+
+    return json.dumps(config, indent=4, sort_keys=True)
+
+def dask_config_hash(profile):
+    return hashlib.md5(dask_config(profile).encode('utf-8')).hexdigest()
+
+def dask_config_name(service_name):
+    return '%s-config' % service_name
+
+def render_dask_config(config_name, profile, owner='', owner_uid=''):
+    text = dask_config_template.safe_substitute(namespace=namespace,
+            name=config_name, application=jupyterhub_name,
+            config=json.dumps(dask_config(profile)), owner=owner,
+            owner_uid=owner_uid)
+
+    return json.loads(text)
+
+def render_worker_deployment(name, pool, deployment_name, scheduler,
+        config_name, profile, owner='', owner_uid='', labels={}):
+
+    settings = cluster_profiles[profile]['worker_pools'][pool]
+
+    text = worker_deployment_template.safe_substitute(
+            namespace=namespace, name=deployment_name,
+            application=jupyterhub_name, cluster=name, profile=profile,
+            pool=pool, scheduler=scheduler, replicas=settings['replicas'],
+            args=json.dumps(worker_arguments(settings,
+                    cluster_profiles[profile]['local_directory'])),
+            resources=json.dumps(container_resources(settings, 'worker')),
+            config=config_name, config_hash=dask_config_hash(profile),
+            scratch=json.dumps(scratch_volume(settings)),
+            scratch_directory=scratch_directory,
+            owner=owner, owner_uid=owner_uid)
+
+    body = json.loads(text)
+
+    body['metadata']['labels'].update(labels)
+
+    # With a worker budget, the initial workers of a user's cluster are
+    # asked for like any others, rather than started regardless.
+
+    if worker_budget > 0 and name and settings['replicas'] > 0:
+        body['spec']['replicas'] = 0
+
+        body['metadata'].setdefault('annotations', {})[
+                requested_replicas_annotation] = json.dumps(dict(
+                replicas=settings['replicas'], since=time.time(),
+                weight=1.0))
+
+    affinity = worker_placement(deployment_name, settings)
+
+    if affinity:
+        body['spec']['template']['spec']['affinity'] = affinity
+
+    return body
+
+def render_scheduler_deployment(name, deployment_name, config_name, profile,
+        owner='', owner_uid='', labels={}):
+
+    settings = cluster_profiles[profile]
+
+    # The user may have been moved to a larger scheduler memory tier than
+    # that of the profile.
+
+    resources = container_resources(settings, 'scheduler')
+
+    memory = scheduler_memory_limit(name, settings)
+
+    if memory:
+        resources.setdefault('limits', {})['memory'] = str(memory)
+
+    text = scheduler_deployment_template.safe_substitute(
+            namespace=namespace, name=deployment_name,
+            application=jupyterhub_name, cluster=name, profile=profile,
+            resources=json.dumps(resources),
+            config=config_name, config_hash=dask_config_hash(profile),
+            owner=owner, owner_uid=owner_uid)
+
+    body = json.loads(text)
+
+    body['metadata']['labels'].update(labels)
+
+    affinity = scheduler_affinity(name, settings)
+
+    if affinity:
+        body['spec']['template']['spec']['affinity'] = affinity
+
+    return body
+
+def select_profile(name, requested=None):
+    if requested in cluster_profiles:
+        return requested
+
+    for profile_name, profile in sorted(cluster_profiles.items()):
+        if name in (profile.get('users') or []):
+            return profile_name
+
+    return default_profile
+
+class ProvisioningTracer(object):
+
+    """Records a timeline of events for each cluster being provisioned,
+    from the request for the cluster through to its workers having
+    registered with the scheduler. Each event is recorded as an offset in
+    seconds from the start of the timeline. Completed timelines are kept
+    in a bounded ring buffer, and timelines which never complete are
+    moved there once they exceed the maximum age.
+
+    """
+
+    def __init__(self, max_traces, max_age):
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+
+        self.active = {}
+        self.completed = collections.deque(maxlen=max_traces)
+
+    def _expire(self, now):
+        for name, trace in list(self.active.items()):
+            if now - trace['started'] > self.max_age:
+                trace['outcome'] = 'incomplete'
+                self.completed.append(self.active.pop(name))
+
+    def start(self, name, event):
+        with self.lock:
+            now = time.time()
+
+            self._expire(now)
+
+            if name not in self.active:
+                self.active[name] = dict(cluster=name, started=now,
+                        outcome=None, events=[(event, 0.0)])
+
+    def record(self, name, event, unique=True):
+        with self.lock:
+            trace = self.active.get(name)
+
+            if trace is None:
+                return False
+
+            if unique and event in [item[0] for item in trace['events']]:
+                return False
+
+            trace['events'].append((event, time.time() - trace['started']))
+
+            return True
+
+    def events(self, name):
+        with self.lock:
+            trace = self.active.get(name)
+            return [item[0] for item in trace['events']] if trace else []
+
+    def finish(self, name, outcome):
+        with self.lock:
+            trace = self.active.pop(name, None)
+
+            if trace is not None:
+                trace['outcome'] = outcome
+                trace['duration'] = time.time() - trace['started']
+
+                self.completed.append(trace)
+
+                provisioning_seconds.observe(trace['duration'])
+
+    def discard(self, name):
+        with self.lock:
+            self.active.pop(name, None)
+
+    def traces(self):
+        with self.lock:
+            self._expire(time.time())
+
+            return list(self.completed) + list(self.active.values())
+
+provisioning_seconds = Histogram('dask_controller_provisioning_seconds',
+        'Time from a cluster being requested to its workers registering.',
+        buckets=(1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600))
+
+tracer = ProvisioningTracer(int(os.environ.get('DASK_TRACE_HISTORY', '500')),
+        float(os.environ.get('DASK_TRACE_MAX_AGE', '900')))
+
+def pod_ready(pod):
+    for condition in pod.status.conditions or []:
+        if condition.type == 'Ready' and condition.status == 'True':
+            return True
+
+    return False
+
+# Workers can take a moment to connect to the scheduler after their pods
+# are ready, so the scheduler is polled every second for a short while.
+# Rather than a thread sleeping between polls, the cluster is queued again
+# for the next one, so a burst of clusters starting doesn't hold up the
+# threads other checks of the schedulers use.
+
+registration_timeout = 30.0
+
+registration_checks = {}
+
+def check_workers_registered(name):
+    if name not in registration_checks:
+        return True
+
+    expected, deadline = registration_checks[name]
+
+    try:
+        identity = fetch_scheduler_json(name, '/json/identity.json')
+
+        if len(identity.get('workers') or {}) >= expected:
+            registration_checks.pop(name, None)
+
+            tracer.record(name, 'workers-registered')
+            tracer.finish(name, 'complete')
+
+            return True
+
+    except Exception:
+        pass
+
+    if time.time() >= deadline:
+        registration_checks.pop(name, None)
+
+    else:
+        registration_queue.add_after(name, 1.0)
+
+    return True
+
+def trace_pod_ready(event_type, pod):
+    if event_type == 'DELETED' or not pod_ready(pod):
+        return
+
+    labels = pod.metadata.labels
+
+    if not labels or not labels['deployment']:
+        return
+
+    deployment = deployment_informer.get(labels['deployment'])
+
+    if deployment is None:
+        return
+
+    name = deployment.metadata.labels['dask-cluster']
+
+    if not name or name not in tracer.active:
+        return
+
+    component = deployment.metadata.labels['component']
+
+    if component == 'dask-scheduler':
+        tracer.record(name, 'scheduler-ready')
+
+    elif component == 'dask-worker':
+        tracer.record(name, 'worker-ready:%s' % pod.metadata.name)
+
+    else:
+        return
+
+    events = tracer.events(name)
+
+    expected = cluster_worker_replicas(name)
+
+    workers = [event for event in events if event.startswith('worker-ready:')]
+
+    if ('scheduler-ready' in events and len(workers) >= expected and
+            tracer.record(name, 'workers-ready')):
+        registration_checks[name] = (expected,
+                time.time() + registration_timeout)
+
+        registration_queue.add(name)
+
+pod_informer.add_handler(trace_pod_ready)
+
+@controller.route('/traces', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def traces(user):
+    response = jsonify(tracer.traces())
+
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = \
+                'attachment; filename=dask-provisioning-traces.json'
+
+    return response
+
+def create_cluster_resources(service_name, scheduler_name, worker_names,
+        cluster, labels={}, profile=default_profile):
+
+    try:
+        text = scheduler_service_template.safe_substitute(
+                namespace=namespace, name=service_name,
+                application=jupyterhub_name, selector=scheduler_name)
+
+        body = json.loads(text)
+
+        body['metadata']['labels'].update(labels)
+
+        service = service_resource.create(namespace=namespace, body=body)
+
+        tracer.record(cluster, 'service-created')
+
+    except ApiException as e:
+        if e.status != 409:
+            print('ERROR: Error creating service. %s' % e)
+            return False
+
+        else:
+            try:
+                service = service_resource.get(namespace=namespace,
+                        name=service_name)
+
+            except Exception as e:
+                print('ERROR: Error querying service. %s' % e)
+                return False
+
+            # A service selecting some other scheduler deployment means
+            # the cluster was claimed from the warm pool.
+
+            if service.spec.selector['deployment'] != scheduler_name:
+                return True
+
+    except Exception as e:
+        print('ERROR: Error creating service. %s' % e)
+        return False
+
+    okay = True
+
+    # The config map is mounted as optional, so if it can't be created the
+    # cluster still starts, with the Dask defaults.
+
+    config_name = dask_config_name(service_name)
+
+    try:
+        body = render_dask_config(config_name, profile,
+                service.metadata.name, service.metadata.uid)
+
+        config_map_resource.create(namespace=namespace, body=body)
+
+        tracer.record(cluster, 'config-created')
+
+    except ApiException as e:
+        if e.status != 409:
+            print('ERROR: Error creating dask config. %s' % e)
+            okay = False
+
+    except Exception as e:
+        print('ERROR: Error creating dask config. %s' % e)
+        okay = False
+
+    # The deployments depend only on the service, so are all created at
+    # the same time.
+
+    def create_deployment(component, render, event):
+        try:
+            deployment_resource.create(namespace=namespace, body=render())
+
+            tracer.record(cluster, event)
+
+        except ApiException as e:
+            if e.status != 409:
+                print('ERROR: Error creating %s deployment. %s' % (
+                        component, e))
+                return False
+
+        except Exception as e:
+            print('ERROR: Error creating %s deployment. %s' % (component, e))
+            return False
+
+        return True
+
+    calls = []
+
+    for pool, worker_name in sorted(worker_names.items()):
+        calls.append((create_deployment, 'worker', functools.partial(
+                render_worker_deployment, cluster, pool, worker_name,
+                service_name, config_name, profile, service.metadata.name,
+                service.metadata.uid, labels),
+                'worker-deployment-created:%s' % pool))
+
+    calls.append((create_deployment, 'scheduler', functools.partial(
+            render_scheduler_deployment, cluster, scheduler_name,
+            config_name, profile, service.metadata.name,
+            service.metadata.uid, labels), 'scheduler-deployment-created'))
+
+    return all(run_concurrently(calls)) and okay
+
+cluster_operations = Counter('dask_controller_cluster_operations_total',
+        'Cluster create and delete operations.', ['operation', 'result'])
+
+def create_cluster(name, profile=default_profile):
+    # The warm pool only holds clusters of the default profile, with the
+    # scheduler memory of that profile.
+
+    settings = cluster_profiles[profile]
+
+    if (warm_pool_size > 0 and profile == default_profile and
+            scheduler_memory_limit(name, settings) ==
+            settings['scheduler_memory_limit']):
+        if claim_cluster(name):
+            cluster_operations.labels('create', 'success').inc()
+            return True
+
+    scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+
+    worker_names = dict((pool, worker_pool_deployment_name(name, pool))
+            for pool in cluster_profiles[profile]['worker_pools'])
+
+    okay = create_cluster_resources(scheduler_name, scheduler_name,
+            worker_names, name, profile=profile)
+
+    cluster_operations.labels('create',
+            okay and 'success' or 'failure').inc()
+
+    return okay
+
+def cluster_deployments(name):
+    # Clusters claimed from the warm pool keep the names of their pool
+    # deployments, so the cache is consulted to find the deployments
+    # which actually belong to a cluster, falling back to the names used
+    # for a cluster created from scratch.
+
+    scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+    worker_name = '%s-worker-%s' % (dask_cluster_name, name)
+
+    for deployment in deployment_informer.by_index('dask-cluster', name):
+        labels = deployment.metadata.labels
+        if labels['component'] == 'dask-scheduler':
+            scheduler_name = deployment.metadata.name
+        elif labels['component'] == 'dask-worker':
+            if (labels['dask-worker-pool'] or
+                    default_worker_pool) == default_worker_pool:
+                worker_name = deployment.metadata.name
+
+    return scheduler_name, worker_name
+
+def scheduler_deployment_name(name):
+    return cluster_deployments(name)[0]
+
+def worker_deployment_name(name):
+    return cluster_deployments(name)[1]
+
+def worker_pool_deployment_name(name, pool):
+    if pool == default_worker_pool:
+        return '%s-worker-%s' % (dask_cluster_name, name)
+
+    return '%s-%s-worker-%s' % (dask_cluster_name, pool, name)
+
+def cluster_worker_pools(name):
+    # Maps the name of each worker pool of the cluster to its deployment.
+    # Deployments from before worker pools were added have no pool label
+    # and are the default pool.
+
+    pools = {default_worker_pool: worker_deployment_name(name)}
+
+    for deployment in deployment_informer.by_index('dask-cluster', name):
+        labels = deployment.metadata.labels
+        if labels['component'] == 'dask-worker':
+            pool = labels['dask-worker-pool'] or default_worker_pool
+            pools[pool] = deployment.metadata.name
+
+    return pools
+
+def cluster_worker_replicas(name):
+    replicas = 0
+
+    for deployment_name in cluster_worker_pools(name).values():
+        deployment = deployment_informer.get(deployment_name)
+        if deployment is not None:
+            replicas += deployment.spec.replicas or 0
+
+    return replicas
+
+def cluster_settings(name):
+    return cluster_profiles.get(cluster_profile(name) or default_profile,
+            cluster_profiles[default_profile])
+
+def worker_pool_settings(name, pool):
+    return cluster_settings(name)['worker_pools'].get(pool)
+
+def cluster_config_name(name):
+    # Clusters claimed from the warm pool keep the config map of the pool
+    # cluster, so the name is taken from the scheduler deployment.
+
+    deployment = deployment_informer.get(scheduler_deployment_name(name))
+
+    if deployment is not None:
+        for volume in deployment.spec.template.spec.volumes or []:
+            if volume.name == 'dask-config':
+                return volume.configMap.name
+
+    return dask_config_name('%s-scheduler-%s' % (dask_cluster_name, name))
+
+def cluster_exists(name):
+    if not deployment_informer.wait_for_sync(30.0):
+        print('ERROR: Deployment cache is not synchronised.')
+        return None
+
+    scheduler_name = scheduler_deployment_name(name)
+
+    return deployment_informer.get(scheduler_name) is not None
+
+# Warm pool of clusters. A number of unassigned scheduler and worker sets
+# are kept running, each with its own pool service which the workers use
+# to find the scheduler. When a cluster is needed for a user, a ready set
+# is claimed by creating the user's scheduler service with a selector
+# for the pool scheduler, relabelling the pool objects and making the
+# user's service the owner of the pool service, so that deleting the
+# user's service still cleans up everything.
+
+warm_pool_size = int(os.environ.get('DASK_WARM_POOL_SIZE', '0'))
+
+pool_lock = threading.Lock()
+pool_claimed = set()
+pool_pending = set()
+
+pool_hits = 0
+pool_misses = 0
+pool_latencies = collections.deque(maxlen=1000)
+
+def pool_resource_names(pool_id):
+    service_name = '%s-pool-%s' % (dask_cluster_name, pool_id)
+    scheduler_name = '%s-pool-scheduler-%s' % (dask_cluster_name, pool_id)
+
+    worker_names = {}
+
+    for pool in cluster_profiles[default_profile]['worker_pools']:
+        if pool == default_worker_pool:
+            worker_names[pool] = '%s-pool-worker-%s' % (dask_cluster_name,
+                    pool_id)
+        else:
+            worker_names[pool] = '%s-pool-%s-worker-%s' % (
+                    dask_cluster_name, pool, pool_id)
+
+    return service_name, scheduler_name, worker_names
+
+def pool_worker_deployments(pool_id):
+    return [deployment.metadata.name for deployment in
+            deployment_informer.by_index('dask-pool', 'available')
+            if deployment.metadata.labels['dask-pool-id'] == pool_id and
+            deployment.metadata.labels['component'] == 'dask-worker']
+
+def pool_available():
+    available = {}
+
+    for deployment in deployment_informer.by_index('dask-pool', 'available'):
+        labels = deployment.metadata.labels
+        if labels['component'] == 'dask-scheduler':
+            available[labels['dask-pool-id']] = deployment
+
+    return available
+
+def pool_ids():
+    # Every pool cluster in the cache, whether available or claimed.
+
+    return set(deployment.metadata.labels['dask-pool-id']
+            for state in ('available', 'claimed')
+            for deployment in deployment_informer.by_index('dask-pool', state)
+            if deployment.metadata.labels['dask-pool-id'])
+
+def claim_cluster(name):
+    global pool_hits, pool_misses
+
+    started = time.time()
+
+    labels = {'dask-pool': 'claimed', 'dask-cluster': name}
+
+    tried = set()
+
+    while True:
+        with pool_lock:
+            for pool_id, deployment in sorted(pool_available().items()):
+                if pool_id in pool_claimed or pool_id in tried:
+                    continue
+                if (deployment.status.availableReplicas or 0) >= 1:
+                    pool_claimed.add(pool_id)
+                    pool_pending.discard(pool_id)
+                    break
+
+            else:
+                pool_misses += 1
+                return False
+
+        pool_service_name, pool_scheduler_name = \
+                pool_resource_names(pool_id)[:2]
+
+        # Other controller replicas may be claiming from the pool at the
+        # same time, so the claim is made by relabelling the scheduler
+        # deployment conditional on the version of it we have seen, which
+        # only one of them can do.
+
+        try:
+            deployment_resource.patch(namespace=namespace,
+                    name=pool_scheduler_name, body={'metadata': {
+                    'labels': labels, 'resourceVersion':
+                    deployment.metadata.resourceVersion}})
+
+            break
+
+        except ApiException as e:
+            with pool_lock:
+                pool_claimed.discard(pool_id)
+
+            if e.status not in (404, 409):
+                print('ERROR: Error claiming pool cluster %s. %s' % (
+                        pool_id, e))
+
+                return False
+
+            tried.add(pool_id)
+
+    worker_deployments = pool_worker_deployments(pool_id)
+
+    scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+
+    try:
+        text = scheduler_service_template.safe_substitute(
+                namespace=namespace, name=scheduler_name,
+                application=jupyterhub_name, selector=pool_scheduler_name)
+
+        body = json.loads(text)
+
+        service = service_resource.create(namespace=namespace, body=body)
+
+    except Exception as e:
+        # Includes the case where the service already exists, in which
+        # case the cluster is being created from scratch and the pool
+        # set is returned for someone else.
+
+        print('ERROR: Error claiming pool cluster %s. %s' % (pool_id, e))
+
+        try:
+            deployment_resource.patch(namespace=namespace,
+                    name=pool_scheduler_name, body={'metadata': {'labels':
+                    {'dask-pool': 'available', 'dask-cluster': None}}})
+
+        except Exception as e:
+            print('ERROR: Error releasing pool cluster %s. %s' % (pool_id, e))
+
+        with pool_lock:
+            pool_claimed.discard(pool_id)
+
+        return False
+
+    owner = {
+        "apiVersion": "v1",
+        "controller": True,
+        "blockOwnerDeletion": False,
+        "kind": "Service",
+        "name": service.metadata.name,
+        "uid": service.metadata.uid
+    }
+
+    def relabel(resource, name, body):
+        try:
+            resource.patch(namespace=namespace, name=name, body=body)
+
+        except Exception as e:
+            print('ERROR: Error claiming pool cluster %s. %s' % (pool_id, e))
+
+            return False
+
+        return True
+
+    calls = [(relabel, service_resource, pool_service_name,
+            {'metadata': {'labels': labels, 'ownerReferences': [owner]}})]
+
+    for worker_name in worker_deployments:
+        calls.append((relabel, deployment_resource, worker_name,
+                {'metadata': {'labels': labels}}))
+
+    if not all(run_concurrently(calls)):
+        return False
+
+    with pool_lock:
+        pool_hits += 1
+        pool_latencies.append(time.time() - started)
+
+    print('INFO: claimed pool cluster %s for %s.' % (pool_id, name))
+
+    tracer.record(name, 'claimed-from-pool')
+
+    return True
+
+def fill_pool():
+    while True:
+        if deployment_informer.wait_for_sync(30.0):
+            with pool_lock:
+                available = set(pool_available().keys())
+
+                # A pool cluster stops being pending once it is seen at
+                # all, as it may have been claimed, possibly by another
+                # replica, before ever being seen as available.
+
+                pool_pending.difference_update(pool_ids())
+                pool_claimed.intersection_update(available)
+
+                count = len(available - pool_claimed) + len(pool_pending)
+
+            # Only the leader tops up the pool, though every replica
+            # keeps track of the pool clusters it has claimed.
+
+            if not is_leader():
+                count = warm_pool_size
+
+            for i in range(warm_pool_size - count):
+                pool_id = uuid.uuid4().hex[:8]
+
+                with pool_lock:
+                    pool_pending.add(pool_id)
+
+                service_name, scheduler_name, worker_names = \
+                        pool_resource_names(pool_id)
+
+                labels = {'dask-pool': 'available', 'dask-pool-id': pool_id}
+
+                if not create_cluster_resources(service_name, scheduler_name,
+                        worker_names, '', labels):
+                    with pool_lock:
+                        pool_pending.discard(pool_id)
+
+        time.sleep(10.0)
+
+def pool_status():
+    with pool_lock:
+        latencies = sorted(pool_latencies)
+
+        return dict(size=warm_pool_size, hits=pool_hits, misses=pool_misses,
+                available=len(set(pool_available()) - pool_claimed),
+                pending=len(pool_pending),
+                claim_latency_p50=latencies[len(latencies)//2]
+                        if latencies else None,
+                claim_latency_max=latencies[-1] if latencies else None)
+
+@controller.route('/pool', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def pool(user):
+    return jsonify(pool_status())
+
+class WorkQueue(object):
+
+    """Queue of keys drained by a pool of worker threads. A key is held in
+    the queue at most once, and a key added again while it is being
+    processed is queued once more only after processing completes, so
+    bursts of events for the same key collapse into a single call of the
+    handler. Keys are handed out subject to a token bucket rate limit, and
+    keys for which the handler fails are retried with per key exponential
+    backoff. A key can also be added after a delay, with only the earliest
+    time at which it is due being kept. The time from a key being queued
+    to its processing completing is also observed in the latency
+    histogram if one is given.
+
+    """
+
+    def __init__(self, name, handler, workers=1, qps=10.0, burst=20,
+            base_delay=1.0, max_delay=300.0, latency=None):
+
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+
+        self.qps = qps
+        self.burst = burst
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.latency = latency
+
+        self.condition = threading.Condition(threading.RLock())
+
+        self.queue = collections.deque()
+        self.queued = {}
+        self.processing = set()
+        self.dirty = {}
+        self.delayed = []
+        self.deadlines = {}
+        self.failures = {}
+
+        self.tokens = float(burst)
+        self.refilled = time.time()
+
+        self.completed = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+    def _add(self, key, now):
+        if key in self.queued or key in self.dirty:
+            return
+
+        if key in self.processing:
+            self.dirty[key] = now
+            return
+
+        self.queued[key] = now
+        self.queue.append(key)
+
+        self.condition.notify()
+
+    def add(self, key):
+        with self.condition:
+            self._add(key, time.time())
+
+    def _add_after(self, key, when):
+        if self.deadlines.get(key, when + 1) <= when:
+            return
+
+        self.deadlines[key] = when
+
+        heapq.heappush(self.delayed, (when, key))
+
+    def add_after(self, key, delay):
+        with self.condition:
+            self._add_after(key, time.time() + delay)
+            self.condition.notify()
+
+    def _throttle(self, now):
+        self.tokens = min(float(self.burst),
+                self.tokens + (now - self.refilled) * self.qps)
+        self.refilled = now
+
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+
+        return (1.0 - self.tokens) / self.qps
+
+    def _get(self):
+        with self.condition:
+            while True:
+                now = time.time()
+
+                while self.delayed and self.delayed[0][0] <= now:
+                    when, key = heapq.heappop(self.delayed)
+
+                    # Entries superseded by an earlier time are skipped.
+
+                    if self.deadlines.get(key) == when:
+                        del self.deadlines[key]
+                        self._add(key, now)
+
+                timeout = None
+
+                if self.queue:
+                    timeout = self._throttle(now)
+
+                    if timeout <= 0.0:
+                        key = self.queue.popleft()
+                        self.processing.add(key)
+                        return key, self.queued.pop(key)
+
+                if self.delayed:
+                    ready = self.delayed[0][0] - now
+                    timeout = ready if timeout is None else min(timeout, ready)
+
+                self.condition.wait(timeout)
+
+    def _done(self, key, queued, okay):
+        with self.condition:
+            now = time.time()
+
+            self.processing.discard(key)
+
+            self.latencies.append(now - queued)
+
+            if self.latency is not None:
+                self.latency.observe(now - queued)
+
+            if okay:
+                self.completed += 1
+                self.failures.pop(key, None)
+
+            else:
+                self.failed += 1
+
+                count = self.failures.get(key, 0) + 1
+                self.failures[key] = count
+
+                delay = min(self.base_delay * 2 ** (count - 1),
+                        self.max_delay)
+
+                self._add_after(key, now + delay)
+
+            if key in self.dirty:
+                self._add(key, self.dirty.pop(key))
+
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            key, queued = self._get()
+
+            try:
+                okay = self.handler(key)
+
+            except Exception as e:
+                print('ERROR: Error processing %s %s. %s' % (self.name, key, e))
+                okay = False
+
+            self._done(key, queued, okay)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def status(self):
+        with self.condition:
+            latencies = sorted(self.latencies)
+
+            def percentile(fraction):
+                if latencies:
+                    return latencies[int(fraction * (len(latencies) - 1))]
+
+            return dict(name=self.name, depth=len(self.queue),
+                    delayed=len(self.deadlines),
+                    processing=len(self.processing),
+                    retrying=len(self.failures), completed=self.completed,
+                    failed=self.failed, latency_p50=percentile(0.5),
+                    latency_p99=percentile(0.99),
+                    latency_max=latencies and latencies[-1] or None)
+
+reconcile_workers = int(os.environ.get('DASK_RECONCILE_WORKERS', '10'))
+reconcile_qps = float(os.environ.get('DASK_RECONCILE_QPS', '20'))
+reconcile_burst = int(os.environ.get('DASK_RECONCILE_BURST', '40'))
+
+# The profile asked for by the hub in a provisioning request is kept until
+# the cluster is created, with the annotation on the notebook pod taking
+# precedence once the pod exists. A cluster whose profile is changed when
+# the notebook is next spawned has its deployments updated to match.
+
+requested_profiles = {}
+
+def requested_profile(name):
+    for pod in pod_informer.by_index('notebook', name):
+        annotations = pod.metadata.annotations
+        if annotations and annotations[profile_annotation]:
+            return annotations[profile_annotation]
+
+    return requested_profiles.get(name)
+
+def cluster_profile(name):
+    for deployment in deployment_informer.by_index('dask-cluster', name):
+        labels = deployment.metadata.labels
+        if labels['component'] == 'dask-worker':
+            return labels['dask-profile'] or default_profile
+
+def change_cluster_profile(name, profile):
+    current = cluster_profile(name)
+
+    if current is None or current == profile:
+        return True
+
+    print('INFO: changing dask cluster %s to profile %s.' % (name, profile))
+
+    settings = cluster_profiles[profile]
+
+    scheduler_name = scheduler_deployment_name(name)
+
+    service_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+
+    service = service_informer.get(service_name)
+
+    if service is None:
+        return False
+
+    okay = True
+
+    # The Dask config is updated first, as the new pods read it when they
+    # start. A cluster created before there was a config map gets one.
+
+    config_name = cluster_config_name(name)
+
+    body = render_dask_config(config_name, profile, service.metadata.name,
+            service.metadata.uid)
+
+    try:
+        try:
+            config_map_resource.patch(namespace=namespace,
+                    name=config_name, body={'data': body['data']})
+
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+            config_map_resource.create(namespace=namespace, body=body)
+
+    except Exception as e:
+        okay = False
+
+        print('ERROR: Could not change dask config %s: %s' %
+                (config_name, e))
+
+    existing = cluster_worker_pools(name)
+
+    templates = []
+
+    for pool in settings['worker_pools']:
+        deployment_name = existing.pop(pool, None)
+
+        if deployment_name is None:
+            continue
+
+        body = render_worker_deployment(name, pool, deployment_name,
+                service_name, config_name, profile)
+
+        templates.append((deployment_name, body['spec']['template']))
+
+    body = render_scheduler_deployment(name, scheduler_name, config_name,
+            profile)
+
+    templates.append((scheduler_name, body['spec']['template']))
+
+    for deployment_name, template in templates:
+        # Placement which the new profile doesn't have is removed.
+
+        template['spec'].setdefault('affinity', None)
+
+        body = {
+            'metadata': {
+                'labels': {
+                    'dask-profile': profile
+                }
+            },
+            'spec': {
+                'template': template
+            }
+        }
+
+        try:
+            deployment_resource.patch(namespace=namespace,
+                    name=deployment_name, body=body)
+
+        except Exception as e:
+            okay = False
+
+            print('ERROR: Could not change profile of deployment %s: %s' %
+                    (deployment_name, e))
+
+    # Worker pools the new profile doesn't have are removed, and those it
+    # adds are created, owned by the scheduler service like the others.
+
+    for pool, deployment_name in existing.items():
+        try:
+            deployment_resource.delete(namespace=namespace,
+                    name=deployment_name)
+
+        except ApiException as e:
+            if e.status != 404:
+                okay = False
+
+                print('ERROR: Could not delete deployment %s: %s' %
+                        (deployment_name, e))
+
+    for pool in settings['worker_pools']:
+        if pool in cluster_worker_pools(name):
+            continue
+
+        body = render_worker_deployment(name, pool,
+                worker_pool_deployment_name(name, pool), service_name,
+                config_name, profile, service.metadata.name,
+                service.metadata.uid)
+
+        try:
+            deployment_resource.create(namespace=namespace, body=body)
+
+        except ApiException as e:
+            if e.status != 409:
+                okay = False
+
+                print('ERROR: Could not create deployment %s: %s' %
+                        (body['metadata']['name'], e))
+
+    return okay
+
+@controller.route('/profiles', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+def profiles(user):
+    details = dict((name, dict((setting, profile[setting]) for setting in
+            profile_settings + dask_config_settings +
+            ('display_name', 'worker_pools')
+            if setting in profile))
+            for name, profile in cluster_profiles.items())
+
+    return jsonify(profiles=details, default=default_profile,
+            current=cluster_profile(user['name']))
+
+def reconcile_cluster(name):
+    found = cluster_exists(name)
+
+    if found is None:
+        return False
+
+    profile = select_profile(name, requested_profile(name))
+
+    if not found:
+        okay = create_cluster(name, profile)
+
+        if okay:
+            requested_profiles.pop(name, None)
+
+        return okay
+
+    requested_profiles.pop(name, None)
+
+    if not change_cluster_profile(name, profile):
+        return False
+
+    if cluster_suspended(name):
+        print('INFO: resuming dask cluster %s.' % name)
+
+        tracer.record(name, 'resumed')
+
+        return resume_cluster(name)
+
+    # Nothing to provision, unless a previous reconcile already started
+    # to, so drop the timeline if this was all it had recorded.
+
+    if len(tracer.events(name)) <= 1:
+        tracer.discard(name)
+
+    return True
+
+reconcile_queue = WorkQueue('cluster', reconcile_cluster,
+        workers=reconcile_workers, qps=reconcile_qps, burst=reconcile_burst)
+
+registration_queue = WorkQueue('registration', check_workers_registered,
+        workers=reconcile_workers, qps=reconcile_qps, burst=reconcile_burst)
+
+# Several replicas of the controller can be run, for capacity and so that
+# losing one doesn't stop clusters being provisioned and culled. Each
+# replica holds a Lease which it keeps renewing, and the replicas whose
+# leases have been seen to be renewed within the lease duration share
+# out the Dask clusters by consistent hashing of the cluster name. A
+# replica only provisions, culls and autoscales the clusters it owns, and
+# when a replica goes away its clusters are taken up by the others once
+# its lease expires. One replica also holds the leader lease, and alone
+# tops up the warm pool. Every replica watches all pods and deployments,
+# so any of them can serve the routes from its local cache.
+
+sharding_enabled = os.environ.get('DASK_CONTROLLER_SHARDING',
+        'false').lower() in ['true', 'yes', 'y', '1']
+
+controller_identity = os.environ.get('DASK_CONTROLLER_IDENTITY',
+        socket.gethostname())
+
+controller_address = os.environ.get('DASK_CONTROLLER_ADDRESS', '')
+
+lease_api_version = os.environ.get('DASK_LEASE_API_VERSION',
+        'coordination.k8s.io/v1')
+
+lease_duration = int(os.environ.get('DASK_LEASE_DURATION', '15'))
+
+shard_virtual_nodes = int(os.environ.get('DASK_SHARD_VIRTUAL_NODES', '64'))
+
+controller_address_annotation = 'dask-controller/address'
+
+lease_template = string.Template("""
+{
+    "kind": "Lease",
+    "apiVersion": "${api_version}",
+    "metadata": {
+        "name": "${name}",
+        "labels": {
+            "app": "${application}",
+            "dask-controller": "${role}"
+        },
+        "annotations": {
+            "dask-controller/address": "${address}"
+        }
+    },
+    "spec": {
+        "holderIdentity": "${identity}",
+        "leaseDurationSeconds": ${duration},
+        "acquireTime": "${now}",
+        "renewTime": "${now}"
+    }
+}
+""")
+
+def micro_time(now):
+    return '%s.%06dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S',
+            time.gmtime(now)), int(now % 1 * 1000000))
+
+def hash_point(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing(object):
+
+    """Consistent hash ring mapping cluster names to controller replicas.
+    Each replica is placed at a number of points on the ring and a name
+    is owned by the replica at the first point following the hash of the
+    name, so adding or removing a replica only moves the names which fall
+    next to its points.
+
+    """
+
+    def __init__(self, members, virtual_nodes):
+        self.members = sorted(members)
+
+        points = sorted((hash_point('%s/%d' % (member, i)), member)
+                for member in self.members for i in range(virtual_nodes))
+
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, name):
+        if not self.hashes:
+            return None
+
+        index = bisect.bisect(self.hashes, hash_point(name))
+
+        return self.owners[index % len(self.hashes)]
+
+class Membership(object):
+
+    """Maintains this replica's member lease and contends for the leader
+    lease, working out from a watch of the leases which replicas are live.
+    A lease is live if it was seen to change within its duration, judged
+    by the local clock, so clock skew between replicas doesn't matter.
+    The hash ring is rebuilt whenever the live replicas change, and the
+    registered handlers called so that newly owned clusters are taken up.
+
+    """
+
+    def __init__(self, identity, address, duration, virtual_nodes):
+        self.identity = identity
+        self.address = address
+        self.duration = duration
+        self.virtual_nodes = virtual_nodes
+
+        self.name = self.lease_name(identity)
+        self.leader_name = '%s-controller-leader' % dask_cluster_name
+
+        self.lock = threading.Lock()
+
+        self.observed = {}
+        self.ring = HashRing([], virtual_nodes)
+        self.leader_until = 0.0
+        self.running = True
+
+        self.handlers = []
+
+        self.rebalances = 0
+        self.transitions = 0
+
+        self.informer = Informer(lease_resource)
+        self.informer.add_handler(self.lease_changed)
+
+    def lease_name(self, identity):
+        return '%s-controller-%s' % (dask_cluster_name, identity)
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def lease_changed(self, event_type, lease):
+        labels = lease.metadata.labels
+
+        if not labels or labels['app'] != jupyterhub_name:
+            return
+
+        if not labels['dask-controller']:
+            return
+
+        with self.lock:
+            if event_type == 'DELETED':
+                self.observed.pop(lease.metadata.name, None)
+            else:
+                self.observed[lease.metadata.name] = time.time()
+
+    def alive(self, lease, now):
+        with self.lock:
+            observed = self.observed.get(lease.metadata.name)
+
+        if observed is None:
+            return False
+
+        return now - observed < (lease.spec.leaseDurationSeconds or
+                self.duration)
+
+    def leases(self, role):
+        for lease in self.informer.items():
+            labels = lease.metadata.labels
+            if labels and labels['app'] == jupyterhub_name:
+                if labels['dask-controller'] == role:
+                    yield lease
+
+    def members(self, now):
+        return sorted(lease.spec.holderIdentity for lease in
+                self.leases('member') if self.alive(lease, now))
+
+    def lease_body(self, name, role, now):
+        text = lease_template.safe_substitute(api_version=lease_api_version,
+                name=name, application=jupyterhub_name, role=role,
+                address=self.address, identity=self.identity,
+                duration=self.duration, now=micro_time(now))
+
+        return json.loads(text)
+
+    def renew(self, now):
+        try:
+            if self.informer.get(self.name) is None:
+                lease_resource.create(namespace=namespace,
+                        body=self.lease_body(self.name, 'member', now))
+
+            else:
+                lease_resource.patch(namespace=namespace, name=self.name,
+                        body={'spec': {'renewTime': micro_time(now)}})
+
+        except ApiException as e:
+            # A conflict or missing lease means the cache is behind, and
+            # the next pass will use the other request.
+
+            if e.status not in (404, 409):
+                print('ERROR: Error renewing lease %s. %s' % (self.name, e))
+
+    def lead(self, now):
+        lease = self.informer.get(self.leader_name)
+
+        try:
+            if lease is None:
+                lease_resource.create(namespace=namespace,
+                        body=self.lease_body(self.leader_name, 'leader', now))
+
+            else:
+                # Replacing the lease using the version we have seen means
+                # only one replica can take over an expired lease.
+
+                body = lease.to_dict()
+                spec = body['spec']
+
+                if spec['holderIdentity'] != self.identity:
+                    if self.alive(lease, now):
+                        return
+
+                    spec['holderIdentity'] = self.identity
+                    spec['acquireTime'] = micro_time(now)
+                    spec['leaseTransitions'] = (spec.get('leaseTransitions')
+                            or 0) + 1
+
+                    print('INFO: controller %s taking over as leader.' %
+                            self.identity)
+
+                    self.transitions += 1
+
+                spec['renewTime'] = micro_time(now)
+
+                lease_resource.replace(namespace=namespace, body=body)
+
+        except ApiException as e:
+            if e.status not in (404, 409):
+                print('ERROR: Error renewing lease %s. %s' % (
+                        self.leader_name, e))
+
+            return
+
+        self.leader_until = now + self.duration
+
+    def reap(self, now):
+        # Remove the leases of replicas which have gone away, so that they
+        # don't build up as replicas are replaced.
+
+        for lease in self.leases('member'):
+            if not self.alive(lease, now):
+                try:
+                    lease_resource.delete(namespace=namespace,
+                            name=lease.metadata.name)
+
+                except ApiException as e:
+                    if e.status != 404:
+                        print('ERROR: Error deleting lease %s. %s' % (
+                                lease.metadata.name, e))
+
+    def rebalance(self, now):
+        members = self.members(now)
+
+        if members == self.ring.members:
+            return
+
+        self.ring = HashRing(members, self.virtual_nodes)
+        self.rebalances += 1
+
+        print('INFO: controller replicas are now %s.' % ', '.join(members))
+
+        for handler in self.handlers:
+            try:
+                handler()
+            except Exception as e:
+                print('ERROR: Error handling rebalance. %s' % e)
+
+    def is_leader(self):
+        return self.running and time.time() < self.leader_until
+
+    def owns(self, name):
+        return self.running and self.ring.owner(name) == self.identity
+
+    def owner_address(self, name):
+        owner = self.ring.owner(name)
+
+        if owner is None:
+            return None
+
+        lease = self.informer.get(self.lease_name(owner))
+
+        if lease is None or not lease.metadata.annotations:
+            return None
+
+        return lease.metadata.annotations[controller_address_annotation]
+
+    def leader_address(self):
+        lease = self.informer.get(self.leader_name)
+
+        if lease is None or not self.alive(lease, time.time()):
+            return None
+
+        if not lease.metadata.annotations:
+            return None
+
+        return lease.metadata.annotations[controller_address_annotation]
+
+    def run(self):
+        self.informer.wait_for_sync()
+
+        while self.running:
+            now = time.time()
+
+            try:
+                self.renew(now)
+                self.lead(now)
+
+                if self.is_leader():
+                    self.reap(now)
+
+                self.rebalance(now)
+
+            except Exception as e:
+                print('ERROR: Error maintaining controller leases. %s' % e)
+
+            time.sleep(self.duration / 3.0)
+
+    def start(self):
+        self.informer.start()
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        # Give up our clusters and leadership straight away, rather than
+        # leaving the other replicas to wait for the leases to expire.
+
+        self.running = False
+        self.ring = HashRing([], self.virtual_nodes)
+
+        names = [self.name]
+
+        lease = self.informer.get(self.leader_name)
+
+        if lease is not None and lease.spec.holderIdentity == self.identity:
+            names.append(self.leader_name)
+
+        self.leader_until = 0.0
+
+        for name in names:
+            try:
+                lease_resource.delete(namespace=namespace, name=name)
+
+            except ApiException as e:
+                if e.status != 404:
+                    print('ERROR: Error deleting lease %s. %s' % (name, e))
+
+    def status(self):
+        lease = self.informer.get(self.leader_name)
+
+        owned = sum(1 for name in deployment_informer.index_values(
+                'dask-cluster') if self.owns(name))
+
+        return dict(identity=self.identity, address=self.address,
+                leader=lease and lease.spec.holderIdentity or None,
+                is_leader=self.is_leader(), members=self.ring.members,
+                owned_clusters=owned, rebalances=self.rebalances,
+                transitions=self.transitions, leases=self.informer.status())
+
+membership = None
+
+if sharding_enabled:
+    # Renewing leases is what keeps the ownership of clusters stable, so
+    # it isn't held back when the API server is under pressure.
+
+    lease_resource = InstrumentedResource(api_resources.get(
+            lease_api_version, 'Lease'), 'leases', critical=True)
+
+    membership = Membership(controller_identity, controller_address,
+            lease_duration, shard_virtual_nodes)
+
+def owns_cluster(name):
+    return membership is None or membership.owns(name)
+
+def is_leader():
+    return membership is None or membership.is_leader()
+
+def clusters_rebalanced():
+    # Take up any clusters now owned whose notebooks are running, as the
+    # replica which owned them before may not have finished provisioning
+    # them, or resuming them if they were suspended, and start tracking
+    # when the clusters now owned are next due to be culled.
+
+    for name in pod_informer.index_values('notebook'):
+        if owns_cluster(name):
+            reconcile_queue.add(name)
+
+    for name in deployment_informer.index_values('dask-cluster'):
+        if owns_cluster(name):
+            cull_queue.add(name)
+
+if membership is not None:
+    membership.add_handler(clusters_rebalanced)
+
+@controller.route('/shards', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def shards(user):
+    if membership is None:
+        return jsonify(sharding=False)
+
+    return jsonify(sharding=True, **membership.status())
+
+# Provisioning can be requested directly by the hub when it starts to
+# spawn a notebook, so that the scheduler and workers are started in
+# parallel with the notebook pod rather than only once the pod has been
+# seen by the watch. The hub authenticates using the API token which was
+# used to enable the controller. The watch remains as a fallback.
+
+controller_api_token = os.environ.get('DASK_CONTROLLER_API_TOKEN', '')
+
+# The hub may send the request to any replica of the controller, which
+# passes it on to the replica owning the cluster. If that can't be done,
+# it provisions the cluster itself, as doing so twice is harmless.
+
+forward_timeout = float(os.environ.get('DASK_FORWARD_TIMEOUT', '5'))
+
+forwarded_header = 'X-Dask-Controller-Forwarded'
+
+# As a cluster is usually provisioned before the notebook pod exists, it
+# isn't treated as idle until the notebook has had the spawn timeout to
+# appear, rather than being marked as idle and then unmarked again.
+
+spawn_timeout = float(os.environ.get('DASK_SPAWN_TIMEOUT', '300'))
+
+provisioned_at = {}
+
+def forward_provision(name, profile, token):
+    address = membership.owner_address(name)
+
+    if not address:
+        return False
+
+    url = 'http://%s%s/provision?user=%s&profile=%s' % (address,
+            prefix.rstrip('/'), quote(name), quote(profile))
+
+    req = urllib.request.Request(url, data=b'', method='POST',
+            headers={'Authorization': token,
+            forwarded_header: controller_identity})
+
+    try:
+        with urllib.request.urlopen(req, timeout=forward_timeout) as fp:
+            fp.read()
+
+    except Exception as e:
+        print('ERROR: Error forwarding provisioning of %s to %s. %s' % (
+                name, address, e))
+
+        return False
+
+    return True
+
+def forward_request(address, timeout=None):
+    # Passes the request being handled on to another replica, with the
+    # credentials of the user, and returns its response, or None if it
+    # couldn't be passed on.
+
+    if not address:
+        return None
+
+    headers = {forwarded_header: controller_identity}
+
+    for header in ('Authorization', 'Cookie'):
+        if request.headers.get(header):
+            headers[header] = request.headers[header]
+
+    req = urllib.request.Request('http://%s%s' % (address, request.full_path),
+            data=request.get_data() if request.method == 'POST' else None,
+            method=request.method, headers=headers)
+
+    try:
+        with urllib.request.urlopen(req,
+                timeout=timeout or forward_timeout) as fp:
+            return Response(fp.read(), status=fp.status,
+                    mimetype=fp.headers.get_content_type())
+
+    except urllib.error.HTTPError as e:
+        return Response(e.read(), status=e.code,
+                mimetype=e.headers.get_content_type())
+
+    except Exception as e:
+        print('ERROR: Error forwarding request %s to %s. %s' % (
+                request.path, address, e))
+
+        return None
+
+@controller.route('/provision', methods=['POST'])
+def provision():
+    token = request.headers.get('Authorization', '')
+
+    if not controller_api_token or not hmac.compare_digest(token,
+            'token %s' % controller_api_token):
+        abort(403)
+
+    name = request.args.get('user', '')
+
+    if not name:
+        abort(400)
+
+    profile = request.args.get('profile', '')
+
+    if not owns_cluster(name) and not request.headers.get(forwarded_header):
+        if forward_provision(name, profile, token):
+            return jsonify()
+
+    if profile:
+        requested_profiles[name] = profile
+
+    now = time.time()
+
+    for other, started in list(provisioned_at.items()):
+        if now - started >= spawn_timeout:
+            provisioned_at.pop(other, None)
+
+    provisioned_at[name] = now
+
+    # The notebook may already have been seen, in which case its arrival
+    # doesn't need to be waited for.
+
+    if pod_informer.by_index('notebook', name):
+        provisioned_at.pop(name, None)
+
+    tracer.start(name, 'provision-requested')
+
+    reconcile_queue.add(name)
+
+    return jsonify()
+
+def new_notebook_added(pod):
+    annotations = pod.metadata.annotations
+
+    if annotations:
+        name = annotations['jupyteronopenshift.org/dask-cluster']
+        if name and owns_cluster(name):
+            tracer.start(name, 'notebook-added')
+
+            reconcile_queue.add(name)
+
+def monitor_pods(event_type, pod):
+    if event_type == 'ADDED':
+        labels = pod.metadata.labels
+        if labels and labels['app'] == jupyterhub_name:
+            if labels['component'] == 'singleuser-server':
+                new_notebook_added(pod)
+
+pod_informer.add_handler(monitor_pods)
+
+# Idle clusters are first suspended by scaling their deployments to zero
+# replicas, with the replica count to restore kept in an annotation on
+# each deployment, and are only deleted once idle for the much longer
+# delete timeout. A delete timeout not greater than the idle timeout
+# means clusters are deleted straight away as before.
+
+idle_delete_timeout = int(os.environ.get('DASK_IDLE_DELETE_TIMEOUT', '86400'))
+
+idle_suspend_scheduler = os.environ.get('DASK_IDLE_SUSPEND_SCHEDULER',
+        'false').lower() in ['true', 'yes', 'y', '1']
+
+suspended_replicas_annotation = 'dask-controller/suspended-replicas'
+
+def suspend_cluster(name, workers_only=False):
+    scheduler_name = scheduler_deployment_name(name)
+
+    deployment_names = list(cluster_worker_pools(name).values())
+
+    if idle_suspend_scheduler and not workers_only:
+        deployment_names.append(scheduler_name)
+
+    def suspend_deployment(deployment_name, replicas):
+        body = {
+            'metadata': {
+                'annotations': {
+                    suspended_replicas_annotation: str(replicas)
+                }
+            },
+            'spec': {
+                'replicas': 0
+            }
+        }
+
+        try:
+            deployment_resource.patch(namespace=namespace,
+                    name=deployment_name, body=body)
+
+        except Exception as e:
+            print('ERROR: Could not suspend deployment %s: %s' %
+                    (deployment_name, e))
+
+            return False
+
+        admission_grants.pop(deployment_name, None)
+
+        return True
+
+    calls = []
+
+    for deployment_name in deployment_names:
+        deployment = deployment_informer.get(deployment_name)
+
+        if deployment is None or not deployment.spec.replicas:
+            continue
+
+        calls.append((suspend_deployment, deployment_name,
+                deployment.spec.replicas))
+
+    return all(run_concurrently(calls))
+
+def cluster_suspended(name):
+    for deployment in deployment_informer.by_index('dask-cluster', name):
+        annotations = deployment.metadata.annotations
+        if annotations and annotations[suspended_replicas_annotation]:
+            return True
+
+    return False
+
+def resume_cluster(name):
+    def resume_deployment(deployment_name, replicas):
+        body = {
+            'metadata': {
+                'annotations': {
+                    suspended_replicas_annotation: None
+                }
+            },
+            'spec': {
+                'replicas': int(replicas)
+            }
+        }
+
+        try:
+            deployment_resource.patch(namespace=namespace,
+                    name=deployment_name, body=body)
+
+        except Exception as e:
+            print('ERROR: Could not resume deployment %s: %s' %
+                    (deployment_name, e))
+
+            return False
+
+        return True
+
+    calls = []
+
+    # With a worker budget, the workers to restore are asked for like any
+    # other request for workers, as the room they had may have been given
+    # to other clusters while this one was suspended.
+
+    requests = {}
+
+    for deployment in deployment_informer.by_index('dask-cluster', name):
+        annotations = deployment.metadata.annotations
+
+        if not annotations:
+            continue
+
+        replicas = annotations[suspended_replicas_annotation]
+
+        if not replicas:
+            continue
+
+        if (worker_budget > 0 and
+                deployment.metadata.labels['component'] == 'dask-worker'):
+            existing = worker_request(deployment) or {}
+
+            requests[deployment.metadata.name] = dict(
+                    replicas=int(replicas), since=time.time(),
+                    weight=existing.get('weight', 1.0))
+
+            continue
+
+        calls.append((resume_deployment, deployment.metadata.name, replicas))
+
+    okay = all(run_concurrently(calls))
+
+    if requests:
+        okay = resume_workers(name, requests) and okay
+
+    return okay
+
+def resume_workers(name, requests):
+    okay = True
+
+    waiting = False
+
+    with admission_lock:
+        targets = {}
+
+        if is_leader():
+            targets, positions = plan_admission(requests, resuming=name)
+
+        for deployment_name, wanted in requests.items():
+            granted = targets.get(deployment_name, (name, 0, wanted))[1]
+
+            try:
+                if is_leader():
+                    admit_replicas(deployment_name, granted, wanted)
+                else:
+                    queue_request(deployment_name, wanted)
+
+            except Exception as e:
+                print('ERROR: Could not resume deployment %s: %s' %
+                        (deployment_name, e))
+
+                okay = False
+
+            waiting = waiting or granted < wanted['replicas']
+
+    if waiting:
+        print('INFO: queued request for workers to resume dask cluster %s.' %
+                name)
+
+        admission_queue.add_after('workers', 30.0)
+
+    return okay
+
+def delete_cluster(name):
+    scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+
+    # Only need to delete the service as deployments for the scheduler
+    # and workers have owner reference set to that for the service, so
+    # when delete the service, the deployments will also be deleted.
+
+    try:
+        delete_options = {
+            "kind": "DeleteOptions",
+            "apiVersion": "v1",
+            "propagationPolicy": "Foreground"
+        }
+
+        service_resource.delete(namespace=namespace,
+                name=scheduler_name, body=delete_options)
+
+    except ApiException as e:
+        if e.status != 404:
+            print('ERROR: Could not delete cluster %s: %s' %
+                    (scheduler_name, e))
+
+            cluster_operations.labels('delete', 'failure').inc()
+
+            return False
+
+    except Exception as e:
+        print('ERROR: Could not delete cluster %s: %s' %
+                (scheduler_name, e))
+
+        cluster_operations.labels('delete', 'failure').inc()
+
+        return False
+
+    cluster_operations.labels('delete', 'success').inc()
+
+    return True
+
+# Activity of each cluster is determined from the task counts reported
+# by the scheduler's dashboard. The schedulers of all clusters are queried
+# concurrently once per activity check, with the results kept so that other
+# parts of the controller can use them without querying again. When the
+# workers of a cluster whose notebook is still running have had nothing
+# to do for the idle worker timeout, the workers alone are suspended. If
+# tasks are later submitted to a cluster with suspended workers, they are
+# resumed.
+
+idle_worker_timeout = int(os.environ.get('DASK_IDLE_WORKER_TIMEOUT', '1800'))
+
+scheduler_request_timeout = float(os.environ.get(
+        'DASK_SCHEDULER_REQUEST_TIMEOUT', '5'))
+
+scheduler_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(os.environ.get('DASK_SCHEDULER_REQUEST_WORKERS', '20')))
+
+scheduler_metrics = {}
+
+cluster_activity = {}
+
+def fetch_scheduler_json(name, path, data=None, timeout=None):
+    url = 'http://%s-scheduler-%s:8787%s' % (dask_cluster_name, name, path)
+
+    if data is not None:
+        data = json.dumps(data).encode('utf-8')
+
+    req = urllib.request.Request(url, data=data,
+            headers={'Content-Type': 'application/json'})
+
+    with urllib.request.urlopen(req,
+            timeout=timeout or scheduler_request_timeout) as fp:
+        return json.loads(fp.read().decode('utf-8'))
+
+def fetch_scheduler_metrics(names):
+    futures = dict((name, scheduler_executor.submit(fetch_scheduler_json,
+            name, '/json/counts.json')) for name in names)
+
+    now = time.time()
+
+    for name, future in futures.items():
+        try:
+            scheduler_metrics[name] = (now, future.result())
+
+        except Exception:
+            scheduler_metrics.pop(name, None)
+
+    for name in list(scheduler_metrics):
+        if name not in futures:
+            del scheduler_metrics[name]
+
+def check_cluster_activity(names, now):
+    fetch_scheduler_metrics(names)
+
+    for name in list(cluster_activity):
+        if name not in names:
+            del cluster_activity[name]
+
+    for name in names:
+        if name not in scheduler_metrics:
+            continue
+
+        counts = scheduler_metrics[name][1]
+
+        busy = any(counts.get(key) for key in
+                ('processing', 'waiting', 'no-worker'))
+
+        signature = tuple(counts.get(key) for key in
+                ('memory', 'released', 'erred', 'tasks'))
+
+        last_active, last_signature = cluster_activity.get(name, (now, None))
+
+        if busy or signature != last_signature:
+            last_active = now
+
+        cluster_activity[name] = (last_active, signature)
+
+        if autoscale_settings(name):
+            continue
+
+        if cluster_suspended(name):
+            if busy:
+                print('INFO: resuming workers of dask cluster %s.' % name)
+
+                resume_cluster(name)
+
+        elif now - last_active > idle_worker_timeout:
+            print('INFO: suspending workers of dask cluster %s.' % name)
+
+            suspend_cluster(name, workers_only=True)
+
+# Adaptive scaling of workers. Users opt in through the autoscale route,
+# with their minimum and maximum worker counts kept in an annotation on
+# the worker deployment. The scheduler of each such cluster is polled and
+# a target worker count computed from the backlog of tasks relative to
+# the number of worker threads, and from worker memory use relative to a
+# target fraction of the memory limit. Scaling up happens as soon as the
+# target rises, but scaling down only once the target has stayed lower
+# for the down delay, and then only to the highest target seen over that
+# period. No change is made within the cooldown period of a prior one.
+
+autoscale_annotation = 'dask-controller/autoscale'
+
+autoscale_interval = float(os.environ.get('DASK_AUTOSCALE_INTERVAL', '5'))
+autoscale_cooldown = float(os.environ.get('DASK_AUTOSCALE_COOLDOWN', '30'))
+autoscale_down_delay = float(os.environ.get('DASK_AUTOSCALE_DOWN_DELAY', '120'))
+
+autoscale_tasks_per_thread = float(os.environ.get(
+        'DASK_AUTOSCALE_TASKS_PER_THREAD', '2'))
+autoscale_memory_target = float(os.environ.get(
+        'DASK_AUTOSCALE_MEMORY_TARGET', '0.6'))
+
+autoscale_history = {}
+autoscale_changed = {}
+
+def autoscale_settings(name):
+    deployment = deployment_informer.get(worker_deployment_name(name))
+
+    if deployment is None:
+        return None
+
+    annotations = deployment.metadata.annotations
+
+    if not annotations or not annotations[autoscale_annotation]:
+        return None
+
+    try:
+        return json.loads(annotations[autoscale_annotation])
+
+    except ValueError:
+        return None
+
+def autoscale_target(counts, identity, current):
+    backlog = sum(counts.get(key) or 0 for key in
+            ('processing', 'waiting', 'no-worker', 'unrunnable'))
+
+    workers = list((identity.get('workers') or {}).values())
+
+    threads = sum(worker.get('nthreads', worker.get('ncores', 1))
+            for worker in workers)
+
+    threads_per_worker = float(threads) / len(workers) if workers else 1.0
+
+    target = int(math.ceil(backlog / (max(threads_per_worker, 1.0) *
+            autoscale_tasks_per_thread)))
+
+    memory = sum((worker.get('metrics') or {}).get('memory', 0)
+            for worker in workers)
+    memory_limit = sum(worker.get('memory_limit') or 0 for worker in workers)
+
+    if memory_limit:
+        fraction = float(memory) / memory_limit
+
+        target = max(target, int(math.ceil(current * fraction /
+                autoscale_memory_target)))
+
+    return target
+
+def autoscale_cluster(name, settings, counts, identity, now):
+    worker_name = worker_deployment_name(name)
+
+    deployment = deployment_informer.get(worker_name)
+
+    if deployment is None:
+        return
+
+    current = deployment.spec.replicas or 0
+
+    maximum = settings.get('maximum', current)
+    minimum = min(settings.get('minimum', 0), maximum)
+
+    target = autoscale_target(counts, identity, current)
+    target = max(minimum, min(target, maximum))
+
+    history = autoscale_history.setdefault(name, collections.deque())
+    history.append((now, target))
+
+    while history and now - history[0][0] > autoscale_down_delay:
+        history.popleft()
+
+    if now - autoscale_changed.get(name, 0) < autoscale_cooldown:
+        return
+
+    if target > current:
+        replicas = target
+
+    elif (target < current and history[0][0] <=
+            now - autoscale_down_delay + autoscale_interval):
+        replicas = max(value for timestamp, value in history)
+
+    else:
+        return
+
+    if replicas == current:
+        return
+
+    print('INFO: autoscaling dask cluster %s from %d to %d workers.' %
+            (name, current, replicas))
+
+    try:
+        if worker_budget > 0:
+            request_workers(name, replicas)
+        else:
+            scale_workers(name, replicas)
+
+    except Exception as e:
+        print('ERROR: Could not autoscale cluster %s: %s' % (name, e))
+
+    else:
+        autoscale_changed[name] = now
+
+def autoscale_clusters():
+    while True:
+        time.sleep(autoscale_interval)
+
+        if not deployment_informer.synced.is_set():
+            continue
+
+        clusters = {}
+
+        for name in deployment_informer.index_values('dask-cluster'):
+            settings = autoscale_settings(name)
+            if settings and owns_cluster(name) and not cluster_suspended(name):
+                clusters[name] = settings
+
+        for name in list(autoscale_history):
+            if name not in clusters:
+                autoscale_history.pop(name, None)
+                autoscale_changed.pop(name, None)
+
+        futures = dict((name, (
+                scheduler_executor.submit(fetch_scheduler_json, name,
+                        '/json/counts.json'),
+                scheduler_executor.submit(fetch_scheduler_json, name,
+                        '/json/identity.json'))) for name in clusters)
+
+        now = time.time()
+
+        for name, (counts, identity) in futures.items():
+            try:
+                counts = counts.result()
+                identity = identity.result()
+
+            except Exception:
+                continue
+
+            scheduler_metrics[name] = (now, counts)
+
+            autoscale_cluster(name, clusters[name], counts, identity, now)
+
+@controller.route('/autoscale', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+def autoscale(user):
+    enabled = request.args.get('enabled', None)
+
+    if enabled is None:
+        return jsonify(autoscale_settings(user['name']) or {})
+
+    if enabled.lower() in ['true', 'yes', 'y', '1']:
+        maximum = int(request.args.get('maximum',
+                max_worker_replicas or worker_replicas))
+
+        if max_worker_replicas > 0:
+            maximum = min(maximum, max_worker_replicas)
+
+        minimum = int(request.args.get('minimum', 1))
+        minimum = max(0, min(minimum, maximum))
+
+        settings = dict(minimum=minimum, maximum=maximum)
+
+        value = json.dumps(settings)
+
+    else:
+        settings = {}
+
+        value = None
+
+    body = {'metadata': {'annotations': {autoscale_annotation: value}}}
+
+    deployment_resource.patch(namespace=namespace,
+            name=worker_deployment_name(user['name']), body=body)
+
+    return jsonify(settings)
+
+# Admission of worker replicas against a budget for the whole namespace,
+# so that users scaling up at once don't leave pods pending against the
+# resource quota. When DASK_WORKER_BUDGET is set, a request for more
+# workers than a cluster has is only granted as far as there is room in
+# the budget, with the rest of the request kept in an annotation on the
+# worker deployment until it can be granted. When room is short, the
+# budget is divided between active clusters by weighted max-min fair
+# sharing of what they ask for, with the weight of a user being the
+# highest priority of their groups. Waiting requests are granted first to
+# the clusters furthest below their share, then in the order made, as
+# room is freed by clusters scaling down, being suspended or being culled.
+# Running workers are never taken away to make room for others.
+
+worker_budget = int(os.environ.get('DASK_WORKER_BUDGET', '0'))
+
+group_priorities = json.loads(os.environ.get('DASK_GROUP_PRIORITIES', '')
+        or '{}')
+
+requested_replicas_annotation = 'dask-controller/requested-replicas'
+
+# Replicas granted by this replica of the controller which the cache may
+# not yet reflect, so that they aren't granted a second time. As this is
+# only known to the replica which made the grants, workers are only
+# granted by the leader when there are several replicas. The others
+# leave their requests waiting for the leader to grant.
+
+admission_lock = threading.Lock()
+admission_grants = {}
+admission_waiting = 0
+
+def user_priority(user):
+    return max([float(group_priorities.get(group, 1.0))
+            for group in user.get('groups') or []] or [1.0])
+
+def worker_request(deployment):
+    annotations = deployment.metadata.annotations
+
+    if not annotations or not annotations[requested_replicas_annotation]:
+        return None
+
+    try:
+        return json.loads(annotations[requested_replicas_annotation])
+
+    except ValueError:
+        return None
+
+def admitted_replicas(deployment):
+    replicas = deployment.spec.replicas or 0
+
+    granted = admission_grants.get(deployment.metadata.name)
+
+    if granted is not None:
+        if granted[0] <= replicas or time.time() - granted[1] > 30.0:
+            admission_grants.pop(deployment.metadata.name, None)
+        else:
+            replicas = granted[0]
+
+    return replicas
+
+def fair_shares(budget, demands):
+    # Weighted max-min fair division of the budget, where demands maps
+    # each cluster to the replicas it wants and its weight.
+
+    shares = dict((name, 0.0) for name in demands)
+
+    remaining = set(name for name, (demand, weight) in demands.items()
+            if demand > 0 and weight > 0)
+
+    capacity = float(budget)
+
+    while remaining and capacity > 1e-9:
+        unit = capacity / sum(demands[name][1] for name in remaining)
+
+        satisfied = [name for name in remaining if demands[name][0] -
+                shares[name] <= unit * demands[name][1]]
+
+        if not satisfied:
+            for name in remaining:
+                shares[name] += unit * demands[name][1]
+            break
+
+        for name in satisfied:
+            capacity -= demands[name][0] - shares[name]
+            shares[name] = float(demands[name][0])
+            remaining.discard(name)
+
+    return shares
+
+def plan_admission(requests={}, resuming=None):
+    # Works out from the cache which waiting requests can be granted now,
+    # with requests overriding those in the cache for the deployments
+    # given. Returns the replicas each granted deployment should have, and
+    # the position in the queue of each request left waiting. The cluster
+    # being resumed, if any, is included though still suspended, as are
+    # workers granted to clusters resumed which the cache may still show
+    # as suspended.
+
+    global admission_waiting
+
+    clusters = {}
+
+    for name in deployment_informer.index_values('dask-cluster'):
+        suspended = name != resuming and cluster_suspended(name)
+
+        for deployment in deployment_informer.by_index('dask-cluster', name):
+            if deployment.metadata.labels['component'] != 'dask-worker':
+                continue
+
+            deployment_name = deployment.metadata.name
+
+            if suspended and deployment_name not in admission_grants:
+                continue
+
+            request = requests.get(deployment_name, worker_request(deployment))
+
+            clusters.setdefault(name, []).append((deployment_name,
+                    admitted_replicas(deployment), request))
+
+    demands = {}
+    usage = {}
+
+    for name, entries in clusters.items():
+        usage[name] = sum(current for _, current, _ in entries)
+
+        demand = sum(max(current, request and request['replicas'] or 0)
+                for _, current, request in entries)
+
+        weight = max([request.get('weight', 1.0) for _, _, request in
+                entries if request] or [1.0])
+
+        demands[name] = (demand, weight)
+
+    shares = fair_shares(worker_budget, demands)
+
+    free = worker_budget - sum(usage.values())
+
+    pending = [(name, deployment_name, current, request)
+            for name, entries in clusters.items()
+            for deployment_name, current, request in entries
+            if request and request['replicas'] > current]
+
+    def priority(item):
+        name, deployment_name, current, request = item
+        share = shares.get(name, 0.0)
+        return (usage[name] / share if share else float('inf'),
+                request.get('since', 0.0), deployment_name)
+
+    pending.sort(key=priority)
+
+    grants = {}
+    allocated = dict(usage)
+
+    # Room is first granted up to the fair share of each cluster, and any
+    # left over then goes to the same queue regardless of share.
+
+    for within_share in (True, False):
+        for name, deployment_name, current, request in pending:
+            limit = free
+
+            if within_share:
+                limit = min(limit, int(math.floor(shares[name] -
+                        allocated[name] + 1e-9)))
+
+            grant = min(request['replicas'] - current -
+                    grants.get(deployment_name, 0), limit)
+
+            if grant > 0:
+                grants[deployment_name] = grants.get(deployment_name, 0) + grant
+                allocated[name] += grant
+                free -= grant
+
+    targets = {}
+    positions = {}
+
+    for name, deployment_name, current, request in pending:
+        replicas = current + grants.get(deployment_name, 0)
+
+        if deployment_name in grants:
+            targets[deployment_name] = (name, replicas, request)
+
+        if replicas < request['replicas']:
+            positions[deployment_name] = len(positions) + 1
+
+    admission_waiting = len(positions)
+
+    return targets, positions
+
+def admit_replicas(deployment_name, replicas, request):
+    # Sets the replicas of the deployment, with the request only kept if
+    # it is still waiting to be granted in full. A deployment being resumed
+    # stops being marked as suspended.
+
+    body = {
+        'metadata': {
+            'annotations': {
+                requested_replicas_annotation: json.dumps(request)
+                        if request and replicas < request['replicas']
+                        else None,
+                suspended_replicas_annotation: None
+            }
+        },
+        'spec': {
+            'replicas': replicas
         }
     }
-}
-""")
 
-def create_cluster(name):
-    scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+    deployment_resource.patch(namespace=namespace, name=deployment_name,
+            body=body)
 
-    worker_name = '%s-worker-%s' % (dask_cluster_name, name)
+    admission_grants[deployment_name] = (replicas, time.time())
 
-    try:
-        text = scheduler_service_template.safe_substitute(
-                namespace=namespace, name=scheduler_name,
-                application=jupyterhub_name)
+def queue_request(deployment_name, request):
+    # Leaves the request waiting for the leader to grant, without changing
+    # the replicas of the deployment, which the leader may have changed.
 
-        body = json.loads(text)
+    body = {
+        'metadata': {
+            'annotations': {
+                requested_replicas_annotation: json.dumps(request),
+                suspended_replicas_annotation: None
+            }
+        }
+    }
 
-        service = service_resource.create(namespace=namespace, body=body)
+    deployment_resource.patch(namespace=namespace, name=deployment_name,
+            body=body)
 
-    except ApiException as e:
-        if e.status != 409:
-            print('ERROR: Error creating service. %s' % e)
-            return
+def request_workers(name, replicas, pool=None, weight=None):
+    worker_name = cluster_worker_pools(name)[pool or default_worker_pool]
+
+    deployment = deployment_informer.get(worker_name)
+
+    if deployment is None:
+        return scale_workers(name, replicas, pool)
+
+    existing = worker_request(deployment)
+
+    current = admitted_replicas(deployment)
+
+    # Scaling down is never held back, and withdraws any waiting request.
+
+    if replicas <= current:
+        admission_grants.pop(worker_name, None)
+
+        if existing:
+            deployment_resource.patch(namespace=namespace, name=worker_name,
+                    body={'metadata': {'annotations':
+                    {requested_replicas_annotation: None}}})
+
+        result = scale_workers(name, replicas, pool)
+
+        result.update(requested=replicas, granted=replicas, position=0)
+
+        return result
+
+    request = dict(replicas=replicas, since=time.time(), weight=weight or
+            (existing and existing.get('weight')) or 1.0)
+
+    if existing:
+        request['since'] = existing.get('since', request['since'])
+
+    with admission_lock:
+        if not is_leader():
+            queue_request(worker_name, request)
+
+            return dict(replicas=current, requested=replicas,
+                    granted=current, position=0, retired=0, moved_bytes=0,
+                    retire_seconds=0.0)
+
+        # The cache may not yet show that the cluster has been resumed.
+
+        targets, positions = plan_admission({worker_name: request},
+                resuming=name)
+
+        granted = targets.get(worker_name, (name, current, request))[1]
+
+        admit_replicas(worker_name, granted, request)
+
+    if granted < replicas:
+        print('INFO: queued request for %d workers for dask cluster %s, '
+                'granted %d.' % (replicas, name, granted))
+
+        admission_queue.add_after('workers', 30.0)
+
+    return dict(replicas=granted, requested=replicas, granted=granted,
+            position=positions.get(worker_name, 0), retired=0,
+            moved_bytes=0, retire_seconds=0.0)
+
+def admit_waiting(key):
+    if not deployment_informer.synced.is_set():
+        return False
+
+    # Replicas other than the leader keep looking while there are requests
+    # waiting, in case they become the leader.
+
+    if not is_leader():
+        if any(worker_request(deployment) for deployment in
+                deployment_informer.items()):
+            admission_queue.add_after(key, 30.0)
+
+        return True
+
+    with admission_lock:
+        targets, positions = plan_admission()
+
+        for deployment_name, (name, replicas, wanted) in targets.items():
+            print('INFO: granting %d workers to dask cluster %s.' % (
+                    replicas, name))
 
-        else:
             try:
-                service = service_resource.get(namespace=namespace,
-                        name=scheduler_name)
+                admit_replicas(deployment_name, replicas, wanted)
 
-            except Exception as e:
-                print('ERROR: Error querying service. %s' % e)
-                return
+            except ApiException as e:
+                if e.status != 404:
+                    print('ERROR: Could not grant workers to cluster %s: %s' %
+                            (name, e))
 
-    except Exception as e:
-        print('ERROR: Error creating service. %s' % e)
+    # Requests are looked at again every so often, in case room was freed
+    # by a change this replica missed.
+
+    if positions:
+        admission_queue.add_after(key, 30.0)
+
+    return True
+
+admission_queue = WorkQueue('admission', admit_waiting,
+        qps=reconcile_qps, burst=reconcile_burst)
+
+def worker_capacity_changed(event_type, deployment):
+    labels = deployment.metadata.labels
+
+    if worker_budget <= 0 or not labels:
         return
 
-    try:
-        text = worker_deployment_template.safe_substitute(
-                namespace=namespace, name=worker_name,
-                application=jupyterhub_name, cluster=name,
-                scheduler=scheduler_name, replicas=worker_replicas,
-                memory=worker_memory, owner=service.metadata.name,
-                owner_uid=service.metadata.uid)
+    if labels['component'] == 'dask-worker':
+        if admission_waiting or worker_request(deployment):
+            admission_queue.add('workers')
 
-        body = json.loads(text)
+deployment_informer.add_handler(worker_capacity_changed)
 
-        deployment_resource.create(namespace=namespace, body=body)
+@controller.route('/admission', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def admission(user):
+    with admission_lock:
+        targets, positions = plan_admission()
 
-    except ApiException as e:
-        if e.status != 409:
-            print('ERROR: Error creating worker deployment. %s' % e)
+    return jsonify(budget=worker_budget, used=count_worker_replicas(),
+            waiting=positions, priorities=group_priorities)
 
-    except Exception as e:
-        print('ERROR: Error creating worker deployment. %s' % e)
+# The time from which a cluster has been idle, that is, without a running
+# notebook, is kept in an annotation on its scheduler service, so that it
+# survives the controller being restarted or the cluster moving to a
+# different replica. Each cluster is looked at when its notebook starts
+# or stops, when it is first seen, and then only when its next deadline
+# to be suspended or deleted is due, using a delayed add to a work queue
+# whose workers bound how many clusters are suspended or deleted at once.
 
-    try:
-        text = scheduler_deployment_template.safe_substitute(
-                namespace=namespace, name=scheduler_name,
-                application=jupyterhub_name, cluster=name,
-                owner=service.metadata.name, owner_uid=service.metadata.uid)
+idle_since_annotation = 'dask-controller/idle-since'
 
-        body = json.loads(text)
+cull_workers = int(os.environ.get('DASK_CULL_WORKERS', '5'))
 
-        deployment_resource.create(namespace=namespace, body=body)
+def set_idle_since(name, timestamp):
+    service_name = '%s-scheduler-%s' % (dask_cluster_name, name)
 
-    except ApiException as e:
-        if e.status != 409:
-            print('ERROR: Error creating scheduler deployment. %s' % e)
+    value = None if timestamp is None else '%.3f' % timestamp
 
-    except Exception as e:
-        print('ERROR: Error creating scheduler deployment. %s' % e)
+    body = {'metadata': {'annotations': {idle_since_annotation: value}}}
 
-def cluster_exists(name):
     try:
-        scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
-
-        deployment_resource.get(namespace=namespace, name=scheduler_name)
+        service_resource.patch(namespace=namespace, name=service_name,
+                body=body)
 
     except ApiException as e:
         if e.status == 404:
+            return True
+
+        print('ERROR: Could not update service %s: %s' % (service_name, e))
+
+        return False
+
+    return True
+
+def cull_cluster(name):
+    if not owns_cluster(name):
+        return True
+
+    if not (pod_informer.synced.is_set() and
+            deployment_informer.synced.is_set() and
+            service_informer.synced.is_set()):
+        cull_queue.add_after(name, 5.0)
+        return True
+
+    notebook = pod_informer.by_index('notebook', name)
+
+    if notebook:
+        provisioned_at.pop(name, None)
+
+    service = service_informer.get('%s-scheduler-%s' % (
+            dask_cluster_name, name))
+
+    if service is None or not deployment_informer.by_index(
+            'dask-cluster', name):
+        return True
+
+    annotations = service.metadata.annotations
+
+    idle_since = annotations and annotations[idle_since_annotation]
+
+    if notebook:
+        if idle_since:
+            return set_idle_since(name, None)
+
+        return True
+
+    now = time.time()
+
+    started = provisioned_at.get(name)
+
+    if started is not None and not idle_since:
+        if now - started < spawn_timeout:
+            cull_queue.add_after(name, started + spawn_timeout - now)
+            return True
+
+        provisioned_at.pop(name, None)
+
+    if not idle_since:
+        if not set_idle_since(name, now):
             return False
 
-        print('ERROR: Error querying deployment config. %s' % e)
+        idle_since = now
+
+    idle_since = float(idle_since)
+
+    if idle_delete_timeout > idle_timeout:
+        if now - idle_since >= idle_delete_timeout:
+            print('INFO: deleting dask cluster %s.' % name)
+
+            return delete_cluster(name)
+
+        if now - idle_since >= idle_timeout:
+            if not cluster_suspended(name):
+                print('INFO: suspending dask cluster %s.' % name)
+
+                if not suspend_cluster(name):
+                    return False
+
+            deadline = idle_since + idle_delete_timeout
+
+        else:
+            deadline = idle_since + idle_timeout
+
+    elif now - idle_since >= idle_timeout:
+        print('INFO: deleting dask cluster %s.' % name)
+
+        return delete_cluster(name)
 
     else:
-        return True
+        deadline = idle_since + idle_timeout
 
-def new_notebook_added(pod):
-    annotations = pod.metadata.annotations
+    cull_queue.add_after(name, deadline - now)
 
-    if annotations:
-        name = annotations['jupyteronopenshift.org/dask-cluster']
-        if name:
-            found = cluster_exists(name)
-            if found is not None and not found:
-                create_cluster(name)
+    return True
+
+# With clusters culled as their deadlines pass rather than in a periodic
+# cycle, how promptly the culler keeps up is measured by the time each
+# cluster waits in the queue and is processed, from being queued to done.
+
+cull_latency_seconds = Histogram('dask_controller_cull_latency_seconds',
+        'Time from a cluster being queued for culling to being processed.',
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
 
-def monitor_pods():
-    watcher = Watch()
-    for item in watcher.stream(pod_resource.get,
-            namespace=namespace, timeout_seconds=0,
-            serialize=False):
+cull_queue = WorkQueue('cull', cull_cluster, workers=cull_workers,
+        qps=reconcile_qps, burst=reconcile_burst,
+        latency=cull_latency_seconds)
 
-        if item['type'] == 'ADDED':
-            pod = ResourceInstance(pod_resource, item['object'])
-            labels = pod.metadata.labels
-            if labels['app'] == jupyterhub_name:
-                if labels['component'] == 'singleuser-server':
-                    new_notebook_added(pod)
+def notebook_changed(event_type, pod):
+    if event_type in ('ADDED', 'DELETED'):
+        annotations = pod.metadata.annotations
 
-thread1 = threading.Thread(target=monitor_pods)
-thread1.set_daemon = True
-thread1.start()
+        if annotations:
+            name = annotations['jupyteronopenshift.org/dask-cluster']
+            if name and owns_cluster(name):
+                cull_queue.add(name)
 
-active_clusters = {}
+pod_informer.add_handler(notebook_changed)
 
-def cull_clusters():
+def cluster_added(event_type, deployment):
+    if event_type == 'ADDED':
+        labels = deployment.metadata.labels
 
+        if labels:
+            name = labels['dask-cluster']
+            if name and owns_cluster(name):
+                cull_queue.add(name)
+
+deployment_informer.add_handler(cluster_added)
+
+# Activity of the clusters whose notebooks are running still needs their
+# schedulers to be polled, which is done periodically.
+
+activity_interval = float(os.environ.get('DASK_ACTIVITY_INTERVAL', '30'))
+
+activity_cycle_seconds = Histogram('dask_controller_activity_cycle_seconds',
+        'Duration of each check of the activity of clusters.')
+
+def activity_cycle():
+    names = set(name for name in pod_informer.index_values('notebook')
+            if owns_cluster(name) and deployment_informer.by_index(
+                    'dask-cluster', name))
+
+    check_cluster_activity(names, time.time())
+
+def monitor_activity():
     while True:
+        time.sleep(activity_interval)
+
+        if not (deployment_informer.synced.is_set() and
+                pod_informer.synced.is_set()):
+            continue
+
+        with activity_cycle_seconds.time():
+            activity_cycle()
+
+# Vertical sizing of schedulers. The memory used by the scheduler of each
+# cluster, as reported by the scheduler's own metrics, is checked against
+# the memory limit of its pod, and scheduler containers killed for using
+# too much memory are looked for in the status of the pod. When the
+# scheduler of a user's cluster is killed, or is seen near its limit too
+# many times, the user is moved to the next larger memory tier. The tier
+# of each user is kept in a config map, so that it survives the cluster
+# being culled and the controller being restarted, and is used when the
+# user's cluster is next created. The scheduler is only restarted with
+# the larger limit straight away if it has just been killed, as then it
+# has lost its state anyway. Otherwise the new limit takes effect when
+# the scheduler next restarts, so that running work is never lost to a
+# resize. Users who have never got close to the limit of their profile
+# keep it, and are never moved down, other than by an admin.
+
+scheduler_memory_tiers = [tier.strip() for tier in os.environ.get(
+        'DASK_SCHEDULER_MEMORY_TIERS', '512Mi,1Gi,2Gi,4Gi').split(',')
+        if tier.strip()]
+
+scheduler_memory_tiers.sort(key=parse_quantity)
+
+scheduler_memory_interval = float(os.environ.get(
+        'DASK_SCHEDULER_MEMORY_INTERVAL', '60'))
+scheduler_memory_high = float(os.environ.get(
+        'DASK_SCHEDULER_MEMORY_HIGH', '0.8'))
+scheduler_memory_strikes = int(os.environ.get(
+        'DASK_SCHEDULER_MEMORY_STRIKES', '3'))
+
+# The tiers are reread from the config map after this many seconds, to see
+# changes made by other controller replicas.
+
+scheduler_sizes_ttl = float(os.environ.get('DASK_SCHEDULER_SIZES_TTL', '60'))
+
+scheduler_sizes_name = '%s-scheduler-sizes' % dask_cluster_name
+
+scheduler_sizes_lock = threading.Lock()
+
+scheduler_sizes = {}
+scheduler_sizes_loaded = None
+
+scheduler_memory_near = {}
+scheduler_restarts = {}
+
+scheduler_memory_resizes = Counter(
+        'dask_controller_scheduler_memory_resizes_total',
+        'Users moved to a larger scheduler memory tier.', ['reason'])
+
+def load_scheduler_sizes():
+    global scheduler_sizes_loaded
+
+    with scheduler_sizes_lock:
+        if (scheduler_sizes_loaded is not None and
+                time.time() - scheduler_sizes_loaded < scheduler_sizes_ttl):
+            return
+
         try:
-            deployments = deployment_resource.get(namespace=namespace)
+            config_map = config_map_resource.get(namespace=namespace,
+                    name=scheduler_sizes_name)
+
+            sizes = config_map.to_dict().get('data') or {}
+
+        except ApiException as e:
+            if e.status != 404:
+                print('ERROR: Could not read scheduler sizes. %s' % e)
+                return
+
+            sizes = {}
 
         except Exception as e:
-            print('ERROR: Cannot query deployments.')
+            print('ERROR: Could not read scheduler sizes. %s' % e)
+            return
 
-        else:
-            for deployment in deployments.items:
-                metadata = deployment.metadata
-                if metadata:
-                    labels = metadata.labels
-                    if labels['component'] == 'dask-scheduler':
-                        name = labels['dask-cluster']
-                        if name:
-                            active_clusters.setdefault(name, None)
+        scheduler_sizes.clear()
+        scheduler_sizes.update(sizes)
+
+        scheduler_sizes_loaded = time.time()
+
+def save_scheduler_size(name, memory):
+    body = {'data': {name: memory}}
 
+    try:
         try:
-            pods = pod_resource.get(namespace=namespace)
+            config_map_resource.patch(namespace=namespace,
+                    name=scheduler_sizes_name, body=body)
 
-        except Exception as e:
-            print('ERROR: Cannot query pods.')
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+            body['metadata'] = {'name': scheduler_sizes_name,
+                    'labels': {'app': jupyterhub_name}}
+
+            body['data'] = dict((key, value) for key, value in
+                    body['data'].items() if value is not None)
 
+            config_map_resource.create(namespace=namespace, body=body)
+
+    except Exception as e:
+        print('ERROR: Could not save scheduler size of %s. %s' % (name, e))
+        return False
+
+    with scheduler_sizes_lock:
+        if memory is None:
+            scheduler_sizes.pop(name, None)
         else:
-            for pod in pods.items:
-                metadata = pod.metadata
-                if metadata:
-                    annotations = metadata.annotations
-                    name = annotations['jupyteronopenshift.org/dask-cluster']
+            scheduler_sizes[name] = memory
 
-                    if name and name in active_clusters:
-                        del active_clusters[name]
+    return True
 
-        now = time.time()
+def scheduler_memory_limit(name, settings):
+    """Returns the memory limit for the scheduler of a cluster, which is
+    the larger of that of the profile and of the tier of the user.
 
-        for name, timestamp in list(active_clusters.items()):
-            if timestamp is None:
-                active_clusters[name] = now
+    """
 
-            else:
-                if now - timestamp > idle_timeout:
-                    print('INFO: deleting dask cluster %s.' % name)
+    memory = settings['scheduler_memory_limit']
 
-                    okay = True
+    if not scheduler_memory_tiers:
+        return memory
 
-                    scheduler_name = '%s-scheduler-%s' % (dask_cluster_name, name)
+    load_scheduler_sizes()
 
-                    # Only need to delete the service as deployments for
-                    # the scheduler and workers have owner reference set
-                    # to that for the service, so when delete the
-                    # service, the deployments will also be deleted.
+    tier = scheduler_sizes.get(name)
 
-                    try:
-                        delete_options = {
-                            "kind": "DeleteOptions",
-                            "apiVersion": "v1",
-                            "propagationPolicy": "Foreground"
-                        }
+    if tier and (not memory or parse_quantity(tier) >
+            parse_quantity(memory)):
+        return tier
+
+    return memory
+
+def grow_scheduler_memory(name, reason):
+    settings = cluster_settings(name)
+
+    current = scheduler_memory_limit(name, settings)
+
+    larger = [tier for tier in scheduler_memory_tiers if not current or
+            parse_quantity(tier) > parse_quantity(current)]
+
+    scheduler_memory_near.pop(name, None)
+
+    if not larger:
+        print('INFO: scheduler of dask cluster %s is at the largest memory '
+                'tier %s.' % (name, current))
+        return False
+
+    print('INFO: moving dask cluster %s from scheduler memory %s to %s, '
+            'as %s.' % (name, current, larger[0], reason))
+
+    if not save_scheduler_size(name, larger[0]):
+        return False
+
+    scheduler_memory_resizes.labels(reason).inc()
+
+    return True
+
+def apply_scheduler_memory(name):
+    scheduler_name = scheduler_deployment_name(name)
+
+    deployment = deployment_informer.get(scheduler_name)
+
+    if deployment is None:
+        return True
+
+    settings = cluster_settings(name)
+
+    memory = scheduler_memory_limit(name, settings)
+
+    for container in deployment.spec.template.spec.containers:
+        if container.name == 'scheduler':
+            limits = container.resources and container.resources.limits
+
+            if limits and limits['memory'] == memory:
+                return True
+
+    print('INFO: restarting scheduler of dask cluster %s with memory %s.' %
+            (name, memory))
+
+    body = {'spec': {'template': {'spec': {'containers': [{
+            'name': 'scheduler', 'resources': {'limits': {'memory': memory}}
+    }]}}}}
+
+    try:
+        deployment_resource.patch(namespace=namespace, name=scheduler_name,
+                body=body)
+
+    except Exception as e:
+        print('ERROR: Could not resize scheduler %s. %s' % (scheduler_name,
+                e))
+        return False
+
+    return True
+
+def fetch_scheduler_memory(name):
+    """Returns the resident memory of the scheduler process, from the
+    Prometheus metrics of the scheduler dashboard.
+
+    """
+
+    url = 'http://%s-scheduler-%s:8787/metrics' % (dask_cluster_name, name)
+
+    with urllib.request.urlopen(url,
+            timeout=scheduler_request_timeout) as fp:
+        for line in fp.read().decode('utf-8').splitlines():
+            if line.startswith('process_resident_memory_bytes '):
+                return float(line.split()[1])
+
+def check_scheduler_memory(names):
+    pods = {}
+
+    for name in names:
+        for pod in pod_informer.by_index('deployment',
+                scheduler_deployment_name(name)):
+            if pod.status.phase == 'Running':
+                pods[name] = pod
+
+    futures = dict((name, scheduler_executor.submit(fetch_scheduler_memory,
+            name)) for name in pods)
+
+    for name in list(scheduler_memory_near):
+        if name not in names:
+            del scheduler_memory_near[name]
+
+    for name, pod in pods.items():
+        limit = None
+
+        for container in pod.spec.containers:
+            if container.name == 'scheduler':
+                limits = container.resources and container.resources.limits
+                limit = limits and limits['memory']
+
+        for status in pod.status.containerStatuses or []:
+            if status.name != 'scheduler':
+                continue
+
+            restarts = status.restartCount or 0
+
+            previous = scheduler_restarts.get(pod.metadata.name)
+
+            scheduler_restarts[pod.metadata.name] = restarts
+
+            if previous is not None and restarts <= previous:
+                continue
+
+            terminated = status.lastState and status.lastState.terminated
+
+            killed = terminated and terminated.reason == 'OOMKilled'
+
+            # A kill at a limit lower than the one now wanted for the user
+            # is one which has already been acted on, such as before the
+            # controller was restarted.
+
+            if killed:
+                wanted = scheduler_memory_limit(name, cluster_settings(name))
+
+                if (not limit or not wanted or parse_quantity(limit) >=
+                        parse_quantity(wanted)):
+                    grow_scheduler_memory(name, 'killed')
+
+            # Having restarted since last looked at, the scheduler has lost
+            # its state, so may as well be given any larger limit now.
+
+            if previous is not None or killed:
+                apply_scheduler_memory(name)
+
+        if not limit:
+            continue
+
+        try:
+            used = futures[name].result()
+
+        except Exception:
+            continue
+
+        if used is None:
+            continue
+
+        if used >= scheduler_memory_high * parse_quantity(limit):
+            count = scheduler_memory_near.get(name, 0) + 1
+
+            scheduler_memory_near[name] = count
+
+            print('INFO: scheduler of dask cluster %s using %d of %s of '
+                    'memory.' % (name, used, limit))
+
+            if count >= scheduler_memory_strikes:
+                grow_scheduler_memory(name, 'near-limit')
+
+    for pod_name in list(scheduler_restarts):
+        if not pod_informer.get(pod_name):
+            del scheduler_restarts[pod_name]
+
+def monitor_scheduler_memory():
+    while True:
+        time.sleep(scheduler_memory_interval)
+
+        if not (deployment_informer.synced.is_set() and
+                pod_informer.synced.is_set()):
+            continue
+
+        names = set(name for name in
+                deployment_informer.index_values('dask-cluster')
+                if owns_cluster(name))
+
+        check_scheduler_memory(names)
+
+@controller.route('/scheduler-memory', methods=['GET', 'OPTIONS', 'POST'])
+@authenticated_user
+@admin_users_only
+def scheduler_memory(user):
+    name = request.args.get('user')
+
+    if name is not None:
+        memory = request.args.get('memory') or None
+
+        if memory is not None and memory not in scheduler_memory_tiers:
+            abort(400)
+
+        if not save_scheduler_size(name, memory):
+            abort(503)
+
+    load_scheduler_sizes()
+
+    return jsonify(tiers=scheduler_memory_tiers, sizes=scheduler_sizes,
+            near_limit=scheduler_memory_near)
+
+def count_worker_replicas():
+    replicas = 0
+
+    for name in deployment_informer.index_values('dask-cluster'):
+        replicas += cluster_worker_replicas(name)
+
+    return replicas
+
+Gauge('dask_controller_active_clusters',
+        'Number of Dask clusters.').set_function(
+        lambda: len(deployment_informer.index_values('dask-cluster')))
+
+Gauge('dask_controller_worker_replicas',
+        'Total worker replicas across all Dask clusters.').set_function(
+        count_worker_replicas)
+
+Gauge('dask_controller_owned_clusters',
+        'Number of Dask clusters owned by this replica.').set_function(
+        lambda: sum(1 for name in deployment_informer.index_values(
+                'dask-cluster') if owns_cluster(name)))
+
+Gauge('dask_controller_leader',
+        'Whether this replica is the leader.').set_function(
+        lambda: 1 if is_leader() else 0)
+
+Gauge('dask_controller_pending_provisioning',
+        'Clusters queued or being provisioned.').set_function(
+        lambda: sum(reconcile_queue.status()[key] for key in
+                ('depth', 'delayed', 'processing')))
+
+# The metrics are left unauthenticated, as is usual for a Prometheus
+# scrape target, as they contain no user data.
+
+@controller.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+# Readiness of the controller. Requests are served as soon as the module
+# is loaded, but until the informer caches are synchronised, requests
+# which need them will wait or fail, so report not ready till then. The
+# startup timings and the state of the API discovery cache are included
+# to show where the time to become ready went.
+
+@controller.route('/ready', methods=['GET'])
+def ready():
+    informers = dict((informer.resource.kind, informer.synced.is_set())
+            for informer in (pod_informer, deployment_informer,
+            service_informer))
+
+    synced = all(informers.values())
+
+    details = dict(ready=synced, informers=informers,
+            uptime=time.time() - startup_started, startup=startup_timings,
+            discovery=api_resources.status())
+
+    return jsonify(details), synced and 200 or 503
+
+application.register_blueprint(controller, url_prefix=prefix.rstrip('/'))
+
+reconcile_queue.start()
+registration_queue.start()
+cull_queue.start()
+
+if worker_budget > 0:
+    admission_queue.start()
+
+if idle_worker_timeout > 0:
+    thread = threading.Thread(target=monitor_activity)
+    thread.daemon = True
+    thread.start()
+
+if warm_pool_size > 0:
+    thread = threading.Thread(target=fill_pool)
+    thread.daemon = True
+    thread.start()
+
+thread = threading.Thread(target=autoscale_clusters)
+thread.daemon = True
+thread.start()
+
+if scheduler_memory_tiers:
+    thread = threading.Thread(target=monitor_scheduler_memory)
+    thread.daemon = True
+    thread.start()
+
+pod_informer.start()
+deployment_informer.start()
+service_informer.start()
+
+# Release the leases of the replica when the process exits, such as when
+# mod_wsgi is shut down or restarted, so the other replicas take over its
+# clusters straight away rather than when the leases expire.
 
-                        service_resource.delete(namespace=namespace,
-                                name=scheduler_name, body=delete_options)
+if membership is not None:
+    membership.start()
 
-                    except ApiException as e:
-                        if e.status != 404:
-                            okay = False
+    atexit.register(membership.stop)
 
-                            print('ERROR: Could not delete cluster %s: %s' %
-                                    (scheduler_name, e))
+# Report how long startup took once the caches are synchronised. Loading
+# of the module completes, and requests can be served, before that.
 
-                    except Exception as e:
-                        okay = False
+def report_startup():
+    for informer in (pod_informer, deployment_informer, service_informer):
+        informer.wait_for_sync()
 
-                        print('ERROR: Could not delete cluster %s: %s' %
-                                (scheduler_name, e))
+    record_startup('ready')
 
-                    if okay:
-                        del active_clusters[name]
+    print('INFO: Startup timings %s.' % json.dumps(startup_timings))
 
-        time.sleep(30.0)
+thread = threading.Thread(target=report_startup)
+thread.daemon = True
+thread.start()
 
-thread2 = threading.Thread(target=cull_clusters)
-thread2.set_daemon = True
-thread2.start()
+record_startup('loaded')
@@ -0,0 +1,125 @@
+"""Fixtures for testing the Dask controller without a cluster or a hub.
+
+The controller is loaded against the in-process fake of the Kubernetes API
+server and JupyterHub used by the benchmark, with a fresh fake API server
+and a fresh copy of the controller module for each test which asks for one.
+
+"""
+
+import os
+import sys
+import time
+import threading
+import importlib.util
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(here, '..', 'benchmark'))
+
+import fake_kubernetes
+
+controller_path = os.path.join(here, '..', 'jupyterhub', 'dask-controller.py')
+
+loaded = []
+
+def reset_metrics():
+    # Every copy of the controller registers the same metrics in the
+    # default registry, so clear it before loading another.
+
+    from prometheus_client import REGISTRY
+
+    for collector in list(REGISTRY._collector_to_names):
+        REGISTRY.unregister(collector)
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+
+    return condition()
+
+class Sampler(object):
+
+    """Samples the worker replicas of all clusters held by the fake API
+    server in the background, keeping the highest seen.
+
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.peak = self.replicas()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def replicas(self):
+        with self.server.condition:
+            return sum(deployment['spec'].get('replicas', 0)
+                    for deployment in self.server.objects['Deployment'].values()
+                    if deployment['metadata']['labels'].get('component')
+                    == 'dask-worker')
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.replicas())
+            time.sleep(0.001)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.replicas())
+
+@pytest.fixture
+def load_controller(tmpdir, monkeypatch):
+    def load(**environ):
+        server = fake_kubernetes.FakeApiServer()
+
+        fake_kubernetes.install(server)
+
+        reset_metrics()
+
+        namespace_file = tmpdir.join('namespace')
+        namespace_file.write('tests')
+
+        settings = {
+            'DASK_NAMESPACE_FILE': str(namespace_file),
+            'DASK_DISCOVERY_CACHE_FILE': str(tmpdir.join('discovery')),
+            'JUPYTERHUB_API_TOKEN': 'tests',
+            'JUPYTERHUB_SERVICE_PREFIX': '/services/dask-controller/',
+            'JUPYTERHUB_NAME': 'jupyterhub',
+            'DASK_CLUSTER_NAME': 'dask',
+            'DASK_CONTROLLER_API_TOKEN': 'tests',
+        }
+
+        settings.update(environ)
+
+        for key, value in settings.items():
+            monkeypatch.setenv(key, value)
+
+        spec = importlib.util.spec_from_file_location(
+                'dask_controller_test%d' % len(loaded), controller_path)
+
+        controller = importlib.util.module_from_spec(spec)
+
+        sys.modules[spec.name] = controller
+
+        spec.loader.exec_module(controller)
+
+        loaded.append(controller)
+
+        for informer in (controller.pod_informer,
+                controller.deployment_informer, controller.service_informer):
+            assert informer.wait_for_sync(10)
+
+        return server, controller
+
+    return load
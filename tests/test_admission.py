@@ -0,0 +1,173 @@
+import threading
+
+from conftest import Sampler, wait_for
+
+def worker_replicas(server, controller, name):
+    deployment = server.get('Deployment', controller.worker_deployment_name(name))
+    return deployment['spec'].get('replicas', 0)
+
+def cached(controller, name, condition):
+    # Waits until the cache of the controller shows the worker deployment
+    # of the cluster as meeting the condition.
+
+    def check():
+        deployment = controller.deployment_informer.get(
+                controller.worker_deployment_name(name))
+        return deployment is not None and condition(deployment)
+
+    return wait_for(check)
+
+def create_clusters(server, controller, names, replicas):
+    for name in names:
+        assert controller.create_cluster(name)
+
+    for name in names:
+        assert cached(controller, name,
+                lambda deployment: deployment.spec.replicas == replicas)
+
+def test_grants_are_limited_to_the_budget(load_controller):
+    server, controller = load_controller(DASK_WORKER_BUDGET='6',
+            DASK_WORKER_REPLICAS='2', DASK_MAX_WORKER_REPLICAS='10')
+
+    create_clusters(server, controller, ['alice', 'bob'], 2)
+
+    result = controller.request_workers('alice', 5)
+
+    assert result['granted'] == 4
+    assert result['position'] == 1
+    assert worker_replicas(server, controller, 'alice') == 4
+
+    assert cached(controller, 'alice',
+            lambda deployment: deployment.spec.replicas == 4)
+
+    # Scaling down is never held back, and the room freed goes to the
+    # request left waiting.
+
+    result = controller.request_workers('bob', 1)
+
+    assert result['granted'] == 1
+
+    assert wait_for(lambda: worker_replicas(server, controller, 'alice') == 5)
+
+def test_fair_shares_divide_the_budget_by_weight(load_controller):
+    server, controller = load_controller()
+
+    shares = controller.fair_shares(10, {'a': (8, 1.0), 'b': (8, 1.0),
+            'c': (2, 1.0)})
+
+    assert shares == {'a': 4.0, 'b': 4.0, 'c': 2.0}
+
+    shares = controller.fair_shares(9, {'a': (9, 2.0), 'b': (9, 1.0)})
+
+    assert round(shares['a'], 6) == 6.0
+    assert round(shares['b'], 6) == 3.0
+
+def test_concurrent_resumes_keep_to_the_budget(load_controller, monkeypatch):
+    names = ['user%d' % index for index in range(8)]
+
+    server, controller = load_controller(DASK_WORKER_BUDGET='16',
+            DASK_WORKER_REPLICAS='2', DASK_MAX_WORKER_REPLICAS='10')
+
+    create_clusters(server, controller, names, 2)
+
+    # Suspend the workers of six clusters, and have another take most of
+    # the room freed, leaving room for only two of the six to resume.
+
+    suspended = names[:6]
+
+    for name in suspended:
+        assert controller.suspend_cluster(name, workers_only=True)
+
+    for name in suspended:
+        assert cached(controller, name,
+                lambda deployment: deployment.spec.replicas == 0)
+
+    assert controller.request_workers('user6', 10)['granted'] == 10
+
+    assert cached(controller, 'user6',
+            lambda deployment: deployment.spec.replicas == 10)
+
+    # Hold back changes from reaching the cache while the clusters are
+    # resumed, as a watch of a busy API server would, so that each resume
+    # still sees the others as suspended.
+
+    informer = controller.deployment_informer
+
+    apply = informer.apply
+
+    released = threading.Event()
+
+    def delayed_apply(event_type, obj):
+        released.wait()
+        apply(event_type, obj)
+
+    monkeypatch.setattr(informer, 'apply', delayed_apply)
+
+    barrier = threading.Barrier(len(suspended))
+
+    def resume(name):
+        barrier.wait()
+        controller.resume_cluster(name)
+
+    with Sampler(server) as sampler:
+        threads = [threading.Thread(target=resume, args=(name,))
+                for name in suspended]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        released.set()
+
+        for name in suspended:
+            assert cached(controller, name, lambda deployment:
+                    not controller.cluster_suspended(name))
+
+    assert sampler.peak <= 16
+
+    assert sum(worker_replicas(server, controller, name)
+            for name in names) == 16
+
+def test_only_the_leader_grants_workers(load_controller, monkeypatch):
+    server, controller = load_controller(DASK_WORKER_BUDGET='6',
+            DASK_WORKER_REPLICAS='2', DASK_MAX_WORKER_REPLICAS='10',
+            DASK_CONTROLLER_SHARDING='true',
+            DASK_CONTROLLER_ADDRESS='127.0.0.1:1',
+            DASK_FORWARD_TIMEOUT='1')
+
+    assert wait_for(lambda: controller.is_leader())
+
+    create_clusters(server, controller, ['alice'], 2)
+
+    monkeypatch.setattr(controller, 'is_leader', lambda: False)
+
+    # A replica which isn't the leader leaves the request waiting rather
+    # than granting it itself.
+
+    result = controller.request_workers('alice', 4)
+
+    assert result['granted'] == 2
+    assert worker_replicas(server, controller, 'alice') == 2
+
+    assert cached(controller, 'alice', lambda deployment:
+            (controller.worker_request(deployment) or {}).get('replicas') == 4)
+
+    # Requests to scale are passed on to the leader, and fail if it can't
+    # be reached.
+
+    response = controller.application.test_client().get(
+            '/services/dask-controller/scale?replicas=5',
+            headers={'Authorization': 'token alice'})
+
+    assert response.status_code == 503
+    assert worker_replicas(server, controller, 'alice') == 2
+
+    # Once it is the leader again, the waiting request is granted.
+
+    monkeypatch.setattr(controller, 'is_leader', lambda: True)
+
+    controller.admission_queue.add('workers')
+
+    assert wait_for(lambda: worker_replicas(server, controller, 'alice') == 4)
@@ -0,0 +1,21 @@
+from conftest import wait_for
+
+def test_cull_latency_is_exported(load_controller):
+    server, controller = load_controller()
+
+    client = controller.application.test_client()
+
+    def observed():
+        response = client.get('/services/dask-controller/metrics')
+
+        for line in response.get_data(as_text=True).splitlines():
+            if line.startswith('dask_controller_cull_latency_seconds_count'):
+                return float(line.split()[-1])
+
+    before = observed()
+
+    assert before is not None
+
+    controller.cull_queue.add('alice')
+
+    assert wait_for(lambda: observed() > before)
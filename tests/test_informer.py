@@ -0,0 +1,18 @@
+from conftest import wait_for
+
+def test_bookmarks_keep_quiet_watches_current(load_controller):
+    server, controller = load_controller(DASK_WATCH_TIMEOUT='1')
+
+    informer = controller.deployment_informer
+
+    # Only services change, so the watch of deployments sees no events,
+    # but is brought up to date by the bookmark sent as it is closed.
+
+    for index in range(5):
+        server.create('Service', {'metadata': {'name': 'other%d' % index,
+                'labels': {}}, 'spec': {}})
+
+    assert int(informer.resource_version or 0) < server.version
+
+    assert wait_for(lambda: int(informer.resource_version) == server.version,
+            timeout=5.0)
@@ -0,0 +1,48 @@
+names = ['user%d' % index for index in range(3000)]
+
+members = ['10.0.0.1:8080', '10.0.0.2:8080', '10.0.0.3:8080']
+
+def owners(ring):
+    return dict((name, ring.owner(name)) for name in names)
+
+def test_each_name_has_one_owner_whatever_the_order(load_controller):
+    server, controller = load_controller()
+
+    ring = controller.HashRing(members, 64)
+
+    assert owners(ring) == owners(controller.HashRing(reversed(members), 64))
+
+    assert set(owners(ring).values()) == set(members)
+
+    # Names are shared out roughly evenly.
+
+    for member in members:
+        count = list(owners(ring).values()).count(member)
+        assert len(names) / 6 < count < len(names) / 2
+
+    assert controller.HashRing([], 64).owner('alice') is None
+
+def test_adding_a_member_only_moves_names_to_it(load_controller):
+    server, controller = load_controller()
+
+    before = owners(controller.HashRing(members, 64))
+    after = owners(controller.HashRing(members + ['10.0.0.4:8080'], 64))
+
+    moved = [name for name in names if before[name] != after[name]]
+
+    assert moved
+    assert len(moved) < len(names) / 2
+
+    assert set(after[name] for name in moved) == {'10.0.0.4:8080'}
+
+def test_removing_a_member_only_moves_its_names(load_controller):
+    server, controller = load_controller()
+
+    before = owners(controller.HashRing(members, 64))
+    after = owners(controller.HashRing(members[1:], 64))
+
+    for name in names:
+        if before[name] != members[0]:
+            assert after[name] == before[name]
+        else:
+            assert after[name] in members[1:]
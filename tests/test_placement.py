@@ -0,0 +1,29 @@
+import json
+
+profiles = {'default': {'worker_placement': 'spread',
+        'worker_topology': 'zone'}}
+
+def test_spread_workers_prefer_not_to_share_a_zone(load_controller):
+    server, controller = load_controller(
+            DASK_CLUSTER_PROFILES=json.dumps(profiles))
+
+    assert controller.create_cluster('alice')
+
+    deployment = server.get('Deployment',
+            controller.worker_deployment_name('alice'))
+
+    spec = deployment['spec']['template']['spec']
+
+    assert 'topologySpreadConstraints' not in spec
+
+    terms = spec['affinity']['podAntiAffinity'][
+            'preferredDuringSchedulingIgnoredDuringExecution']
+
+    assert terms == [{
+        'weight': 100,
+        'podAffinityTerm': {
+            'labelSelector': {'matchLabels': {
+                'deployment': deployment['metadata']['name']}},
+            'topologyKey': 'failure-domain.beta.kubernetes.io/zone'
+        }
+    }]
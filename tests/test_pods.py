@@ -0,0 +1,42 @@
+import json
+
+from conftest import wait_for
+
+profiles = {'default': {'worker_pools': {'highmem': {'replicas': 2}}}}
+
+def watch(controller, user, query=''):
+    response = controller.application.test_client().get(
+            '/services/dask-controller/pods/watch?version=none' + query,
+            headers={'Authorization': 'token %s' % user})
+
+    assert response.status_code == 200
+
+    return response.get_json()
+
+def test_watch_lists_the_pods_of_one_pool(load_controller):
+    server, controller = load_controller(DASK_WORKER_REPLICAS='3',
+            DASK_CLUSTER_PROFILES=json.dumps(profiles))
+
+    assert controller.create_cluster('alice')
+
+    assert wait_for(lambda: len(watch(controller, 'alice')['pods']) == 5)
+
+    assert len(watch(controller, 'alice', '&pool=default')['pods']) == 3
+    assert len(watch(controller, 'alice', '&pool=highmem')['pods']) == 2
+    assert len(watch(controller, 'alice', '&pool=other')['pods']) == 0
+
+def test_versions_are_forgotten_when_the_cluster_is_deleted(load_controller):
+    server, controller = load_controller(DASK_WORKER_REPLICAS='3',
+            DASK_CLUSTER_PROFILES=json.dumps(profiles))
+
+    assert controller.create_cluster('alice')
+
+    deployments = set(controller.cluster_worker_pools('alice').values())
+
+    assert wait_for(lambda: deployments ==
+            set(controller.pod_status_versions))
+
+    assert controller.delete_cluster('alice')
+
+    assert wait_for(lambda: not controller.pod_status_versions and
+            not controller.pod_status_snapshots)
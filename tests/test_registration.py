@@ -0,0 +1,48 @@
+from conftest import wait_for
+
+def test_registration_is_polled_until_the_workers_connect(load_controller,
+        monkeypatch):
+    server, controller = load_controller()
+
+    # The scheduler reports the workers as having registered only on the
+    # third poll.
+
+    polls = []
+
+    def fetch_scheduler_json(name, path, data=None, timeout=None):
+        polls.append(name)
+        workers = {'tcp://worker-1': {}, 'tcp://worker-2': {}}
+        return dict(workers=workers if len(polls) >= 3 else {})
+
+    monkeypatch.setattr(controller, 'fetch_scheduler_json',
+            fetch_scheduler_json)
+
+    controller.tracer.start('alice', 'requested')
+
+    controller.registration_checks['alice'] = (2, controller.time.time() + 30)
+    controller.registration_queue.add('alice')
+
+    assert wait_for(lambda: 'alice' not in controller.registration_checks)
+
+    assert polls == ['alice', 'alice', 'alice']
+    assert controller.tracer.traces()[-1]['outcome'] == 'complete'
+
+def test_registration_stops_polling_after_the_timeout(load_controller,
+        monkeypatch):
+    server, controller = load_controller()
+
+    polls = []
+
+    def fetch_scheduler_json(name, path, data=None, timeout=None):
+        polls.append(name)
+        raise IOError('scheduler is not reachable')
+
+    monkeypatch.setattr(controller, 'fetch_scheduler_json',
+            fetch_scheduler_json)
+
+    controller.registration_checks['alice'] = (2, controller.time.time())
+    controller.registration_queue.add('alice')
+
+    assert wait_for(lambda: 'alice' not in controller.registration_checks)
+
+    assert polls == ['alice']
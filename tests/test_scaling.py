@@ -0,0 +1,84 @@
+from conftest import wait_for
+
+def worker_pods(server, controller, name):
+    deployment = controller.worker_deployment_name(name)
+
+    with server.condition:
+        return dict((pod['metadata']['name'], pod) for pod in
+                server.objects['Pod'].values()
+                if pod['metadata']['labels'].get('deployment') == deployment)
+
+def test_scaling_down_removes_the_workers_retired(load_controller,
+        monkeypatch):
+    server, controller = load_controller(DASK_WORKER_REPLICAS='4',
+            DASK_MAX_WORKER_REPLICAS='10')
+
+    assert controller.create_cluster('alice')
+
+    deployment = controller.worker_deployment_name('alice')
+
+    assert wait_for(lambda: len(controller.pod_informer.by_index(
+            'deployment', deployment)) == 4)
+
+    pods = worker_pods(server, controller, 'alice')
+
+    # The two newest pods hold the most data, so the replica set would
+    # remove the workers which should be kept if left to choose.
+
+    order = sorted(pods, key=lambda name: int(
+            pods[name]['metadata']['annotations']['fake/sequence']))
+
+    memory = dict((name, index + 1) for index, name in enumerate(order))
+
+    addresses = dict((pods[name]['status']['podIP'], name) for name in pods)
+
+    def fetch_scheduler_json(name, path, data=None, timeout=None):
+        return {'workers': dict(('tcp://%s:8786' % ip,
+                {'host': ip, 'memory': memory[pod_name]})
+                for ip, pod_name in addresses.items())}
+
+    retired = []
+
+    def retire_scheduler_workers(name, workers):
+        retired.extend(workers)
+        return dict((address, {}) for address in workers)
+
+    monkeypatch.setattr(controller, 'fetch_scheduler_json',
+            fetch_scheduler_json)
+    monkeypatch.setattr(controller, 'retire_scheduler_workers',
+            retire_scheduler_workers)
+
+    result = controller.scale_workers('alice', 2)
+
+    assert result['retired'] == 2
+    assert result['moved_bytes'] == 3
+
+    assert sorted(retired) == sorted('tcp://%s:8786' % pods[name]['status']
+            ['podIP'] for name in order[:2])
+
+    assert wait_for(lambda: sorted(worker_pods(server, controller,
+            'alice')) == sorted(order[2:]))
+
+def test_scaling_down_without_the_scheduler(load_controller, monkeypatch):
+    server, controller = load_controller(DASK_WORKER_REPLICAS='3',
+            DASK_MAX_WORKER_REPLICAS='10')
+
+    assert controller.create_cluster('alice')
+
+    deployment = controller.worker_deployment_name('alice')
+
+    assert wait_for(lambda: len(controller.pod_informer.by_index(
+            'deployment', deployment)) == 3)
+
+    def fetch_scheduler_json(name, path, data=None, timeout=None):
+        raise IOError('Scheduler not reachable.')
+
+    monkeypatch.setattr(controller, 'fetch_scheduler_json',
+            fetch_scheduler_json)
+
+    result = controller.scale_workers('alice', 1)
+
+    assert result['retired'] == 0
+
+    assert wait_for(lambda: len(worker_pods(server, controller,
+            'alice')) == 1)
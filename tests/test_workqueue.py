@@ -0,0 +1,115 @@
+import threading
+import time
+
+from conftest import wait_for
+
+def test_keys_added_again_are_processed_once_more(load_controller):
+    server, controller = load_controller()
+
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(key):
+        calls.append(key)
+
+        if key == 'a' and len(calls) == 1:
+            started.set()
+            release.wait()
+
+        return True
+
+    queue = controller.WorkQueue('test', handler)
+
+    queue.add('a')
+    queue.start()
+
+    assert started.wait(5)
+
+    # Adding a key while it is being processed queues it once more, and
+    # adding a key already queued does nothing.
+
+    for _ in range(3):
+        queue.add('a')
+        queue.add('b')
+
+    release.set()
+
+    assert wait_for(lambda: queue.status()['completed'] == 3)
+
+    time.sleep(0.1)
+
+    assert sorted(calls) == ['a', 'a', 'b']
+
+def test_failed_keys_are_retried_with_backoff(load_controller):
+    server, controller = load_controller()
+
+    times = []
+
+    def handler(key):
+        times.append(time.time())
+
+        if len(times) < 3:
+            raise RuntimeError('failed')
+
+        return True
+
+    queue = controller.WorkQueue('test', handler, base_delay=0.1)
+
+    queue.add('a')
+    queue.start()
+
+    assert wait_for(lambda: queue.status()['completed'] == 1)
+
+    status = queue.status()
+
+    assert status['failed'] == 2
+    assert status['retrying'] == 0
+
+    assert times[1] - times[0] >= 0.1
+    assert times[2] - times[1] >= 0.2
+
+def test_only_the_earliest_delay_is_kept(load_controller):
+    server, controller = load_controller()
+
+    calls = []
+
+    def handler(key):
+        calls.append((key, time.time()))
+        return True
+
+    queue = controller.WorkQueue('test', handler)
+
+    queue.start()
+
+    started = time.time()
+
+    queue.add_after('a', 60.0)
+    queue.add_after('a', 0.1)
+
+    queue.add_after('b', 0.1)
+    queue.add_after('b', 60.0)
+
+    assert wait_for(lambda: len(calls) == 2)
+
+    assert sorted(key for key, _ in calls) == ['a', 'b']
+    assert all(when - started >= 0.1 for _, when in calls)
+
+    assert queue.status()['delayed'] == 0
+
+def test_keys_are_rate_limited(load_controller):
+    server, controller = load_controller()
+
+    queue = controller.WorkQueue('test', lambda key: True, workers=4,
+            qps=20.0, burst=1)
+
+    for key in range(5):
+        queue.add(key)
+
+    started = time.time()
+
+    queue.start()
+
+    assert wait_for(lambda: queue.status()['completed'] == 5)
+
+    assert time.time() - started >= 0.19